@@ -0,0 +1,416 @@
+import asyncio
+import getopt
+import json
+import math
+import os
+import platform
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from client.client import Client
+from protocol import Protocol
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server')
+
+# server implementations benchmarked, name -> script in the server folder
+SERVER_SCRIPTS = {
+    'asyncio': 'server_with_asyncio.py',
+    'select': 'server_with_selects.py',
+}
+
+# frequent, medium and rare patterns of the synthetic logs
+DEFAULT_PATTERNS = {
+    'frequent': 'a',
+    'medium': 'Receiving block',
+    'rare': 'WARN',
+}
+
+# server settings used unless --serverargs is given: no index and no result cache, so every run scans the logs
+DEFAULT_SERVER_ARGS = ['--indexdir=', '--cachesize=0']
+
+# HDFS message templates and their relative frequency
+LOG_TEMPLATES = [
+    (30, 'INFO', 'dfs.DataNode$PacketResponder', 'PacketResponder {n} for block blk_{blk} terminating'),
+    (25, 'INFO', 'dfs.DataNode$PacketResponder', 'Received block blk_{blk} of size {size} from /{ip}'),
+    (20, 'INFO', 'dfs.DataNode$DataXceiver', 'Receiving block blk_{blk} src: /{ip}:{port} dest: /{ip}:50010'),
+    (15, 'INFO', 'dfs.FSNamesystem', 'BLOCK* NameSystem.addStoredBlock: blockMap updated: {ip}:50010 is added to '
+                                     'blk_{blk} size {size}'),
+    (5, 'INFO', 'dfs.FSNamesystem', 'BLOCK* NameSystem.allocateBlock: /user/root/rand/_temporary/part-{n}. blk_{blk}'),
+    (4, 'INFO', 'dfs.FSDataset', 'Deleting block blk_{blk} file /mnt/hadoop/dfs/data/current/subdir{n}/blk_{blk}'),
+    (1, 'WARN', 'dfs.DataNode$DataXceiver', '{ip}:50010:Got exception while serving blk_{blk} to /{ip}:'),
+]
+
+
+'''
+function to generate a synthetic HDFS style log file (e.g. 081109 203615 148 INFO dfs.DataNode$PacketResponder: ...)
+
+@params path: path of the log file to write
+@params size: approximate size of the log file in bytes
+@params seed: seed of the random generator, the same seed always produces the same file
+'''
+def generate_log_file(path: str, size: int, seed: int) -> None:
+    rand = random.Random(seed)
+    weights = [template[0] for template in LOG_TEMPLATES]
+    timestamp = time.mktime((2008, 11, 9, 20, 36, 15, 0, 0, -1))
+    written = 0
+    with open(path, 'w') as f:
+        while written < size:
+            lines = []
+            for _, level, component, message in rand.choices(LOG_TEMPLATES, weights, k=1000):
+                timestamp += rand.random()
+                ip = f'10.251.{rand.randrange(256)}.{rand.randrange(256)}'
+                lines.append(f'{time.strftime("%y%m%d %H%M%S", time.localtime(timestamp))} {rand.randrange(1, 30000)} '
+                             f'{level} {component}: ' +
+                             message.format(n=rand.randrange(64), blk=rand.randrange(-2 ** 63, 2 ** 63), ip=ip,
+                                            port=rand.randrange(30000, 60000), size=rand.randrange(2 ** 26)) + '\n')
+            chunk = ''.join(lines)
+            f.write(chunk)
+            written += len(chunk)
+
+
+'''
+function to find a free loopback port
+'''
+def find_free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+'''
+function to wait until a server accepts connections
+
+@params port: loopback port of the server
+@params timeout: seconds to wait before giving up
+'''
+def wait_for_server(port: int, timeout: float = 30) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f'server on port {port} did not start within {timeout} seconds')
+
+
+'''
+function to measure the resident set size in KB of a process and all its descendants (e.g. scan workers),
+returns None where /proc is not available
+'''
+def process_tree_rss(pid: int) -> Optional[int]:
+    try:
+        rss = 0
+        pids = [pid]
+        while pids:
+            current = pids.pop()
+            with open(f'/proc/{current}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        rss += int(line.split()[1])
+            with open(f'/proc/{current}/task/{current}/children') as f:
+                pids.extend(int(child) for child in f.read().split())
+        return rss
+    except (OSError, ValueError):
+        return None
+
+
+'''
+function to compute the p-th percentile (nearest rank) of a list of values
+'''
+def percentile(values: List[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def latency_stats(values: List[float]) -> Dict[str, float]:
+    return {
+        'p50': percentile(values, 50),
+        'p99': percentile(values, 99),
+        'mean': sum(values) / len(values),
+        'min': min(values),
+        'max': max(values),
+    }
+
+
+class ServerGroup(object):
+
+    '''
+    N local instances of a server implementation on loopback ports, each serving its own log file
+
+    @params name: name of the server implementation, a key of SERVER_SCRIPTS
+    @params log_files: log file of every instance
+    @params server_args: extra command line arguments of every instance
+    @params workdir: directory for the output of the instances
+    '''
+    def __init__(self, name: str, log_files: List[str], server_args: List[str], workdir: str) -> None:
+        self.name = name
+        self.log_files = log_files
+        self.server_args = server_args
+        self.workdir = workdir
+        self.processes: List[subprocess.Popen] = []
+        self.ports: List[int] = []
+
+    def start(self) -> None:
+        for i, log_file in enumerate(self.log_files):
+            port = find_free_port()
+            output = open(os.path.join(self.workdir, f'{self.name}-{i}.out'), 'w')
+            # own session, so the instance and its worker processes can be stopped together
+            self.processes.append(subprocess.Popen(
+                [sys.executable, SERVER_SCRIPTS[self.name], '--hostname=127.0.0.1', f'--port={port}',
+                 f'--logfile={log_file}'] + self.server_args,
+                cwd=SERVER_DIR, stdout=output, stderr=subprocess.STDOUT, start_new_session=True))
+            output.close()
+            self.ports.append(port)
+        for port in self.ports:
+            wait_for_server(port)
+
+    def rss(self) -> List[Optional[int]]:
+        return [process_tree_rss(process.pid) for process in self.processes]
+
+    def stop(self) -> None:
+        for process in self.processes:
+            try:
+                os.killpg(process.pid, signal.SIGTERM)
+            except (AttributeError, ProcessLookupError):
+                process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+'''
+coroutine to send a query to a single server through the client's pooled connection and time its stages
+
+@params client: client whose connection pool is used
+@params port: loopback port of the server
+@params query: search query
+'''
+async def timed_query(client: Client, port: int, query: str) -> Dict:
+    connection = await client.pool.get_connection('127.0.0.1', port)
+    begin = time.perf_counter()
+    first_frame = None
+    response_bytes = 0
+    summary = {'files': []}
+    async for frame_type, payload in connection.request(query):
+        if first_frame is None:
+            first_frame = time.perf_counter() - begin
+        response_bytes += Protocol.HEADER.size + len(payload)
+        if frame_type == Protocol.FRAME_SUMMARY:
+            summary = Protocol.decode_summary(payload)
+        elif frame_type == Protocol.FRAME_ERROR:
+            raise RuntimeError(payload.decode())
+    return {
+        'total': time.perf_counter() - begin,
+        'first_frame': first_frame,
+        'server_search': summary.get('elapsed', 0.0),
+        'bytes_scanned': summary.get('bytes_scanned', 0),
+        'response_bytes': response_bytes,
+        'matched_lines': sum(file['count'] for file in summary['files']),
+    }
+
+
+'''
+coroutine to run a query on all the servers of a group `runs` times after a warmup run, like a user query of the client
+
+@params ports: loopback ports of the servers
+@params query: search query
+@params runs: number of measured runs
+'''
+async def benchmark_query(ports: List[int], query: str, runs: int) -> Dict:
+    client = Client()
+    try:
+        # warmup: connects to the servers and faults the log files into the page cache
+        await asyncio.gather(*(timed_query(client, port, query) for port in ports))
+
+        latencies = []
+        first_frames = []
+        server_searches = []
+        results = []
+        for _ in range(runs):
+            begin = time.perf_counter()
+            results = await asyncio.gather(*(timed_query(client, port, query) for port in ports))
+            latencies.append(time.perf_counter() - begin)
+            first_frames.append(min(result['first_frame'] for result in results))
+            server_searches.append(max(result['server_search'] for result in results))
+    finally:
+        await client.close()
+
+    bytes_scanned = sum(result['bytes_scanned'] for result in results)
+    median = percentile(latencies, 50)
+    return {
+        'query': query,
+        'runs': runs,
+        'matched_lines': sum(result['matched_lines'] for result in results),
+        'response_bytes': sum(result['response_bytes'] for result in results),
+        'bytes_scanned': bytes_scanned,
+        'latency': latency_stats(latencies),
+        'first_frame': latency_stats(first_frames),
+        'server_search': latency_stats(server_searches),
+        'mb_per_s': bytes_scanned / (1024 * 1024) / median if median > 0 else None,
+    }
+
+
+'''
+function to compare results with a baseline result file, returns the descriptions of the p50 latencies which
+regressed by more than the tolerance
+'''
+def find_regressions(results: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    previous = {(entry['server'], entry['pattern']): entry for entry in baseline.get('results', [])}
+    regressions = []
+    for entry in results['results']:
+        old = previous.get((entry['server'], entry['pattern']))
+        if old is None:
+            continue
+        old_p50 = old['latency']['p50']
+        new_p50 = entry['latency']['p50']
+        if old_p50 > 0 and new_p50 > old_p50 * (1 + tolerance):
+            regressions.append(f"{entry['server']} {entry['pattern']}: p50 {old_p50:.4f}s -> {new_p50:.4f}s")
+    return regressions
+
+
+def usage() -> None:
+    print('usage: python3 benchmark.py --servers=<n> --logsize=<MB> --runs=<n> --output=<json file> '
+          '[--pattern=<name>=<regex> ...] [--queryoptions=<options>] [--implementations=asyncio,select] '
+          '[--serverargs=<server options>] [--workdir=<dir>] [--baseline=<json file>] [--tolerance=<fraction>]')
+
+
+def parse_cmdline_args(arguments: List[str]) -> Dict:
+    settings = {
+        'servers': 2,
+        'log_size': 16,
+        'runs': 10,
+        'output': 'benchmark_results.json',
+        'patterns': {},
+        'query_options': '',
+        'implementations': list(SERVER_SCRIPTS),
+        'server_args': DEFAULT_SERVER_ARGS,
+        'workdir': None,
+        'baseline': None,
+        'tolerance': 0.2,
+        'seed': 425,
+    }
+    try:
+        opts, _ = getopt.getopt(arguments, 'h', [
+            'servers=', 'logsize=', 'runs=', 'output=', 'pattern=', 'queryoptions=', 'implementations=',
+            'serverargs=', 'workdir=', 'baseline=', 'tolerance=', 'seed=', 'help'])
+        for opt, arg in opts:
+            if opt in ('-h', '--help'):
+                usage()
+                sys.exit()
+            elif opt == '--servers':
+                settings['servers'] = max(1, int(arg))
+            elif opt == '--logsize':
+                settings['log_size'] = float(arg)
+            elif opt == '--runs':
+                settings['runs'] = max(1, int(arg))
+            elif opt == '--output':
+                settings['output'] = arg
+            elif opt == '--pattern':
+                name, regex = arg.split('=', 1)
+                settings['patterns'][name] = regex
+            elif opt == '--queryoptions':
+                settings['query_options'] = arg
+            elif opt == '--implementations':
+                settings['implementations'] = [name for name in arg.split(',') if name]
+                if not all(name in SERVER_SCRIPTS for name in settings['implementations']):
+                    raise ValueError(f'unknown implementation in {arg}')
+            elif opt == '--serverargs':
+                settings['server_args'] = arg.split()
+            elif opt == '--workdir':
+                settings['workdir'] = arg
+            elif opt == '--baseline':
+                settings['baseline'] = arg
+            elif opt == '--tolerance':
+                settings['tolerance'] = float(arg)
+            elif opt == '--seed':
+                settings['seed'] = int(arg)
+    except (getopt.GetoptError, ValueError) as e:
+        print(f'invalid arguments: {e}')
+        usage()
+        sys.exit(2)
+
+    settings['patterns'] = settings['patterns'] or dict(DEFAULT_PATTERNS)
+    return settings
+
+
+'''
+function to prepare the log files of the servers, files of the same size and seed are reused across runs
+'''
+def prepare_log_files(workdir: str, count: int, log_size: float, seed: int) -> List[str]:
+    log_files = []
+    size = int(log_size * 1024 * 1024)
+    for i in range(count):
+        path = os.path.join(workdir, f'hdfs-{seed + i}-{size}.log')
+        if not os.path.exists(path):
+            print(f'generating {path} ...')
+            generate_log_file(path + '.tmp', size, seed + i)
+            os.replace(path + '.tmp', path)
+        log_files.append(os.path.abspath(path))
+    return log_files
+
+
+def run_benchmark(settings: Dict, workdir: str) -> Dict:
+    log_files = prepare_log_files(workdir, settings['servers'], settings['log_size'], settings['seed'])
+    results = {
+        'settings': {key: value for key, value in settings.items() if key != 'workdir'},
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+        },
+        'log_bytes': sum(os.path.getsize(log_file) for log_file in log_files),
+        'results': [],
+        'rss_kb': {},
+    }
+
+    for name in settings['implementations']:
+        group = ServerGroup(name, log_files, settings['server_args'], workdir)
+        try:
+            group.start()
+            idle_rss = group.rss()
+            for pattern, regex in settings['patterns'].items():
+                query = f'search {[regex]!r} {settings["query_options"]}'.rstrip()
+                print(f'{name}: running {query} on {len(log_files)} servers ...')
+                entry = asyncio.run(benchmark_query(group.ports, query, settings['runs']))
+                entry.update({'server': name, 'pattern': pattern})
+                results['results'].append(entry)
+                print(f"{name} {pattern}: p50 {entry['latency']['p50']:.4f}s p99 {entry['latency']['p99']:.4f}s "
+                      f"{entry['mb_per_s'] or 0:.1f} MB/s {entry['matched_lines']} lines")
+            results['rss_kb'][name] = {'idle': idle_rss, 'after_queries': group.rss()}
+        finally:
+            group.stop()
+
+    return results
+
+
+if __name__ == '__main__':
+
+    settings = parse_cmdline_args(sys.argv[1:])
+
+    if settings['workdir'] is not None:
+        os.makedirs(settings['workdir'], exist_ok=True)
+        results = run_benchmark(settings, settings['workdir'])
+    else:
+        with tempfile.TemporaryDirectory() as workdir:
+            results = run_benchmark(settings, workdir)
+
+    with open(settings['output'], 'w') as f:
+        json.dump(results, f, indent=4)
+    print(f"results written to {settings['output']}")
+
+    if settings['baseline'] is not None:
+        with open(settings['baseline']) as f:
+            regressions = find_regressions(results, json.load(f), settings['tolerance'])
+        for regression in regressions:
+            print(f'regression: {regression}')
+        if regressions:
+            sys.exit(1)
@@ -1,62 +1,900 @@
 #!/opt/homebrew/bin/python3
+import os
+import re
 import sys
+import heapq
 import asyncio
 import signal
 import getopt
 import time
-from typing import List, Tuple
+import io
+import tempfile
+from collections import deque
+from typing import AsyncIterator, Deque, Dict, List, Optional, Tuple, final
+# wire protocol is shared with the servers
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+from compression import Compression
+from protocol import Protocol, ProtocolError
+from aggregation import Aggregation
+from search_query import SearchQuery
 
-class Client:
+class ServerConnection(object):
 
-    def __init__(self):
-        pass
+    # upper bound on the response frames buffered per in-flight query, applies backpressure on the connection
+    MAX_PENDING_FRAMES = 16
 
     '''
-    coroutine to asyncronously connect, send and recv responses from a single server
+    @params compression: names of the compression codecs offered to the server in order of preference, empty to receive
+                         raw frames
+    '''
+    def __init__(self, hostname: str, port: int, compression: Optional[List[str]] = None):
+        self.hostname = hostname
+        self.port = port
+        self.compression = compression if compression is not None else Compression.available()
+        # codec the server picked for the frames it sends, None while they are raw
+        self.codec = None
+        # whether the codecs of the client were offered, once the server advertised the codecs it supports
+        self.offered = False
+        self.reader = None
+        self.writer = None
+        # task reading response frames and routing them to the in-flight queries
+        self.dispatcher = None
+        # future which completes once the connection is established
+        self.connecting = None
+        # queue of response frames for every in-flight request id
+        self.pending: Dict[int, asyncio.Queue] = {}
+        self.next_request_id = 1
+        self.closed = False
+
+    '''
+    coroutine to connect to the server and start routing response frames
+    '''
+    async def connect(self) -> None:
+        self.reader, self.writer = await asyncio.open_connection(self.hostname, self.port)
+        self.dispatcher = asyncio.ensure_future(self.dispatch_responses())
+
+    '''
+    coroutine to read response frames from the server and hand them to the query with the matching request id
+    '''
+    async def dispatch_responses(self) -> None:
+        try:
+            while True:
+                frame = await Protocol.read_frame(self.reader, self.codec)
+                if frame is None:
+                    break
+                frame_type, request_id, payload = frame
+                if frame_type == Protocol.FRAME_HELLO:
+                    if not self.offered:
+                        # the server advertised compression, frames stay raw until it answered the offer. requests
+                        # need not wait for the answer, a server which advertised nothing is never offered codecs
+                        self.offered = True
+                        if self.compression:
+                            self.writer.write(Protocol.encode_hello(self.compression))
+                    else:
+                        self.codec = Compression.get(payload.decode())
+                    continue
+                responses = self.pending.get(request_id)
+                # frames of abandoned queries are dropped
+                if responses is not None:
+                    await responses.put((frame_type, payload))
+        except (ProtocolError, asyncio.IncompleteReadError, ConnectionError) as e:
+            print(f'connection to server ({self.hostname}:{self.port}) failed: {e}')
+        finally:
+            self.closed = True
+            # wake up the queries waiting for frames which will never arrive
+            for responses in self.pending.values():
+                if not responses.full():
+                    responses.put_nowait(None)
+
+    def allocate_request_id(self) -> int:
+        request_id = self.next_request_id
+        self.next_request_id += 1
+        return request_id
+
+    '''
+    async generator sending a query on this connection and yielding its response frames until the end of the response
 
-    @params server_hostname: Hostname of server as specified in the config file
-    @params server_port: Port on which server application is running
     @params query: Search query entered by user
+    @params request_id: request id allocated beforehand, e.g. to cancel the query later, a new one by default
+    @params deadline: event loop time by which the response must have ended, asyncio.TimeoutError is raised once it
+                      passed. A query abandoned before the end of its response is cancelled on the server.
+    '''
+    async def request(self, query: str, request_id: Optional[int] = None,
+                      deadline: Optional[float] = None) -> AsyncIterator[Tuple[int, bytes]]:
+        if request_id is None:
+            request_id = self.allocate_request_id()
+        responses = asyncio.Queue(self.MAX_PENDING_FRAMES)
+        self.pending[request_id] = responses
+        loop = asyncio.get_running_loop()
+        ended = False
+
+        try:
+            self.writer.write(Protocol.encode_frame(Protocol.FRAME_REQUEST, request_id, query.encode()))
+            await self.writer.drain()
+
+            while True:
+                if self.closed and responses.empty():
+                    raise ConnectionError('connection closed before the end of the response')
+                if deadline is None or not responses.empty():
+                    frame = await responses.get()
+                else:
+                    frame = await asyncio.wait_for(responses.get(), deadline - loop.time())
+                if frame is None:
+                    raise ConnectionError('connection closed before the end of the response')
+                ended = frame[0] in (Protocol.FRAME_SUMMARY, Protocol.FRAME_ERROR)
+                yield frame
+                if ended:
+                    break
+        finally:
+            del self.pending[request_id]
+            # the dispatcher may wait for room in the queue of an abandoned query
+            while not responses.empty():
+                responses.get_nowait()
+            if not ended and not self.closed:
+                # stop the search on the server, e.g. after the deadline, the frames it still sends are dropped
+                self.writer.write(Protocol.encode_frame(Protocol.FRAME_CANCEL, request_id, b''))
+
+    '''
+    coroutine to ask the server to end the response of an in-flight query, e.g. a follow query
+    '''
+    async def cancel(self, request_id: int) -> None:
+        self.writer.write(Protocol.encode_frame(Protocol.FRAME_CANCEL, request_id, b''))
+        await self.writer.drain()
+
+    '''
+    coroutine to close the connection
+    '''
+    async def close(self) -> None:
+        self.closed = True
+        if self.dispatcher is not None:
+            self.dispatcher.cancel()
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except ConnectionError:
+                pass
+
+
+class ConnectionPool(object):
+
+    '''
+    @params compression: names of the compression codecs offered to the servers, None for all the available ones
+    '''
+    def __init__(self, compression: Optional[List[str]] = None):
+        # long-lived connection for every server
+        self.connections: Dict[Tuple[str, int], ServerConnection] = {}
+        self.compression = compression
+
+    '''
+    coroutine to get the open connection to a server, connecting only if there is none yet or the previous one was
+    closed
+
+    @params hostname: Hostname of server as specified in the config file
+    @params port: Port on which server application is running
+    @params deadline: event loop time by which the connection must be established, asyncio.TimeoutError otherwise
+    '''
+    async def get_connection(self, hostname: str, port: int, deadline: Optional[float] = None) -> ServerConnection:
+        connection = self.connections.get((hostname, port))
+        if connection is None or connection.closed:
+            connection = ServerConnection(hostname, port, self.compression)
+            connection.connecting = asyncio.ensure_future(connection.connect())
+            self.connections[(hostname, port)] = connection
+
+        try:
+            # concurrent queries to the same server share a single connection attempt, which goes on when one of
+            # them stops waiting for it
+            timeout = deadline - asyncio.get_running_loop().time() if deadline is not None else None
+            await asyncio.wait_for(asyncio.shield(connection.connecting), timeout)
+        except Exception:
+            # a failed attempt is retried by the next query
+            if connection.connecting.done():
+                connection.closed = True
+            raise
+
+        return connection
+
+    '''
+    coroutine to close all the pooled connections
+    '''
+    async def close(self) -> None:
+        for connection in self.connections.values():
+            await connection.close()
+        self.connections.clear()
+
+
+class ResultSpool(object):
+
+    '''
+    Matched lines of a response, buffered in memory up to max_size bytes and spilled to a temporary file beyond that.
+    Lines are appended by the task reading the response and read back in chunks of complete lines by the merge, the
+    spool is emptied whenever all the lines written so far were read.
+
+    @params max_size: bytes buffered in memory before the spool is moved to a temporary file
+    '''
+
+    # bytes read back from the spool at once
+    READ_SIZE: final = 1024 * 1024
+
+    def __init__(self, max_size: int):
+        self.file = tempfile.SpooledTemporaryFile(max_size=max_size)
+        self.write_position = 0
+        self.read_position = 0
+
+    def pending(self) -> int:
+        return self.write_position - self.read_position
+
+    '''
+    append lines ending with a newline
+    '''
+    def write(self, lines: bytes) -> None:
+        self.file.seek(self.write_position)
+        self.file.write(lines)
+        self.write_position += len(lines)
+
+    '''
+    read the next chunk of complete lines
+    '''
+    def read(self) -> bytes:
+        self.file.seek(self.read_position)
+        data = self.file.read(min(self.pending(), ResultSpool.READ_SIZE))
+        end = data.rfind(b'\n') + 1
+        if end == 0:
+            # line longer than a chunk, writes always end with a newline
+            data += self.file.readline()
+        elif end < len(data):
+            data = data[:end]
+        self.read_position += len(data)
+        if self.read_position == self.write_position:
+            self.file.seek(0)
+            self.file.truncate()
+            self.write_position = self.read_position = 0
+        return data
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class ClientTrace(object):
+
+    '''
+    Timings of a query on the client: for every server queried the seconds spent connecting (0 on a pooled
+    connection) and the seconds from sending the query to the first and the last byte of the response, and the
+    seconds spent merging the responses for the console
+    '''
+
+    SPANS: final = ('connect', 'first_byte', 'last_byte')
+
+    def __init__(self) -> None:
+        self.begin = time.perf_counter()
+        self.servers: Dict[Tuple[str, int], Dict[str, float]] = {}
+        self.merge = 0.0
+
+    def add(self, server: Tuple[str, int], span: str, seconds: float) -> None:
+        self.servers.setdefault(server, {})[span] = seconds
+
+    '''
+    record that a span of a server ended now
+    '''
+    def mark(self, server: Tuple[str, int], span: str) -> None:
+        self.add(server, span, time.perf_counter() - self.begin)
+
+    def format(self) -> str:
+        lines = []
+        for (hostname, port), spans in self.servers.items():
+            timings = ', '.join(f'{span} {spans[span] * 1000:.1f}ms' for span in ClientTrace.SPANS if span in spans)
+            lines.append(f'trace of server ({hostname}:{port}): {timings}\n')
+        if self.merge:
+            lines.append(f'merging the responses took {self.merge * 1000:.1f}ms\n')
+        return ''.join(lines)
+
+
+class ResponseStream(object):
+
+    '''
+    Matched lines of the response of a single server. A task reads the response as fast as the server sends it into
+    a spool, so a server is never held back by a slower one, and the merge takes the lines from the spool.
+
+    @params hostname: Hostname of the server
+    @params port: Port of the server
+    @params max_memory: bytes of matched lines held in memory before they are spilled to disk
+    '''
+
+    # start of a line up to its timestamp, the line may be prefixed with the path of its log file
+    TIMESTAMP_REGEX = re.compile(rb'(?:[^:\n]*:)?(\d{6} \d{6})')
+
+    def __init__(self, hostname: str, port: int, max_memory: int):
+        self.hostname = hostname
+        self.port = port
+        # replica of the server which answered
+        self.replica = (hostname, port)
+        self.spool = ResultSpool(max_memory)
+        self.lines: Deque[bytes] = deque()
+        self.summary = {'files': []}
+        self.error = None
+        # matched lines received, counted when the response did not end before the deadline
+        self.num_lines = 0
+        # task reading the response into the spool, set once more lines were spooled or the response ended
+        self.reader = None
+        self.received = asyncio.Event()
+        self.done = False
+        # timestamp of the last line with one, lines without a timestamp (e.g. stack traces) stay after it
+        self.timestamp = b''
+        # trace of the query, the end of the response is recorded to it
+        self.trace = None
+
+    '''
+    coroutine to send the query to the server (or its replicas) and start reading the response once its first frame
+    arrived
+    '''
+    async def start(self, client: 'Client', query: str, deadline: Optional[float] = None) -> None:
+        self.trace = client.trace
+        try:
+            self.replica, responses, frame = await client.open_response(self.hostname, self.port, query, deadline)
+            self.reader = asyncio.ensure_future(self.read_responses(responses, frame))
+        except asyncio.TimeoutError:
+            self.time_out()
+        except Exception as e:
+            self.fail(e)
+
+    '''
+    coroutine to read the frames of the response, the matched lines are written to the spool
+    '''
+    async def read_responses(self, responses: AsyncIterator[Tuple[int, bytes]], frame: Tuple[int, bytes]) -> None:
+        try:
+            while True:
+                frame_type, payload = frame
+                if frame_type == Protocol.FRAME_BATCH:
+                    num_lines, lines = Protocol.decode_batch(payload)
+                    self.num_lines += num_lines
+                    self.spool.write(lines)
+                    self.received.set()
+                elif frame_type == Protocol.FRAME_SUMMARY:
+                    self.summary = Protocol.decode_summary(payload)
+                elif frame_type == Protocol.FRAME_ERROR:
+                    self.error = payload.decode()
+                try:
+                    frame = await responses.__anext__()
+                except StopAsyncIteration:
+                    break
+        except asyncio.TimeoutError:
+            self.time_out()
+        except Exception as e:
+            self.fail(e)
+        finally:
+            self.done = True
+            self.received.set()
+            if self.trace is not None:
+                self.trace.mark(self.replica, 'last_byte')
+
+    def fail(self, e: Exception) -> None:
+        self.error = f'Failed to fetch logs from server with Exception ({e})'
+        self.done = True
+
+    '''
+    the response did not end before the deadline, the lines received so far are partial results
+    '''
+    def time_out(self) -> None:
+        self.summary = {'files': [], 'partial': Client.NO_RESPONSE_BEFORE_DEADLINE}
+        self.done = True
+
+    def has_buffered_lines(self) -> bool:
+        return bool(self.lines) or self.spool.pending() > 0
+
+    '''
+    coroutine to take the next line of the response, None once all the lines were taken
+    '''
+    async def next_line(self) -> Optional[bytes]:
+        while not self.lines:
+            if self.spool.pending():
+                self.lines.extend(self.spool.read()[:-1].split(b'\n'))
+            elif self.done:
+                return None
+            else:
+                self.received.clear()
+                await self.received.wait()
+        return self.lines.popleft()
+
+    '''
+    key ordering the line among the lines of all the servers
+    '''
+    def sort_key(self, line: bytes) -> bytes:
+        match = ResponseStream.TIMESTAMP_REGEX.match(line)
+        if match is not None:
+            self.timestamp = match.group(1)
+        return self.timestamp
+
+    def close(self) -> None:
+        if self.reader is not None:
+            self.reader.cancel()
+        self.spool.close()
+
+
+class Client:
+
     '''
-    async def fetch_logs_from_server(self, server_hostname: str, server_port: int, query: str) -> Tuple[int, str]:
+    @params max_result_memory: bytes of matched lines held in memory per query, shared by the servers, the rest
+                               is spilled to temporary files
+    @params timeout: seconds after which the servers stop searching for a query without a timeout option and return
+                     partial results, 0 to wait for the complete results of such queries
+    @params replicas: other servers holding a copy of the logs of a server, queried when it is slow to answer
+    @params compression: names of the compression codecs offered to the servers in order of preference, None for all
+                         the available ones, empty to receive raw frames
+    @params trace_queries: whether the timings of every query are printed after its results
+    '''
+
+    # default bytes of matched lines held in memory per query
+    MAX_RESULT_MEMORY: final = 64 * 1024 * 1024
+
+    # seconds after the timeout of a query the client waits for the partial results of the servers
+    DEADLINE_GRACE: final = 1
 
+    NO_RESPONSE_BEFORE_DEADLINE: final = 'no response before the deadline'
+
+    # a replica is queried too when the first one did not answer within this percentile of the recent response times
+    HEDGE_PERCENTILE: final = 95
+
+    # response times the hedge delay is computed from, and the fixed delay used until enough of them were measured
+    MAX_LATENCY_SAMPLES: final = 256
+    MIN_LATENCY_SAMPLES: final = 16
+    DEFAULT_HEDGE_DELAY: final = 0.5
+
+    # size of the buffer of the matched lines written to the console
+    OUTPUT_BUFFER_SIZE: final = 1024 * 1024
+
+    # query answered by the servers with their metrics
+    STATS_QUERY: final = 'stats'
+
+    def __init__(self, max_result_memory: int = MAX_RESULT_MEMORY, timeout: int = 0,
+                 replicas: Optional[Dict[Tuple[str, int], List[Tuple[str, int]]]] = None,
+                 compression: Optional[List[str]] = None, trace_queries: bool = False):
+        # connections are reused across queries and shared by concurrent queries
+        self.pool = ConnectionPool(compression)
+        self.max_result_memory = max_result_memory
+        self.timeout = timeout
+        self.replicas = replicas if replicas is not None else {}
+        # seconds from sending recent queries to the first frame of their response
+        self.latencies: Deque[float] = deque(maxlen=Client.MAX_LATENCY_SAMPLES)
+        self.trace_queries = trace_queries
+        # trace of the query being handled, None when the client is used for single requests
+        self.trace: Optional[ClientTrace] = None
+
+    '''
+    seconds to wait for the first frame of a response before querying another replica
+    '''
+    def hedge_delay(self) -> float:
+        if len(self.latencies) < Client.MIN_LATENCY_SAMPLES:
+            return Client.DEFAULT_HEDGE_DELAY
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, len(latencies) * Client.HEDGE_PERCENTILE // 100)]
+
+    '''
+    coroutine to send a query to a single server over a pooled connection, returns the response frames and the first
+    of them
+    '''
+    async def request_first_frame(self, hostname: str, port: int, query: str, deadline: Optional[float]) \
+            -> Tuple[AsyncIterator[Tuple[int, bytes]], Tuple[int, bytes]]:
+        loop = asyncio.get_running_loop()
+        for attempt in range(2):
+            begin = loop.time()
+            connection = await self.pool.get_connection(hostname, port, deadline)
+            if self.trace is not None:
+                self.trace.add((hostname, port), 'connect', loop.time() - begin)
+            # a pooled connection may have been closed by the server since it was last used
+            reused = connection.next_request_id > 1
+            responses = connection.request(query, deadline=deadline)
+            try:
+                frame = await responses.__anext__()
+            except ConnectionError:
+                if attempt > 0 or not reused:
+                    raise
+                continue
+            self.latencies.append(loop.time() - begin)
+            if self.trace is not None:
+                self.trace.mark((hostname, port), 'first_byte')
+            return responses, frame
+
+    '''
+    coroutine to send a query to a server and, when it does not answer within the hedge delay (or fails), to its
+    replicas one after the other. The first replica to answer is kept and the queries to the others are cancelled.
+    Returns the replica which answered, its response frames and the first of them.
+
+    @params hostname: Hostname of server as specified in the config file
+    @params port: Port on which server application is running
+    @params query: Search query entered by user
+    @params deadline: event loop time by which the response must have ended
+    '''
+    async def open_response(self, hostname: str, port: int, query: str, deadline: Optional[float] = None) \
+            -> Tuple[Tuple[str, int], AsyncIterator[Tuple[int, bytes]], Tuple[int, bytes]]:
+        replicas = [(hostname, port)] + self.replicas.get((hostname, port), [])
+        attempts: Dict[asyncio.Future, Tuple[str, int]] = {}
+        error = None
         try:
-            # Connect to the server
-            reader, writer = await asyncio.open_connection(
-                server_hostname, server_port
-            )
+            for i, replica in enumerate(replicas):
+                attempts[asyncio.ensure_future(self.request_first_frame(*replica, query, deadline))] = replica
+                # the last replica is waited for as long as it takes
+                delay = self.hedge_delay() if i + 1 < len(replicas) else None
+                while attempts:
+                    done, _ = await asyncio.wait(attempts, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+                    if not done:
+                        break
+                    for attempt in done:
+                        answered = attempts.pop(attempt)
+                        if attempt.exception() is None:
+                            return (answered,) + attempt.result()
+                        error = attempt.exception()
+                    if i + 1 < len(replicas):
+                        # a failed replica is replaced right away
+                        break
+            raise error
+        finally:
+            # queries to the slower replicas are cancelled on their servers
+            for attempt in attempts:
+                attempt.cancel()
+
+    '''
+    coroutine to collect the response of a server from its first frame on
 
-            # Send search query to the server
-            writer.write(query.encode())
-            await writer.drain()
+    @params server: server the partial results are flagged for
+    @params responses: response frames of the server
+    @params frame: first response frame
+    @params aggregates: list the partial aggregate of an aggregate query is appended to
+    @params keep_lines: whether the matched lines are kept, only the counts are returned otherwise
+    @params partials: servers whose results are partial, mapped to the reason
+    '''
+    async def collect_response(self, server: Tuple[str, int], responses: AsyncIterator[Tuple[int, bytes]],
+                               frame: Tuple[int, bytes], aggregates: Optional[List[Dict]] = None,
+                               keep_lines: bool = True,
+                               partials: Optional[Dict[Tuple[str, int], str]] = None) -> Tuple[int, str]:
 
-            num_log_lines = 0
-            logs = ""
+        batches = []
+        summary = None
+        num_lines = 0
 
+        # Read server response frame by frame, each batch frame carries many matched lines
+        try:
             while True:
-                # Read server response line by line
-                log_line = await reader.readline()
-                if not log_line:
+                frame_type, payload = frame
+                if frame_type == Protocol.FRAME_BATCH:
+                    count, lines = Protocol.decode_batch(payload)
+                    num_lines += count
+                    if keep_lines:
+                        batches.append(lines)
+                elif frame_type == Protocol.FRAME_SUMMARY:
+                    summary = Protocol.decode_summary(payload)
+                elif frame_type == Protocol.FRAME_ERROR:
+                    batches = [payload + b'\n']
+                    summary = {'files': []}
+                try:
+                    frame = await responses.__anext__()
+                except StopAsyncIteration:
                     break
+        except asyncio.TimeoutError:
+            summary = {'files': [], 'partial': Client.NO_RESPONSE_BEFORE_DEADLINE}
 
-                log_line = log_line.decode()
-                # increment macthed line count and append each log line to logs variable
-                if log_line:
-                    logs += log_line
-                    num_log_lines += 1
+        num_log_lines, counts = Client.format_summary(summary, aggregates)
+        if 'partial' in summary:
+            if partials is not None:
+                partials[server] = summary['partial']
+            # a server which did not answer in time sent no counts, only the lines received are known
+            num_log_lines = max(num_log_lines, num_lines)
+        return num_log_lines, b''.join(batches).decode() + counts
 
-            # Close connection with server
-            writer.close()
-            await writer.wait_closed()
+    '''
+    function to turn the summary of a response into the matched line count and the text with the counts per file,
+    the file errors and the exists flag. the partial aggregate of an aggregate query is appended to aggregates.
+    '''
+    @staticmethod
+    def format_summary(summary: Dict, aggregates: Optional[List[Dict]] = None) -> Tuple[int, str]:
+        logs = ''
+        # matched line counts come from the summary, count and exists queries send no lines
+        files = summary['files']
+        num_log_lines = sum(file['count'] for file in files)
+        # append matched line count for all the searched files, marking counts cut short by the query options
+        counts = [f"{file['count']}+" if file.get('truncated') else str(file['count']) for file in files]
+        if len(files) == 1:
+            logs += f"{files[0]['file']}: {counts[0]}\n"
+        elif files:
+            logs += ','.join(f"{file['file']}:{count}" for file, count in zip(files, counts)) + '\n'
+        for file in files:
+            if 'error' in file:
+                logs += f"{file['file']}: {file['error']}\n"
+        if 'exists' in summary:
+            logs += f"exists: {summary['exists']}\n"
+        if 'partial' in summary:
+            logs += f"partial results: {summary['partial']}\n"
+        if 'aggregate' in summary and aggregates is not None:
+            aggregates.append(summary['aggregate'])
+
+        return num_log_lines, logs
+
+    '''
+    function to turn a query into a count query when its matched lines are not going to be printed,
+    so the servers do not send them at all
+    '''
+    @staticmethod
+    def count_only_query(query: str) -> str:
+        try:
+            search_query = SearchQuery.parse(query)
+        except ValueError:
+            return query
+        if search_query.mode != SearchQuery.MODE_LINES or search_query.limit or search_query.head or search_query.tail \
+                or search_query.follow:
+            return query
+        return Client.add_option(query, SearchQuery.MODE_COUNT)
+
+    '''
+    function to add an option to a valid query
+    '''
+    @staticmethod
+    def add_option(query: str, option: str) -> str:
+        # the field query takes the rest of the query, options go before it
+        _, options = SearchQuery.split_search_strings(query[len('search '):])
+        where = SearchQuery.WHERE_REGEX.search(query, len(query) - len(options))
+        if where is not None:
+            return query[:where.start()] + ' ' + option + query[where.start():]
+        return query + ' ' + option
+
+    '''
+    function to add the timeout of the client to a query without one, if the client was given a timeout. returns the
+    query and the event loop time by which the responses of the servers must have ended, None if there is no deadline
+    '''
+    def apply_deadline(self, query: str) -> Tuple[str, Optional[float]]:
+        try:
+            search_query = SearchQuery.parse(query)
+        except ValueError:
+            return query, None
+        timeout = search_query.timeout
+        if timeout is None:
+            if not self.timeout:
+                return query, None
+            timeout = self.timeout
+            query = Client.add_option(query, f'timeout {timeout}s')
+        # the servers stop searching at the timeout, their partial results take a moment to arrive
+        return query, asyncio.get_running_loop().time() + timeout + Client.DEADLINE_GRACE
+
+    '''
+    coroutine to send a query to all the servers and print their matched lines merged by timestamp as they arrive.
+    The lines of every server are expected in time order, a heap holds the next line of every server and the
+    earliest is printed once every server has a line buffered (or finished), so printing starts before the slowest
+    server finished. Lines not printed yet are spooled per server and spilled to disk beyond the memory ceiling of
+    the client, and printed lines go through a large buffered writer.
+
+    @params server_details: Details of all servers from the config file
+    @params query: Search query entered by user
+    @params aggregates: list the partial aggregates of an aggregate query are appended to
+    @params deadline: event loop time by which the responses must have ended, the lines received by then are printed
+    @params partials: servers whose results are partial, mapped to the reason
+    '''
+    async def print_merged_responses(self, server_details, query: str, aggregates: Optional[List[Dict]] = None,
+                                     deadline: Optional[float] = None,
+                                     partials: Optional[Dict[Tuple[str, int], str]] = None) -> List[Tuple[int, str]]:
 
-            return num_log_lines - 1, logs
+        # SpooledTemporaryFile never rolls over to disk with a max_size of 0
+        max_memory = max(self.max_result_memory // max(len(server_details), 1), 1)
+        streams = [ResponseStream(hostname, port, max_memory) for hostname, port in server_details]
+        await asyncio.gather(*(stream.start(self, query, deadline) for stream in streams))
 
+        sys.stdout.flush()
+        output = io.BufferedWriter(io.FileIO(sys.stdout.fileno(), 'w', closefd=False), Client.OUTPUT_BUFFER_SIZE)
+        begin = time.perf_counter()
+        try:
+            heap = []
+            for i, stream in enumerate(streams):
+                line = await stream.next_line()
+                if line is not None:
+                    heap.append((stream.sort_key(line), i, line))
+            heapq.heapify(heap)
+
+            prefixes = [f'{hostname}:{port}: '.encode() for hostname, port in server_details]
+            while heap:
+                _, i, line = heap[0]
+                output.write(prefixes[i] + line + b'\n')
+                stream = streams[i]
+                # printed lines are flushed before waiting for a server
+                if not stream.has_buffered_lines():
+                    output.flush()
+                line = await stream.next_line()
+                if line is None:
+                    heapq.heappop(heap)
+                else:
+                    heapq.heapreplace(heap, (stream.sort_key(line), i, line))
+        finally:
+            output.flush()
+            for stream in streams:
+                stream.close()
+            if self.trace is not None:
+                self.trace.merge = time.perf_counter() - begin
+
+        results = []
+        for stream in streams:
+            if stream.error is not None:
+                results.append((0, stream.error + '\n'))
+                continue
+            num_log_lines, counts = Client.format_summary(stream.summary, aggregates)
+            if stream.replica != (stream.hostname, stream.port):
+                counts += f'answered by replica {stream.replica[0]}:{stream.replica[1]}\n'
+            if 'partial' in stream.summary:
+                if partials is not None:
+                    partials[(stream.hostname, stream.port)] = stream.summary['partial']
+                num_log_lines = max(num_log_lines, stream.num_lines)
+            results.append((num_log_lines, counts))
+        return results
+
+    '''
+    coroutine to asyncronously send a query and recv responses from a single server over a pooled connection
+
+    @params server_hostname: Hostname of server as specified in the config file
+    @params server_port: Port on which server application is running
+    @params query: Search query entered by user
+    @params aggregates: list the partial aggregate of an aggregate query is appended to
+    @params keep_lines: whether the matched lines are kept, only the counts are returned otherwise
+    @params deadline: event loop time by which the response must have ended, the lines received by then are returned
+    @params partials: servers whose results are partial, mapped to the reason
+    '''
+    async def fetch_logs_from_server(self, server_hostname: str, server_port: int, query: str,
+                                     aggregates: Optional[List[Dict]] = None, keep_lines: bool = True,
+                                     deadline: Optional[float] = None,
+                                     partials: Optional[Dict[Tuple[str, int], str]] = None) -> Tuple[int, str]:
+
+        server = (server_hostname, server_port)
+        try:
+            replica, responses, frame = await self.open_response(server_hostname, server_port, query, deadline)
+            num_log_lines, logs = await self.collect_response(server, responses, frame, aggregates, keep_lines,
+                                                              partials)
+            if self.trace is not None:
+                self.trace.mark(replica, 'last_byte')
+            if replica != server:
+                logs += f'answered by replica {replica[0]}:{replica[1]}\n'
+            return num_log_lines, logs
+
+        except asyncio.TimeoutError:
+            # no replica answered before the deadline
+            if partials is not None:
+                partials[server] = Client.NO_RESPONSE_BEFORE_DEADLINE
+            return 0, f'partial results: {Client.NO_RESPONSE_BEFORE_DEADLINE}\n'
         except Exception as e:
             print(f'logs from server ({server_hostname}:{server_port}):')
             print(
                 f'Failed to fetch logs from server with Exception ({e})')
             return 0, ""
 
+    '''
+    coroutine to follow a query on a single server, printing the matched lines pushed by the server as they arrive
+    until stop completes. returns the number of matched lines pushed.
+
+    @params stop: future which completes when the user stops following
+    '''
+    async def follow_server(self, server_hostname: str, server_port: int, query: str, stop: asyncio.Future,
+                            print_logs_to_console: bool = True) -> int:
+
+        num_log_lines = 0
+        canceller = None
+        try:
+            connection = await self.pool.get_connection(server_hostname, server_port)
+            request_id = connection.allocate_request_id()
+
+            async def cancel_on_stop() -> None:
+                await stop
+                await connection.cancel(request_id)
+
+            # the request frame is written before the canceller first runs
+            canceller = asyncio.ensure_future(cancel_on_stop())
+            async for frame_type, payload in connection.request(query, request_id):
+                if frame_type == Protocol.FRAME_BATCH:
+                    num_lines, lines = Protocol.decode_batch(payload)
+                    num_log_lines += num_lines
+                    if print_logs_to_console:
+                        prefix = f'{server_hostname}:{server_port}: '
+                        print(prefix + lines[:-1].decode().replace('\n', '\n' + prefix))
+                elif frame_type == Protocol.FRAME_ERROR:
+                    print(f'logs from server ({server_hostname}:{server_port}): {payload.decode()}')
+
+        except Exception as e:
+            print(f'Failed to follow logs of server ({server_hostname}:{server_port}) with Exception ({e})')
+        finally:
+            if canceller is not None:
+                canceller.cancel()
+
+        return num_log_lines
+
+    '''
+    coroutine to follow a query on all the servers: the lines appended to the logs of the servers are printed as
+    a single live stream as the servers push them, until the user presses enter
+
+    @params server_details: Details of all servers from the config file
+    @params query: Follow query entered by user
+    @params print_logs_to_console: Flag to turn off/on log printing to console
+    '''
+    async def follow_user_query(self, server_details, query: str, print_logs_to_console: bool = True) -> None:
+
+        loop = asyncio.get_running_loop()
+        stop = loop.create_future()
+
+        def read_stop_line() -> None:
+            loop.remove_reader(sys.stdin)
+            sys.stdin.readline()
+            if not stop.done():
+                stop.set_result(None)
+
+        print('following the logs, press enter to stop')
+        try:
+            # stdin is watched by the event loop rather than read by a thread, so nothing is left reading it when
+            # following ends because every server failed
+            loop.add_reader(sys.stdin, read_stop_line)
+            watching_stdin = True
+        except (NotImplementedError, ValueError, OSError):
+            # event loops which cannot watch stdin (e.g. on windows) read it in a thread
+            stop = loop.run_in_executor(None, input)
+            watching_stdin = False
+
+        background_tasks = [self.follow_server(hostname, port, query, stop, print_logs_to_console)
+                            for hostname, port in server_details]
+        try:
+            results = await asyncio.gather(*background_tasks)
+        finally:
+            if watching_stdin:
+                loop.remove_reader(sys.stdin)
+
+        print('matched line count per server: ')
+        for server_detail, num_log_lines in zip(server_details, results):
+            print(f'{server_detail}: {num_log_lines}')
+        print(f'Total matched line count for all server: {sum(results)}')
+
+    '''
+    function to format the metrics of a server: its counters and gauges, and the count and percentiles of its
+    histograms, durations in milliseconds
+    '''
+    @staticmethod
+    def format_stats(stats: Dict) -> str:
+        lines = [f"uptime: {stats['uptime']:.0f} seconds\n"]
+        # servers running several worker processes report the metrics of the worker serving the connection
+        if stats.get('worker') is not None:
+            lines.append(f"worker: {stats['worker']}\n")
+        for name, value in sorted({**stats['counters'], **stats['gauges']}.items()):
+            lines.append(f'{name}: {value}\n')
+        for name, histogram in sorted(stats['histograms'].items()):
+            if not histogram['count']:
+                continue
+            scale, unit = (1000, 'ms') if name.endswith('_seconds') else (1, '')
+            label = name[:-len('_seconds')] if unit else name
+            percentiles = ', '.join(f'{percentile} {histogram[percentile] * scale:.1f}{unit}'
+                                    for percentile in ('p50', 'p95', 'p99', 'max'))
+            lines.append(f"{label}: count {histogram['count']}, {percentiles}\n")
+        return ''.join(lines)
+
+    '''
+    coroutine to fetch the metrics of all the servers and print them
+    '''
+    async def print_server_stats(self, server_details) -> None:
+
+        async def fetch_stats(hostname: str, port: int) -> Dict:
+            connection = await self.pool.get_connection(hostname, port)
+            stats = None
+            async for frame_type, payload in connection.request(Client.STATS_QUERY):
+                if frame_type == Protocol.FRAME_SUMMARY:
+                    stats = Protocol.decode_summary(payload).get('stats')
+                elif frame_type == Protocol.FRAME_ERROR:
+                    raise ValueError(payload.decode())
+            if stats is None:
+                raise ValueError('server does not report stats')
+            return stats
+
+        results = await asyncio.gather(*(fetch_stats(hostname, port) for hostname, port in server_details),
+                                       return_exceptions=True)
+        for (hostname, port), stats in zip(server_details, results):
+            print(f'stats of server ({hostname}:{port}):')
+            if isinstance(stats, Exception):
+                print(f'Failed to fetch stats from server with Exception ({stats})')
+            else:
+                print(Client.format_stats(stats), end='')
+
+    '''
+    coroutine to close all the connections to the servers
+    '''
+    async def close(self) -> None:
+        await self.pool.close()
+
     '''
     coroutine to asyncronously handle user query by sending and receiving data from multiple servers
 
@@ -67,52 +905,94 @@ class Client:
     '''
     async def handle_user_query(self, server_details, query: str, print_logs_to_console: bool = True) -> None:
 
-        # list to keep track of all server tasks
-        background_tasks = []
-        for hostname, port in server_details:
-            background_tasks.append(self.fetch_logs_from_server(hostname, port, query))
+        if query.strip() == Client.STATS_QUERY:
+            await self.print_server_stats(server_details)
+            return
+
+        try:
+            if SearchQuery.parse(query).follow:
+                await self.follow_user_query(server_details, query, print_logs_to_console)
+                return
+        except ValueError:
+            # invalid queries are reported by the servers
+            pass
+
+        if not print_logs_to_console:
+            query = Client.count_only_query(query)
+        query, deadline = self.apply_deadline(query)
+
+        # partial aggregates of the servers, merged once all of them responded
+        aggregates = []
+        # servers which stopped searching or did not answer before the deadline
+        partials = {}
 
         begin = time.time()
-        results = await asyncio.gather(*background_tasks, return_exceptions=True)
+        self.trace = ClientTrace()
+        if print_logs_to_console:
+            # matched lines of all the servers are printed merged by timestamp as they arrive
+            results = await self.print_merged_responses(server_details, query, aggregates, deadline, partials)
+        else:
+            # list to keep track of all server tasks, matched lines which are not printed are not kept
+            background_tasks = []
+            for hostname, port in server_details:
+                background_tasks.append(self.fetch_logs_from_server(hostname, port, query, aggregates, False,
+                                                                    deadline, partials))
+            results = await asyncio.gather(*background_tasks, return_exceptions=True)
         end = time.time()
+        trace, self.trace = self.trace, None
 
         if print_logs_to_console:
-            for i in range(len(background_tasks)):
+            for i in range(len(server_details)):
                 print(
-                    f'logs from server ({server_details[i][0]}:{server_details[i][1]}):')
+                    f'summary of server ({server_details[i][0]}:{server_details[i][1]}):')
                 print(f'{results[i][1]}')
 
         print('matched line count per server: ')
         total_matched_count = 0
-        for i in range(len(background_tasks)):
-            print(f'{server_details[i]}: {results[i][0]}')
+        for i in range(len(server_details)):
+            partial = partials.get(server_details[i])
+            print(f'{server_details[i]}: {results[i][0]}' + (f' (partial: {partial})' if partial else ''))
             total_matched_count += results[i][0]
 
-        print(f'Total matched line count for all server: {total_matched_count}')
+        partial = ' (partial)' if partials else ''
+        print(f'Total matched line count for all server: {total_matched_count}{partial}')
+        if aggregates:
+            print(Aggregation.format(Aggregation.merge(aggregates)), end='')
         # total time taken
         print(
             f"Total time taken to fetch all the logs from servers: {end - begin} seconds")
+        if self.trace_queries:
+            print(trace.format(), end='')
 
 
 '''
-function to read servers information from the config file
+function to read servers information from the config file. Every line is a server `hostname, port`, optionally
+followed by replicas holding a copy of its logs: `hostname, port | replica hostname, port | ...`. Returns the servers
+and the replicas of every server.
 
 @params filename: path to the config file
 '''
-def fetch_server_details_from_config_file(filename: str) -> List[Tuple[str, int]]:
+def fetch_server_details_from_config_file(filename: str) -> Tuple[List[Tuple[str, int]],
+                                                                 Dict[Tuple[str, int], List[Tuple[str, int]]]]:
     servers = []
+    replicas = {}
     try:
         with open(filename) as f:
             for line in f:
-                hostname, port = line.split(',')
-                hostname = hostname.strip()
-                port = port.strip()
-                servers.append((hostname, int(port)))
+                group = []
+                for replica in line.split('|'):
+                    hostname, port = replica.split(',')
+                    hostname = hostname.strip()
+                    port = port.strip()
+                    group.append((hostname, int(port)))
+                servers.append(group[0])
+                if len(group) > 1:
+                    replicas[group[0]] = group[1:]
     except Exception as e:
         print(f'failed to read server details from {filename}')
-        return []
+        return [], {}
 
-    return servers
+    return servers, replicas
 
 
 '''
@@ -128,11 +1008,20 @@ def process_cmd_line_args():
     servers_config_file = 'servers.conf'
     # This flag sets whether the matched lines will be printed to console or not
     logs_to_console = True
+    # bytes of matched lines held in memory per query before they are spilled to disk
+    max_result_memory = Client.MAX_RESULT_MEMORY
+    # seconds the servers search for a query without a timeout option before returning partial results, 0 for no limit
+    timeout = 0
+    # compression codecs offered to the servers, all the available ones by default
+    compression = None
+    # whether the timings of every query are printed
+    trace_queries = False
 
     # process command line options
     try:
         opts, args = getopt.getopt(sys.argv[1:], "c:h", [
-                                   "config=", "logsToConsole="])
+                                   "config=", "logsToConsole=", "maxResultMemory=", "timeout=", "compression=",
+                                   "trace="])
 
         for opt, arg in opts:
             if opt in ("-c", "--config"):
@@ -143,32 +1032,48 @@ def process_cmd_line_args():
                 elif arg == "False":
                     logs_to_console = False
                 else:
-                    print(
-                        "usage: python3 client.py --config='servers.conf' --logsToConsole=True/False")
+                    print("usage: python3 client.py --config='servers.conf' --logsToConsole=True/False "
+                          "--maxResultMemory=<MB> --timeout=<seconds> --compression=<codecs|none> --trace=True/False")
                     sys.exit(2)
+            elif opt == "--maxResultMemory":
+                max_result_memory = int(arg) * 1024 * 1024
+            elif opt == "--timeout":
+                timeout = int(arg)
+            elif opt == "--compression":
+                compression = Compression.parse_offer(arg)
+            elif opt == "--trace":
+                trace_queries = arg == "True"
             elif opt in ("-h"):
-                print(
-                    "usage: python3 client.py --config='servers.conf' --logsToConsole=True/False")
+                print("usage: python3 client.py --config='servers.conf' --logsToConsole=True/False "
+                      "--maxResultMemory=<MB> --timeout=<seconds> --compression=<codecs|none> --trace=True/False")
                 sys.exit()
         
-        return [servers_config_file, logs_to_console]
+        return [servers_config_file, logs_to_console, max_result_memory, timeout, compression, trace_queries]
 
-    except getopt.GetoptError:
-        print("usage: python3 client.py --config='servers.conf' --logsToConsole=True/False")
+    except (getopt.GetoptError, ValueError):
+        print("usage: python3 client.py --config='servers.conf' --logsToConsole=True/False --maxResultMemory=<MB> "
+              "--timeout=<seconds> --compression=<codecs|none> --trace=True/False")
         sys.exit(2)
 
 
 if __name__ == "__main__":
 
-    # Fetch config file path and logs_to_console flag from command line arguments
-    [servers_config_file, logs_to_console] = process_cmd_line_args()
+    # Fetch config file path, logs_to_console flag, memory ceiling, default timeout, compression codecs and trace flag
+    # from command line arguments
+    [servers_config_file, logs_to_console, max_result_memory, timeout, compression,
+     trace_queries] = process_cmd_line_args()
 
     # read servers details from servers.conf file
-    server_details = fetch_server_details_from_config_file(servers_config_file)
+    server_details, replicas = fetch_server_details_from_config_file(servers_config_file)
 
     # register for a signal handler to handle Ctrl + c
     signal.signal(signal.SIGINT, handler)
 
+    # single event loop and client for the whole session, so server connections are reused across queries
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    client = Client(max_result_memory, timeout, replicas, compression, trace_queries)
+
     while True:
 
         try:
@@ -185,19 +1090,22 @@ if __name__ == "__main__":
                 i = 0
                 for server_detail in server_details:
                     print(f'{i + 1}: {server_details[i]}')
+                    for replica in replicas.get(server_detail, []):
+                        print(f'   replica: {replica}')
                     i += 1
             
             elif option == 2:
                 query = str(
-                    input("Enter search query (Ex: 'search ['query1', 'query2]'): "))
+                    input("Enter search query (Ex: 'search ['query1', 'query2] "
+                          "[count | exists | limit N | head N | tail N] [follow]'): "))
                 print('fetching logs from all the servers ...')
 
                 # schedule tasks in asyncio event loop
-                client = Client()
-                asyncio.run(client.handle_user_query(
+                loop.run_until_complete(client.handle_user_query(
                     server_details, query, logs_to_console))
 
             elif option == 3:
+                loop.run_until_complete(client.close())
                 sys.exit()
             else:
                 print(f'invalid option {option}.')
@@ -0,0 +1,209 @@
+import base64
+import hashlib
+import math
+from collections import Counter
+from typing import Dict, Iterator, List, Optional, Tuple, final
+from field_query import LogRecord
+
+
+class HyperLogLog(object):
+
+    '''
+    HyperLogLog sketch estimating the number of distinct values in 2^PRECISION one byte registers (about 1.6%
+    standard error). Sketches built by different servers are merged by taking the maximum of every register.
+
+    @params registers: registers of an existing sketch, a new sketch starts empty
+    '''
+
+    PRECISION: final = 12
+
+    def __init__(self, registers: Optional[bytearray] = None) -> None:
+        self.registers = registers if registers is not None else bytearray(1 << HyperLogLog.PRECISION)
+
+    def add(self, value: bytes) -> None:
+        hashed = int.from_bytes(hashlib.blake2b(value, digest_size=8).digest(), 'big')
+        # first bits select the register, the position of the first set bit of the rest is its rank
+        bits = 64 - HyperLogLog.PRECISION
+        register = hashed >> bits
+        rank = bits - (hashed & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[register]:
+            self.registers[register] = rank
+
+    def merge(self, other: 'HyperLogLog') -> None:
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def estimate(self) -> int:
+        num_registers = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / num_registers)
+        estimate = alpha * num_registers * num_registers / sum(2.0 ** -rank for rank in self.registers)
+        empty = self.registers.count(0)
+        # small cardinalities are estimated from the number of empty registers (linear counting)
+        if estimate <= 2.5 * num_registers and empty:
+            estimate = num_registers * math.log(num_registers / empty)
+        return round(estimate)
+
+    def encode(self) -> str:
+        return base64.b64encode(self.registers).decode()
+
+    @staticmethod
+    def decode(text: str) -> 'HyperLogLog':
+        return HyperLogLog(bytearray(base64.b64decode(text)))
+
+
+class Aggregation(object):
+
+    '''
+    Aggregate of the matched lines computed by every server over its log files. Servers send their partial aggregate
+    in the summary and the client merges the partials of all the servers, so responses grow with the number of
+    groups rather than with the number of matched lines.
+
+    @params kind: KIND_COUNT to count the lines per group of field values, KIND_HISTOGRAM to count them per time
+                  bucket, KIND_TOP for the k most frequent values of a field, KIND_DISTINCT to estimate the number of
+                  distinct values of a field
+    @params fields: fields the lines are grouped by, the single field of top and distinct
+    @params k: number of values of a top aggregate
+    @params interval: seconds per histogram bucket, buckets of less than a day start at multiples of the interval
+                      since midnight
+    '''
+
+    KIND_COUNT: final = 'count'
+    KIND_HISTOGRAM: final = 'histogram'
+    KIND_TOP: final = 'top'
+    KIND_DISTINCT: final = 'distinct'
+
+    # groups sent by a server, the counts of the remaining smallest groups are sent as a single sum
+    MAX_GROUPS: final = 10000
+
+    # values sent per requested value of a top aggregate, so values ranked lower on some servers are still merged
+    TOP_OVERSAMPLE: final = 4
+
+    # distinct values remembered to avoid hashing them again
+    MAX_SEEN_VALUES: final = 65536
+
+    def __init__(self, kind: str, fields: List[str], k: int = 0, interval: int = 0) -> None:
+        for field in fields:
+            if field not in LogRecord.FIELDS:
+                raise ValueError(f'unknown field {field}, expected one of {", ".join(LogRecord.FIELDS)}')
+        self.kind = kind
+        self.fields = fields
+        self.k = k
+        self.interval = interval
+        self.counts = Counter()
+        self.sketch = HyperLogLog() if kind == Aggregation.KIND_DISTINCT else None
+        self.seen = set()
+        # histogram bucket of every time of day seen so far
+        self.buckets: Dict[bytes, bytes] = {}
+
+    '''
+    add the matched lines of blocks of matched lines to the aggregate, returns the number of lines added
+    '''
+    def add_blocks(self, blocks: Iterator[Tuple[int, bytes]]) -> int:
+        record = LogRecord()
+        num_lines = 0
+        if self.kind == Aggregation.KIND_HISTOGRAM:
+            add = self.add_histogram
+        elif self.kind == Aggregation.KIND_DISTINCT:
+            add = self.add_distinct
+        else:
+            add = self.add_count
+        try:
+            for count, lines in blocks:
+                num_lines += count
+                for line in lines[:-1].split(b'\n'):
+                    add(record.parse(line))
+        finally:
+            blocks.close()
+        return num_lines
+
+    def add_count(self, record: LogRecord) -> None:
+        if len(self.fields) == 1:
+            self.counts[getattr(record, self.fields[0])] += 1
+        else:
+            self.counts[b'\t'.join(getattr(record, field) for field in self.fields)] += 1
+
+    def add_histogram(self, record: LogRecord) -> None:
+        # lines without a timestamp (e.g. stack traces) belong to no bucket
+        if not record.date:
+            return
+        if self.interval >= 86400:
+            self.counts[record.date] += 1
+            return
+        bucket = self.buckets.get(record.time)
+        if bucket is None:
+            if len(record.time) != 6 or not record.time.isdigit():
+                return
+            seconds = int(record.time[:2]) * 3600 + int(record.time[2:4]) * 60 + int(record.time[4:])
+            seconds -= seconds % self.interval
+            bucket = b'%02d%02d%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+            self.buckets[record.time] = bucket
+        self.counts[record.date + b' ' + bucket] += 1
+
+    def add_distinct(self, record: LogRecord) -> None:
+        value = getattr(record, self.fields[0])
+        if value in self.seen:
+            return
+        if len(self.seen) >= Aggregation.MAX_SEEN_VALUES:
+            self.seen.clear()
+        self.seen.add(value)
+        self.sketch.add(value)
+
+    '''
+    partial aggregate of this server, sent to the client in the summary
+    '''
+    def partial(self) -> Dict:
+        partial = {'kind': self.kind, 'fields': self.fields, 'k': self.k, 'interval': self.interval}
+        if self.kind == Aggregation.KIND_DISTINCT:
+            partial['sketch'] = self.sketch.encode()
+            return partial
+        max_groups = Aggregation.MAX_GROUPS
+        if self.kind == Aggregation.KIND_TOP:
+            max_groups = self.k * Aggregation.TOP_OVERSAMPLE
+        groups = self.counts.most_common(max_groups) if len(self.counts) > max_groups else self.counts.items()
+        partial['groups'] = {key.decode(errors='backslashreplace'): count for key, count in groups}
+        partial['other'] = sum(self.counts.values()) - sum(partial['groups'].values())
+        return partial
+
+    '''
+    merge the partial aggregates of the servers of a query
+    '''
+    @staticmethod
+    def merge(partials: List[Dict]) -> Dict:
+        merged = dict(partials[0])
+        if merged['kind'] == Aggregation.KIND_DISTINCT:
+            sketch = HyperLogLog.decode(partials[0]['sketch'])
+            for partial in partials[1:]:
+                sketch.merge(HyperLogLog.decode(partial['sketch']))
+            merged['sketch'] = sketch.encode()
+            return merged
+        groups = Counter()
+        for partial in partials:
+            groups.update(partial['groups'])
+        merged['groups'] = groups
+        merged['other'] = sum(partial['other'] for partial in partials)
+        return merged
+
+    '''
+    text of a merged aggregate, one line per group
+    '''
+    @staticmethod
+    def format(merged: Dict) -> str:
+        fields = ','.join(merged['fields'])
+        if merged['kind'] == Aggregation.KIND_DISTINCT:
+            return f"distinct {fields}: ~{HyperLogLog.decode(merged['sketch']).estimate()}\n"
+
+        groups = merged['groups']
+        if merged['kind'] == Aggregation.KIND_HISTOGRAM:
+            lines = [f"histogram {merged['interval']}s:"]
+            lines += [f'{bucket}: {groups[bucket]}' for bucket in sorted(groups)]
+        elif merged['kind'] == Aggregation.KIND_TOP:
+            # values cut by a server may be missing from its counts
+            approximate = ' (approximate)' if merged['other'] else ''
+            lines = [f"top {merged['k']} {fields}{approximate}:"]
+            lines += [f'{value}: {count}' for value, count in groups.most_common(merged['k'])]
+            return '\n'.join(lines) + '\n'
+        else:
+            lines = [f'count by {fields}:']
+            lines += [f"{key.replace(chr(9), ' ')}: {count}" for key, count in groups.most_common()]
+        if merged['other']:
+            lines.append(f"other: {merged['other']}")
+        return '\n'.join(lines) + '\n'
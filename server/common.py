@@ -1,45 +1,38 @@
-from typing import List, Tuple, final
-import ast
+from typing import Optional, Tuple, final
+import os
 import sys
 import getopt
+from search_query import SearchQuery
 
 class Common(object):
 
     MAX_QUERY_SIZE: final = 5120
 
+    # bytes of matched lines batched into a single frame before it is sent to the client
+    RESPONSE_CHUNK_SIZE: final = 64 * 1024
+
+    # queries executed at the same time by a server
+    DEFAULT_MAX_QUERIES: final = 4
+
+    INVALID_QUERY_RESPONSE: final = b"invalid query: expected search ['<query string 1>', '<query string 2>'] " \
+                                    b"[count | exists | limit <n> | head <n> | tail <n>] " \
+                                    b"[count by <field>[,<field>] | histogram <n>s|m|h|d | top <k> <field> | " \
+                                    b"distinct <field>] " \
+                                    b"[from <YYMMDD HHMMSS>] [to <YYMMDD HHMMSS>] [last <n>s|m|h|d] " \
+                                    b"[timeout <n>s|m|h|d] " \
+                                    b"[follow] " \
+                                    b"[where <field>=|!=|~|<|>|<=|>=<value> [and|or|not ...]]"
+
     '''
-    function to prepare grep commands to get matched line count and actual matched lines from log files
+    function to parse search strings and query options from the user query
     '''
     @staticmethod
-    def prepare_grep_shell_cmds(query: str, logpath: str) -> Tuple[int, List[bytes]]:
-
-        query_prefix = "search "
-
-        if not query.startswith(query_prefix):
-            return (1, [str.encode("invalid query: expected search ['<query string 1>', '<query string 2>']")])
+    def parse_search_query(query: str) -> Tuple[int, Optional[SearchQuery]]:
 
         try:
-            search_strings = ast.literal_eval(query[len(query_prefix):])
-            cmds = []
-
-            # form query to get count of all the matched lines
-            cmd = "grep -E -c "
-            for search_string in search_strings:
-                cmd += f"-e '{search_string}' "
-            cmd += logpath
-            cmds.append(cmd.encode())
-
-            # form query to seach all the matched lines
-            cmd = "grep -E "
-            for search_string in search_strings:
-                cmd += f"-e '{search_string}' "
-            cmd += logpath
-            cmds.append(cmd.encode())
-
-            return (0, cmds)
-        except:
-            return (1, [str.encode("invalid query: expected search ['<query string 1>', '<query string 2>']")])
-
+            return (0, SearchQuery.parse(query))
+        except ValueError:
+            return (1, None)
 
     '''
     parse cmdline options for server
@@ -50,10 +43,30 @@ class Common(object):
         hostname = '127.0.0.1'
         port = 8000
         log_file = 'logs/machine.log'
+        # additional server settings
+        options = {
+            # directory to persist the token indexes of the log files to, empty to disable indexing
+            'index_dir': '.logindex',
+            # worker processes scanning large log files in parallel, 0 to scan in the server process
+            'scan_workers': os.cpu_count() or 1,
+            # queries executed at the same time, further queries wait for their turn
+            'max_queries': Common.DEFAULT_MAX_QUERIES,
+            # memory budget in bytes for cached query results, 0 to disable caching
+            'cache_size': 128 * 1024 * 1024,
+            # directory to write columnar segments of the log files to for field queries, empty to disable them
+            'segment_dir': '',
+            # seconds concurrent full scans of the same log file are coalesced into a single scan, 0 to disable
+            'coalesce_window': 0,
+            # level of the server log, warning or error keep the messages of every connection and query off the log
+            'log_level': 'info',
+            # worker processes serving the port, 1 to serve in the server process
+            'workers': 1,
+        }
 
         try:
             opts, args = getopt.getopt(arguments, "h:p:l:", [
-                "hostname=", "port=", "help=", "logfile="])
+                "hostname=", "port=", "help=", "logfile=", "indexdir=", "scanworkers=", "maxqueries=", "cachesize=",
+                "segmentdir=", "coalescewindow=", "loglevel=", "workers="])
 
             for opt, arg in opts:
                 if opt == '--help':
@@ -65,9 +78,27 @@ class Common(object):
                     port = int(arg)
                 elif opt in ("-l", "--logfile"):
                     log_file = arg
+                elif opt == "--indexdir":
+                    options['index_dir'] = arg
+                elif opt == "--scanworkers":
+                    options['scan_workers'] = int(arg)
+                elif opt == "--maxqueries":
+                    options['max_queries'] = max(1, int(arg))
+                elif opt == "--cachesize":
+                    # budget is given in MB
+                    options['cache_size'] = int(arg) * 1024 * 1024
+                elif opt == "--segmentdir":
+                    options['segment_dir'] = arg
+                elif opt == "--coalescewindow":
+                    # window is given in milliseconds
+                    options['coalesce_window'] = int(arg) / 1000
+                elif opt == "--loglevel":
+                    options['log_level'] = arg
+                elif opt == "--workers":
+                    options['workers'] = max(1, int(arg))
 
         except getopt.GetoptError:
             print('server.py -h <hostname> -p <port>')
             sys.exit(2)
         
-        return hostname, port, log_file
+        return hostname, port, log_file, options
@@ -0,0 +1,295 @@
+import bisect
+import itertools
+import os
+import zlib
+from collections import deque
+from concurrent.futures import Executor
+from typing import Iterator, List, Optional, Tuple, final
+from search_engine import SearchEngine
+from time_index import TimeIndex
+
+try:
+    import zstandard
+except ImportError:  # zstd compressed logs are not searchable without the zstandard package
+    zstandard = None
+
+
+class Checkpoint(object):
+
+    '''
+    Point of a compressed log file decompression can resume from
+
+    @params offset: offset in the decompressed data
+    @params compressed_offset: offset in the compressed file to continue reading at
+    @params state: snapshot of the decompressor at this point, None to start a fresh decompressor
+    @params line_offset: offset of the first line starting at or after `offset` in the decompressed data
+    @params timestamp: timestamp of the line at `line_offset`, None if unknown
+    '''
+
+    __slots__ = ('offset', 'compressed_offset', 'state', 'line_offset', 'timestamp')
+
+    def __init__(self, offset: int, compressed_offset: int, state, line_offset: Optional[int],
+                 timestamp: Optional[bytes] = None) -> None:
+        self.offset = offset
+        self.compressed_offset = compressed_offset
+        self.state = state
+        self.line_offset = line_offset
+        self.timestamp = timestamp
+
+
+class CompressedLog(object):
+
+    '''
+    Seekable view of a gzip or zstd compressed (rotated) log file. The first full pass over the file records a
+    checkpoint about every CHECKPOINT_INTERVAL bytes of decompressed data, later searches split the file into
+    line aligned blocks between the checkpoints which are decompressed independently, in parallel, and blocks
+    without candidate lines or outside the time window of a query are not decompressed at all.
+
+    gzip checkpoints keep a snapshot of the zlib decompressor, so they live in memory only. zstd files are
+    decompressed as a single stream, decompressors of the zstandard package cannot be snapshotted.
+
+    @params path: path to the compressed log file
+    @params stat: stat of the compressed log file when it was opened
+    '''
+
+    GZIP_MAGIC: final = b'\x1f\x8b'
+    ZSTD_MAGIC: final = b'\x28\xb5\x2f\xfd'
+
+    # decompressed bytes between two checkpoints, the unit of parallel decompression
+    CHECKPOINT_INTERVAL: final = 4 * 1024 * 1024
+
+    # compressed bytes read at once
+    READ_SIZE: final = 256 * 1024
+
+    def __init__(self, path: str, stat: os.stat_result) -> None:
+        self.path = path
+        self.inode = stat.st_ino
+        self.file_size = stat.st_size
+        self.mtime = stat.st_mtime_ns
+        self.format = CompressedLog.detect_format(path)
+        # known once a full pass over the file completed
+        self.checkpoints: Optional[List[Checkpoint]] = None
+        self.size: Optional[int] = None
+
+    '''
+    compression format of a log file from its magic bytes, None for plain (or unreadable) files
+    '''
+    @staticmethod
+    def detect_format(path: str) -> Optional[str]:
+        try:
+            with open(path, 'rb') as f:
+                magic = f.read(4)
+        except OSError:
+            return None
+        if magic.startswith(CompressedLog.GZIP_MAGIC):
+            return 'gzip'
+        if magic == CompressedLog.ZSTD_MAGIC:
+            return 'zstd'
+        return None
+
+    '''
+    whether the file is still the one this view was created for
+    '''
+    def is_current(self, stat: os.stat_result) -> bool:
+        return self.inode == stat.st_ino and self.file_size == stat.st_size and self.mtime == stat.st_mtime_ns
+
+    '''
+    generator decompressing a gzip file from a checkpoint, yields every piece of decompressed data together with
+    the compressed offset reached and the decompressor which continues from there
+    '''
+    def iter_gzip(self, checkpoint: Checkpoint) -> Iterator[Tuple[bytes, int, object]]:
+        decompressor = checkpoint.state.copy() if checkpoint.state is not None else zlib.decompressobj(31)
+        compressed_offset = checkpoint.compressed_offset
+        with open(self.path, 'rb') as f:
+            f.seek(compressed_offset)
+            while True:
+                chunk = f.read(CompressedLog.READ_SIZE)
+                if not chunk:
+                    break
+                compressed_offset += len(chunk)
+                pieces = []
+                while chunk:
+                    pieces.append(decompressor.decompress(chunk))
+                    if not decompressor.eof:
+                        break
+                    # next member of a multi member file (e.g. written by pigz or concatenated rotations),
+                    # zero padding after the last member is ignored
+                    chunk = decompressor.unused_data.lstrip(b'\0')
+                    decompressor = zlib.decompressobj(31)
+                yield b''.join(pieces), compressed_offset, decompressor
+
+    '''
+    generator decompressing a zstd file from its beginning, across all its frames
+    '''
+    def iter_zstd(self) -> Iterator[Tuple[bytes, None, None]]:
+        if zstandard is None:
+            raise OSError(f'{self.path} is zstd compressed, install the zstandard package to search it')
+        with open(self.path, 'rb') as f:
+            reader = zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True)
+            while True:
+                data = reader.read(CompressedLog.READ_SIZE)
+                if not data:
+                    break
+                yield data, None, None
+
+    def iter_decompressed(self, checkpoint: Checkpoint) -> Iterator[Tuple[bytes, Optional[int], object]]:
+        if self.format == 'gzip':
+            return self.iter_gzip(checkpoint)
+        return self.iter_zstd()
+
+    '''
+    generator decompressing the whole file and yielding its data in pieces of complete lines (only the last line of
+    the file may lack its newline). checkpoints are recorded on the way and kept once the pass completes.
+    '''
+    def iter_chunks(self) -> Iterator[bytes]:
+        checkpoints = [Checkpoint(0, 0, None, 0)]
+        # checkpoint waiting for the first line starting after it
+        waiting = None
+        # next checkpoint waiting for the timestamp of its first line
+        next_timestamp = 0
+        offset = 0
+        # decompressed bytes yielded so far
+        yielded = 0
+        partial_line = b''
+        for data, compressed_offset, decompressor in self.iter_decompressed(checkpoints[0]):
+            if waiting is not None:
+                newline = data.find(b'\n')
+                if newline >= 0:
+                    waiting.line_offset = offset + newline + 1
+                    waiting = None
+            offset += len(data)
+            if compressed_offset is not None and waiting is None and \
+                    offset >= checkpoints[-1].offset + CompressedLog.CHECKPOINT_INTERVAL:
+                line_start = data.endswith(b'\n')
+                checkpoint = Checkpoint(offset, compressed_offset, decompressor.copy(), offset if line_start else None)
+                checkpoints.append(checkpoint)
+                if not line_start:
+                    waiting = checkpoint
+
+            data = partial_line + data
+            end = data.rfind(b'\n') + 1
+            partial_line = data[end:]
+            if end == 0:
+                continue
+            while next_timestamp < len(checkpoints) and checkpoints[next_timestamp].line_offset is not None and \
+                    checkpoints[next_timestamp].line_offset < yielded + end:
+                checkpoint = checkpoints[next_timestamp]
+                checkpoint.timestamp = TimeIndex.line_timestamp(data, checkpoint.line_offset - yielded)
+                next_timestamp += 1
+            yield data[:end]
+            yielded += end
+
+        if partial_line:
+            yield partial_line
+        # no line starts after the last checkpoint
+        if waiting is not None or (len(checkpoints) > 1 and checkpoints[-1].line_offset == offset):
+            checkpoints.pop()
+        self.checkpoints = checkpoints
+        self.size = offset
+
+    '''
+    decompressed byte range (start, end) of the lines of a block
+    '''
+    def block_range(self, block: int) -> Tuple[int, int]:
+        end = self.checkpoints[block + 1].line_offset if block + 1 < len(self.checkpoints) else self.size
+        return self.checkpoints[block].line_offset, end
+
+    '''
+    decompress the lines of a single block, starting from its checkpoint
+    '''
+    def read_block(self, block: int) -> bytes:
+        checkpoint = self.checkpoints[block]
+        start, end = self.block_range(block)
+        pieces = []
+        offset = checkpoint.offset
+        source = self.iter_decompressed(checkpoint)
+        try:
+            for data, _, _ in source:
+                pieces.append(data)
+                offset += len(data)
+                if offset >= end:
+                    break
+        finally:
+            source.close()
+        return b''.join(pieces)[start - checkpoint.offset:end - checkpoint.offset]
+
+    '''
+    generator yielding blocks of matched lines of the file in file order
+
+    @params engine: engine of the query
+    @params block_size: size of the blocks matched lines are grouped into
+    @params executor: thread pool decompressing blocks in parallel (zlib releases the GIL), blocks are decompressed
+                      one after the other without it
+    @params window: blocks decompressed ahead of the one being searched
+    @params spans: sorted (start, end) decompressed byte ranges of the only lines to search, e.g. selected by an index
+    @params time_from: earliest timestamp of the lines to search, blocks ending before it are skipped
+    @params time_to: latest timestamp of the lines to search, blocks starting after it are skipped
+    '''
+    def iter_file_blocks(self, engine: SearchEngine, block_size: int, executor: Optional[Executor] = None,
+                         window: int = 1, spans: Optional[List[Tuple[int, int]]] = None,
+                         time_from: Optional[bytes] = None,
+                         time_to: Optional[bytes] = None) -> Iterator[Tuple[int, bytes]]:
+        if self.checkpoints is None:
+            # the first search of the file decompresses it sequentially and records its checkpoints on the way,
+            # a search which stopped early records none
+            chunks = itertools.takewhile(lambda _: not engine.should_stop(), self.iter_chunks())
+            yield from SearchEngine.group_blocks(itertools.chain.from_iterable(
+                engine.scan(data, 0, len(data)) for data in chunks), block_size)
+            return
+
+        # blocks to decompress and the ranges of each to search
+        blocks = []
+        if spans is None:
+            for block in range(len(self.checkpoints)):
+                start, end = self.block_range(block)
+                blocks.append((block, [(0, end - start)]))
+        else:
+            block_starts = [checkpoint.line_offset for checkpoint in self.checkpoints]
+            for span_start, span_end in spans:
+                block = bisect.bisect_right(block_starts, span_start) - 1
+                base = block_starts[block]
+                if not blocks or blocks[-1][0] != block:
+                    blocks.append((block, []))
+                blocks[-1][1].append((span_start - base, span_end - base))
+        blocks = [(block, ranges) for block, ranges in blocks if self.block_in_window(block, time_from, time_to)]
+
+        yield from SearchEngine.group_blocks(self.iter_block_matches(engine, blocks, executor, window), block_size)
+
+    '''
+    whether a block may hold lines of a time window, judging by the timestamps of its first line and the next block's
+    '''
+    def block_in_window(self, block: int, time_from: Optional[bytes], time_to: Optional[bytes]) -> bool:
+        first = self.checkpoints[block].timestamp
+        if time_to is not None and first is not None and first > time_to:
+            return False
+        following = self.checkpoints[block + 1].timestamp if block + 1 < len(self.checkpoints) else None
+        return time_from is None or following is None or following >= time_from
+
+    def iter_block_matches(self, engine: SearchEngine, blocks: List[Tuple[int, List[Tuple[int, int]]]],
+                           executor: Optional[Executor], window: int) -> Iterator[bytes]:
+        pending = deque()
+        try:
+            for block, ranges in blocks:
+                if engine.should_stop():
+                    break
+                if executor is None:
+                    data = self.read_block(block)
+                    for start, end in ranges:
+                        yield from engine.scan(data, start, end)
+                    continue
+                # bound the blocks decompressed ahead so they do not pile up in memory
+                if len(pending) >= window:
+                    yield from self.scan_block(engine, *pending.popleft())
+                pending.append((executor.submit(self.read_block, block), ranges))
+            while pending and not engine.should_stop():
+                yield from self.scan_block(engine, *pending.popleft())
+        finally:
+            # query was abandoned or stopped early
+            for future, _ in pending:
+                future.cancel()
+
+    @staticmethod
+    def scan_block(engine: SearchEngine, future, ranges: List[Tuple[int, int]]) -> Iterator[bytes]:
+        data = future.result()
+        for start, end in ranges:
+            yield from engine.scan(data, start, end)
@@ -0,0 +1,143 @@
+import abc
+import zlib
+from typing import List, Optional, final
+
+try:
+    import lz4.frame
+except ImportError:  # lz4 is not negotiated without the lz4 package
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:  # zstd is not negotiated without the zstandard package
+    zstandard = None
+
+
+class Codec(abc.ABC):
+
+    '''
+    Compression codec of the frame payloads sent on a connection. Every payload is compressed on its own, so frames
+    can be compressed by any thread as they are produced and in any order.
+
+    @params name: name the codec is negotiated with
+    '''
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    @abc.abstractmethod
+    def compress(self, data: bytes) -> bytes:
+        pass
+
+    '''
+    decompress a payload, raises ValueError if it is corrupt or decompresses to more than max_size bytes
+    '''
+    @abc.abstractmethod
+    def decompress(self, data: bytes, max_size: int) -> bytes:
+        pass
+
+
+class ZlibCodec(Codec):
+
+    # fastest level, matched log lines are repetitive enough to shrink several times anyway
+    LEVEL: final = 1
+
+    def __init__(self) -> None:
+        super().__init__('zlib')
+
+    def compress(self, data: bytes) -> bytes:
+        return zlib.compress(data, ZlibCodec.LEVEL)
+
+    def decompress(self, data: bytes, max_size: int) -> bytes:
+        decompressor = zlib.decompressobj()
+        try:
+            payload = decompressor.decompress(data, max_size)
+        except zlib.error as e:
+            raise ValueError(str(e))
+        if decompressor.unconsumed_tail or not decompressor.eof:
+            raise ValueError('corrupt or oversized payload')
+        return payload
+
+
+class Lz4Codec(Codec):
+
+    def __init__(self) -> None:
+        super().__init__('lz4')
+
+    def compress(self, data: bytes) -> bytes:
+        return lz4.frame.compress(data)
+
+    def decompress(self, data: bytes, max_size: int) -> bytes:
+        decompressor = lz4.frame.LZ4FrameDecompressor()
+        try:
+            # the size declared by the frame is checked before anything is decompressed, a frame without a declared
+            # size is decompressed up to max_size bytes
+            if lz4.frame.get_frame_info(data)['content_size'] > max_size:
+                raise ValueError('oversized payload')
+            payload = decompressor.decompress(data, max_size)
+        except RuntimeError as e:
+            raise ValueError(str(e))
+        if not decompressor.eof:
+            raise ValueError('corrupt or oversized payload')
+        return payload
+
+
+class ZstdCodec(Codec):
+
+    LEVEL: final = 3
+
+    def __init__(self) -> None:
+        super().__init__('zstd')
+
+    def compress(self, data: bytes) -> bytes:
+        # compressor objects must not be shared by threads
+        return zstandard.ZstdCompressor(level=ZstdCodec.LEVEL).compress(data)
+
+    def decompress(self, data: bytes, max_size: int) -> bytes:
+        try:
+            return zstandard.ZstdDecompressor().decompress(data, max_output_size=max_size)
+        except zstandard.ZstdError as e:
+            raise ValueError(str(e))
+
+
+class Compression(object):
+
+    '''
+    Codecs a client and a server can negotiate for a connection. The client offers the codecs it supports in order of
+    preference, the server picks the first one it supports too.
+    '''
+
+    # payloads smaller than this are always sent raw, they hardly shrink and are not worth the time
+    MIN_COMPRESS_SIZE: final = 1024
+
+    # codecs supported by this process, in order of preference
+    CODECS: final = {codec.name: codec for codec in (ZstdCodec() if zstandard is not None else None,
+                                                     Lz4Codec() if lz4 is not None else None,
+                                                     ZlibCodec()) if codec is not None}
+
+    @staticmethod
+    def available() -> List[str]:
+        return list(Compression.CODECS)
+
+    '''
+    pick the codec of a connection from the comma separated codec names offered by the client, None to send raw
+    '''
+    @staticmethod
+    def negotiate(offer: str) -> Optional[Codec]:
+        for name in offer.split(','):
+            codec = Compression.CODECS.get(name.strip().lower())
+            if codec is not None:
+                return codec
+        return None
+
+    @staticmethod
+    def get(name: str) -> Optional[Codec]:
+        return Compression.CODECS.get(name)
+
+    '''
+    parse a comma separated list of codec names, e.g. from the command line, 'none' for no compression
+    '''
+    @staticmethod
+    def parse_offer(text: str) -> List[str]:
+        names = [name.strip().lower() for name in text.split(',') if name.strip()]
+        return [name for name in names if name != 'none']
@@ -0,0 +1,293 @@
+import abc
+import re
+from typing import Iterator, List, Optional, Tuple, final
+
+
+class LogRecord(object):
+
+    '''
+    Fields of a parsed HDFS log line: `081109 203615 148 INFO dfs.DataNode$PacketResponder: PacketResponder 1 ...`.
+    A single record is reused for all the lines of a search, so filtering does not allocate an object per line.
+    '''
+
+    __slots__ = ('date', 'time', 'pid', 'level', 'component', 'message')
+
+    FIELDS: final = __slots__
+
+    def __init__(self) -> None:
+        self.parse(b'')
+
+    '''
+    split a line into its fields, lines which do not have all the fields (e.g. stack traces) only have a message
+    '''
+    def parse(self, line: bytes) -> 'LogRecord':
+        parts = line.split(b' ', 4)
+        if len(parts) < 5:
+            self.date = self.time = self.pid = self.level = self.component = b''
+            self.message = line
+            return self
+        self.date, self.time, self.pid, self.level, rest = parts
+        self.component, separator, self.message = rest.partition(b': ')
+        if not separator:
+            self.component = b''
+            self.message = rest
+        return self
+
+
+class Condition(abc.ABC):
+
+    '''
+    Node of a parsed field query, evaluated against a parsed log record
+    '''
+
+    # relative cost of evaluating the condition, cheaper conditions are evaluated first
+    cost = 1
+
+    @abc.abstractmethod
+    def matches(self, record: LogRecord) -> bool:
+        pass
+
+    '''
+    plan the evaluation order of the condition and its children
+    '''
+    def plan(self) -> 'Condition':
+        return self
+
+    '''
+    literal contained by every line matching the condition, empty if there is none
+    '''
+    def required_literal(self) -> str:
+        return ''
+
+
+class FieldCondition(Condition):
+
+    '''
+    Comparison of a single field with a value
+
+    @params field: one of LogRecord.FIELDS
+    @params operator: =, !=, ~ (regex search), <, <=, > or >=
+    @params value: value to compare the field with, a regex for ~
+    '''
+
+    OPERATORS: final = ('=', '!=', '~', '<', '<=', '>', '>=')
+
+    def __init__(self, field: str, operator: str, value: str) -> None:
+        if field not in LogRecord.FIELDS:
+            raise ValueError(f'unknown field {field}, expected one of {", ".join(LogRecord.FIELDS)}')
+        self.field = field
+        self.operator = operator
+        self.value = value
+        self.encoded = value.encode()
+        self.regex = None
+        self.number = None
+        if operator == '~':
+            try:
+                self.regex = re.compile(self.encoded)
+            except re.error as e:
+                raise ValueError(f'invalid regex {value}: {e}')
+            # fields near the start of the line are short, the message is searched last
+            self.cost = 20 if field == 'message' else 10
+        elif field == 'pid' and operator not in ('=', '!='):
+            if not value.isdigit():
+                raise ValueError(f'pid must be compared with a number, got {value}')
+            self.number = int(value)
+            self.cost = 2
+        elif field in ('component', 'message'):
+            self.cost = 2 if field == 'component' else 5
+
+    def matches(self, record: LogRecord) -> bool:
+        return self.matches_value(getattr(record, self.field))
+
+    '''
+    whether a value of the field satisfies the condition
+    '''
+    def matches_value(self, field: bytes) -> bool:
+        operator = self.operator
+        if operator == '=':
+            return field == self.encoded
+        if operator == '!=':
+            return field != self.encoded
+        if operator == '~':
+            return self.regex.search(field) is not None
+        if self.number is not None:
+            if not field.isdigit():
+                return False
+            field = int(field)
+            value = self.number
+        else:
+            value = self.encoded
+        if operator == '<':
+            return field < value
+        if operator == '<=':
+            return field <= value
+        if operator == '>':
+            return field > value
+        return field >= value
+
+    def required_literal(self) -> str:
+        if self.operator == '=':
+            return self.value
+        if self.operator == '~':
+            # imported here, the search engine is not needed to evaluate conditions in other processes
+            from search_engine import SearchEngine
+            return SearchEngine.required_literal(self.value).decode()
+        return ''
+
+
+class NotCondition(Condition):
+
+    def __init__(self, condition: Condition) -> None:
+        self.condition = condition
+
+    def matches(self, record: LogRecord) -> bool:
+        return not self.condition.matches(record)
+
+    def plan(self) -> Condition:
+        self.condition = self.condition.plan()
+        self.cost = self.condition.cost
+        return self
+
+
+class AndCondition(Condition):
+
+    def __init__(self, conditions: List[Condition]) -> None:
+        self.conditions = conditions
+
+    def matches(self, record: LogRecord) -> bool:
+        for condition in self.conditions:
+            if not condition.matches(record):
+                return False
+        return True
+
+    def plan(self) -> Condition:
+        # cheapest conditions first, evaluation stops at the first one which fails
+        self.conditions = sorted((condition.plan() for condition in self.conditions), key=lambda c: c.cost)
+        self.cost = sum(condition.cost for condition in self.conditions)
+        return self
+
+    def required_literal(self) -> str:
+        # every condition must match, the longest literal of any of them is the most selective
+        return max((condition.required_literal() for condition in self.conditions), key=len, default='')
+
+
+class OrCondition(Condition):
+
+    def __init__(self, conditions: List[Condition]) -> None:
+        self.conditions = conditions
+
+    def matches(self, record: LogRecord) -> bool:
+        for condition in self.conditions:
+            if condition.matches(record):
+                return True
+        return False
+
+    def plan(self) -> Condition:
+        # cheapest conditions first, evaluation stops at the first one which matches
+        self.conditions = sorted((condition.plan() for condition in self.conditions), key=lambda c: c.cost)
+        self.cost = sum(condition.cost for condition in self.conditions)
+        return self
+
+
+class FieldQuery(object):
+
+    '''
+    Structured query over the fields of the log lines, e.g. `level=WARN and component=dfs.DataNode$DataXceiver`,
+    `not (level=INFO or pid>=1000) and message~'Got exception'`. Values containing spaces or operators are quoted.
+    Conditions are combined with and, or, not and parentheses (not binds tightest, then and, then or).
+
+    @params text: text of the query
+    '''
+
+    TOKEN_REGEX: final = re.compile(r'''\s*(?:(?P<paren>[()])|(?P<operator>!=|<=|>=|=|~|<|>)|'''
+                                    r'''(?P<quoted>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")|(?P<word>[^\s()=!~<>'"]+))''')
+
+    def __init__(self, text: str) -> None:
+        self.text = text
+        self.tokens = FieldQuery.tokenize(text)
+        self.position = 0
+        condition = self.parse_or()
+        if self.position < len(self.tokens):
+            raise ValueError(f'unexpected {self.tokens[self.position][1]} in field query')
+        self.condition = condition.plan()
+
+    '''
+    split the text of a query into (kind, value) tokens
+    '''
+    @staticmethod
+    def tokenize(text: str) -> List[Tuple[str, str]]:
+        tokens = []
+        position = 0
+        text = text.strip()
+        while position < len(text):
+            match = FieldQuery.TOKEN_REGEX.match(text, position)
+            if match is None or match.end() == position:
+                raise ValueError(f'invalid field query at {text[position:]}')
+            kind = match.lastgroup
+            value = match.group(kind)
+            if kind == 'quoted':
+                value = re.sub(r'\\(.)', r'\1', value[1:-1])
+                kind = 'word'
+            elif kind == 'word' and value.lower() in ('and', 'or', 'not'):
+                kind = value.lower()
+            tokens.append((kind, value))
+            position = match.end()
+        return tokens
+
+    def peek(self) -> Optional[str]:
+        return self.tokens[self.position][0] if self.position < len(self.tokens) else None
+
+    def expect(self, kind: str) -> str:
+        if self.peek() != kind:
+            found = self.tokens[self.position][1] if self.position < len(self.tokens) else 'end of query'
+            raise ValueError(f'expected {kind} but found {found} in field query')
+        self.position += 1
+        return self.tokens[self.position - 1][1]
+
+    def parse_or(self) -> Condition:
+        conditions = [self.parse_and()]
+        while self.peek() == 'or':
+            self.position += 1
+            conditions.append(self.parse_and())
+        return conditions[0] if len(conditions) == 1 else OrCondition(conditions)
+
+    def parse_and(self) -> Condition:
+        conditions = [self.parse_not()]
+        while self.peek() == 'and':
+            self.position += 1
+            conditions.append(self.parse_not())
+        return conditions[0] if len(conditions) == 1 else AndCondition(conditions)
+
+    def parse_not(self) -> Condition:
+        if self.peek() == 'not':
+            self.position += 1
+            return NotCondition(self.parse_not())
+        if self.peek() == 'paren' and self.tokens[self.position][1] == '(':
+            self.position += 1
+            condition = self.parse_or()
+            if self.expect('paren') != ')':
+                raise ValueError('expected ) in field query')
+            return condition
+        field = self.expect('word')
+        operator = self.expect('operator')
+        return FieldCondition(field.lower(), operator, self.expect('word'))
+
+    '''
+    literal contained by every line matching the query, used to find the candidate lines without parsing every line
+    '''
+    def required_literal(self) -> str:
+        return self.condition.required_literal()
+
+    '''
+    generator dropping the matched lines whose fields do not match the query from blocks of matched lines
+    '''
+    def filter_blocks(self, blocks: Iterator[Tuple[int, bytes]]) -> Iterator[Tuple[int, bytes]]:
+        record = LogRecord()
+        matches = self.condition.matches
+        try:
+            for _, lines in blocks:
+                kept = [line for line in lines[:-1].split(b'\n') if matches(record.parse(line))]
+                if kept:
+                    yield len(kept), b'\n'.join(kept) + b'\n'
+        finally:
+            blocks.close()
@@ -0,0 +1,172 @@
+import os
+import threading
+import time
+from typing import Dict, Hashable, Iterator, List, Optional, Tuple, final
+from common import Common
+from compressed_log import CompressedLog
+from protocol import Protocol
+from search_engine import SearchEngine
+from search_query import SearchQuery
+from time_index import TimeIndex
+
+
+class Subscription(object):
+
+    '''
+    Follow query of a client receiving the matched lines appended to the log files
+
+    @params subscriber: identity of the client connection the matches are pushed to
+    @params request_id: request id of the follow query
+    @params engine: engine of the query
+    @params search_query: parsed follow query
+    '''
+
+    __slots__ = ('subscriber', 'request_id', 'engine', 'search_query', 'counts', 'begin')
+
+    def __init__(self, subscriber: Hashable, request_id: int, engine: SearchEngine, search_query: SearchQuery) -> None:
+        self.subscriber = subscriber
+        self.request_id = request_id
+        self.engine = engine
+        self.search_query = search_query
+        # lines pushed per log file
+        self.counts: Dict[str, int] = {}
+        self.begin = time.time()
+
+    '''
+    SUMMARY frame ending the response of the subscription
+    '''
+    def summary_frame(self) -> bytes:
+        return Protocol.encode_summary(self.request_id, {
+            'files': [{'file': os.path.basename(log_file), 'count': count} for log_file, count in self.counts.items()],
+            'bytes_scanned': self.engine.bytes_scanned,
+            'elapsed': time.time() - self.begin,
+        })
+
+
+class LogFollower(object):
+
+    '''
+    Watches the log files of a server for appended data by polling their sizes and offsets. Every poll reads the
+    complete lines appended since the previous poll once and searches them for all the subscriptions, so following
+    costs in proportion to the rate the logs are written at, not to their size. Subscriptions start at the end of the
+    log files, log files created or rotated while following are read from their beginning.
+
+    @params logpath: log file, directory or glob pattern served by the server
+    '''
+
+    # seconds between two polls of the log files
+    POLL_INTERVAL: final = 0.5
+
+    # appended bytes read from a log file per poll at most, the rest is read by the next polls
+    MAX_POLL_SIZE: final = 8 * 1024 * 1024
+
+    def __init__(self, logpath: str) -> None:
+        self.logpath = logpath
+        # guards the subscriptions and the positions, which are changed by the server while polls run in executor
+        # threads
+        self.lock = threading.Lock()
+        self.subscriptions: Dict[Tuple[Hashable, int], Subscription] = {}
+        # inode and offset of the next line to read of every followed log file
+        self.positions: Dict[str, Tuple[int, int]] = {}
+
+    def has_subscriptions(self) -> bool:
+        return bool(self.subscriptions)
+
+    '''
+    start pushing the lines matching a follow query appended from now on
+    '''
+    def subscribe(self, subscriber: Hashable, request_id: int, engine: SearchEngine,
+                  search_query: SearchQuery) -> None:
+        with self.lock:
+            if not self.subscriptions:
+                # positions are not kept up to date while nobody follows
+                self.positions = {log_file: self.end_position(log_file)
+                                  for log_file in SearchEngine.resolve_log_files(self.logpath)}
+            self.subscriptions[(subscriber, request_id)] = Subscription(subscriber, request_id, engine, search_query)
+
+    '''
+    stop a subscription, returns the SUMMARY frame ending its response or None if there is no such subscription
+    '''
+    def cancel(self, subscriber: Hashable, request_id: int) -> Optional[bytes]:
+        with self.lock:
+            subscription = self.subscriptions.pop((subscriber, request_id), None)
+        return subscription.summary_frame() if subscription is not None else None
+
+    '''
+    drop all the subscriptions of a closed connection
+    '''
+    def unsubscribe_all(self, subscriber: Hashable) -> None:
+        with self.lock:
+            for key in [key for key in self.subscriptions if key[0] == subscriber]:
+                del self.subscriptions[key]
+
+    @staticmethod
+    def end_position(log_file: str) -> Tuple[int, int]:
+        try:
+            stat = os.stat(log_file)
+        except OSError:
+            return 0, 0
+        return stat.st_ino, stat.st_size
+
+    '''
+    read the appended data of all the log files and search it for all the subscriptions, returns the frames to push
+    as (subscriber, frame) pairs
+    '''
+    def poll(self) -> List[Tuple[Hashable, bytes]]:
+        with self.lock:
+            subscriptions = list(self.subscriptions.values())
+        if not subscriptions:
+            return []
+
+        log_files = SearchEngine.resolve_log_files(self.logpath)
+        frames = []
+        for log_file in log_files:
+            data = self.read_appended(log_file)
+            if not data:
+                continue
+            # prefix matched lines with the file path when following multiple files
+            prefix = log_file.encode() + b':' if len(log_files) > 1 else b''
+            for subscription in subscriptions:
+                for num_lines, lines in self.search_appended(subscription, data):
+                    subscription.counts[log_file] = subscription.counts.get(log_file, 0) + num_lines
+                    if prefix:
+                        lines = prefix + lines[:-1].replace(b'\n', b'\n' + prefix) + b'\n'
+                    frames.append((subscription.subscriber,
+                                   Protocol.encode_batch(subscription.request_id, num_lines, lines)))
+        return frames
+
+    '''
+    complete lines appended to a log file since the previous poll
+    '''
+    def read_appended(self, log_file: str) -> bytes:
+        if CompressedLog.detect_format(log_file) is not None:
+            return b''
+        try:
+            with open(log_file, 'rb') as f:
+                stat = os.fstat(f.fileno())
+                with self.lock:
+                    inode, offset = self.positions.get(log_file, (stat.st_ino, 0))
+                # log file was rotated or truncated: follow the new file from its beginning
+                if inode != stat.st_ino or stat.st_size < offset:
+                    offset = 0
+                f.seek(offset)
+                data = f.read(min(stat.st_size - offset, LogFollower.MAX_POLL_SIZE))
+        except OSError:
+            return b''
+        # a partially written last line is read by a later poll
+        end = data.rfind(b'\n') + 1
+        with self.lock:
+            self.positions[log_file] = (stat.st_ino, offset + end)
+        return data[:end]
+
+    @staticmethod
+    def search_appended(subscription: Subscription, data: bytes) -> Iterator[Tuple[int, bytes]]:
+        search_query = subscription.search_query
+        blocks = SearchEngine.group_blocks(subscription.engine.scan(data, 0, len(data)), Common.RESPONSE_CHUNK_SIZE)
+        if search_query.has_time_window():
+            time_from = search_query.time_from.encode() if search_query.time_from is not None else None
+            time_to = search_query.time_to.encode() if search_query.time_to is not None else None
+            blocks = TimeIndex.filter_blocks(blocks, time_from, time_to)
+        if search_query.where is not None:
+            blocks = search_query.where.filter_blocks(blocks)
+        return blocks
@@ -0,0 +1,529 @@
+import os
+import re
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Hashable, Iterator, List, Optional, Tuple, final
+from common import Common
+from compressed_log import CompressedLog
+from log_follower import LogFollower
+from log_segment import SegmentBuilder
+from metrics import Metrics
+from parallel_scan import ParallelScanner
+from protocol import Protocol
+from result_cache import CachedResult, ResultCache
+from search_engine import SearchEngine
+from search_query import SearchQuery
+from shared_scan import ScanCoalescer
+from time_index import TimeIndex
+from token_index import LogIndexer
+
+
+class LogSearcher(object):
+
+    '''
+    Searches the log files served by a server and prepares the streamed responses to the queries
+
+    @params logpath: log file, directory or glob pattern served by the server
+    @params indexer: background indexer of the log files, queries fall back to full scans without it
+    @params scanner: pool of worker processes for large files, large files are scanned in process without it
+    @params cache: cache of recent query results, every query searches the log files without it
+    @params decompress_workers: threads decompressing blocks of compressed log files in parallel
+    @params segments: background converter of the log files into columnar segments used by field queries, field
+                      queries search the raw log files without it
+    @params coalescer: coalescer of the full scans of concurrent queries into shared scans, every query scans the
+                       log files on its own without it
+    '''
+
+    # query answered with the metrics of the server instead of searching the log files
+    STATS_QUERY: final = 'stats'
+
+    def __init__(self, logpath: str, indexer: Optional[LogIndexer] = None,
+                 scanner: Optional[ParallelScanner] = None, cache: Optional[ResultCache] = None,
+                 decompress_workers: int = 0, segments: Optional[SegmentBuilder] = None,
+                 coalescer: Optional[ScanCoalescer] = None) -> None:
+        self.logpath = logpath
+        self.indexer = indexer
+        self.scanner = scanner
+        self.cache = cache
+        self.decompress_workers = decompress_workers
+        self.segments = segments
+        self.coalescer = coalescer
+        self.decompress_pool = ThreadPoolExecutor(decompress_workers) if decompress_workers > 1 else None
+        # seekable views of the compressed log files, their checkpoints are recorded by the first search
+        self.compressed_logs: Dict[str, CompressedLog] = {}
+        # sparse timestamp indexes of the plain log files, built by the first time window query of a file
+        self.time_indexes: Dict[str, TimeIndex] = {}
+        # follow queries of the clients, polled by the server
+        self.follower = LogFollower(logpath)
+        # engines of the queries being searched for every (subscriber, request id), to stop them when cancelled
+        self.running: Dict[Tuple[Hashable, int], SearchEngine] = {}
+        # counters and histograms of the server, updated by the servers too
+        self.metrics = Metrics()
+        # id of the server worker process the searcher belongs to, None if the server runs in a single process
+        self.worker: Optional[int] = None
+
+    '''
+    create the searcher of a server from the server settings and start its background indexing
+    '''
+    @staticmethod
+    def create(logpath: str, options: Dict) -> 'LogSearcher':
+        # of several server workers only worker 0 builds the indexes and segments, the others load them
+        read_only = bool(options.get('worker'))
+
+        indexer = None
+        if options.get('index_dir'):
+            indexer = LogIndexer(logpath, options['index_dir'], read_only)
+            indexer.start()
+
+        scanner = None
+        if options.get('scan_workers', 0) > 1:
+            scanner = ParallelScanner(options['scan_workers'])
+
+        cache = None
+        if options.get('cache_size', 0) > 0:
+            cache = ResultCache(options['cache_size'])
+
+        segments = None
+        if options.get('segment_dir'):
+            segments = SegmentBuilder(logpath, options['segment_dir'], read_only)
+            segments.start()
+
+        coalescer = None
+        if options.get('coalesce_window', 0) > 0:
+            coalescer = ScanCoalescer(options['coalesce_window'], scanner,
+                                      options.get('max_queries', Common.DEFAULT_MAX_QUERIES))
+
+        searcher = LogSearcher(logpath, indexer, scanner, cache, options.get('scan_workers', 0), segments, coalescer)
+        searcher.worker = options.get('worker')
+        return searcher
+
+    '''
+    function to search log files and prepare a streamed response of BATCH frames with matched lines followed by a
+    SUMMARY frame with the matched line count for all the files. The returned iterator yields encoded frames of about
+    RESPONSE_CHUNK_SIZE bytes as matches are found, so the response is never fully buffered.
+
+    A follow query is subscribed to instead and yields no frames, its matches are pushed to the subscriber by the polls
+    of the follower until the subscription is cancelled.
+
+    A query with a timeout stops searching at its deadline, which counts from the arrival of the request, so the time
+    it waited for a free query slot is included. A query can be stopped with cancel from the moment it is prepared,
+    before or while it is searched. Its response then ends with the lines matched so far and a summary flagged as
+    partial.
+
+    The stats query is answered with a SUMMARY frame holding the metrics of the server, or of the worker process of
+    the server serving the connection.
+
+    @params subscriber: identity of the client connection follow queries are pushed to, None if the server cannot push
+    @params received: time.time() at which the request arrived, now if not given
+    '''
+    def prepare_search_response(self, query: str, request_id: int = 0, subscriber: Optional[Hashable] = None,
+                                received: Optional[float] = None) -> Tuple[int, Iterator[bytes]]:
+
+        if query.strip() == LogSearcher.STATS_QUERY:
+            return (0, iter([Protocol.encode_summary(request_id, {'stats': dict(self.metrics.snapshot(),
+                                                                                worker=self.worker)})]))
+
+        return_code, search_query = Common.parse_search_query(query)
+        if return_code == 1:
+            self.metrics.increment('queries_invalid')
+            return (1, iter([Protocol.encode_frame(Protocol.FRAME_ERROR, request_id, Common.INVALID_QUERY_RESPONSE)]))
+
+        try:
+            engine = SearchEngine(search_query.engine_search_strings())
+        except re.error as e:
+            self.metrics.increment('queries_invalid')
+            return (1, iter([Protocol.encode_frame(Protocol.FRAME_ERROR, request_id, f"invalid query: {e}".encode())]))
+
+        if search_query.follow:
+            if subscriber is None:
+                return (1, iter([Protocol.encode_frame(Protocol.FRAME_ERROR, request_id,
+                                                       b"invalid query: follow is not supported by this server")]))
+            self.follower.subscribe(subscriber, request_id, engine, search_query)
+            self.metrics.increment('follow_queries')
+            return (0, iter([]))
+
+        if search_query.timeout is not None:
+            engine.deadline = (received if received is not None else time.time()) + search_query.timeout
+        if subscriber is not None:
+            self.running[(subscriber, request_id)] = engine
+        return (0, self.stream_search_response(engine, search_query, SearchEngine.resolve_log_files(self.logpath),
+                                               request_id, subscriber))
+
+    '''
+    stop a query of a client, returns the SUMMARY frame ending the response of a follow query. a query being searched
+    ends its response itself, with the lines matched so far.
+    '''
+    def cancel(self, subscriber: Hashable, request_id: int) -> Optional[bytes]:
+        engine = self.running.get((subscriber, request_id))
+        if engine is not None:
+            engine.cancelled = True
+            return None
+        return self.follower.cancel(subscriber, request_id)
+
+    '''
+    stop all the queries of a closed connection
+    '''
+    def cancel_all(self, subscriber: Hashable) -> None:
+        for key in [key for key in list(self.running) if key[0] == subscriber]:
+            # queries still waiting for a query slot may never start their response, which forgets them otherwise
+            self.running.pop(key).cancelled = True
+        self.follower.unsubscribe_all(subscriber)
+
+    '''
+    generator yielding the frames of the response of a query, the query can be cancelled until it ends
+    '''
+    def stream_search_response(self, engine: SearchEngine, search_query: SearchQuery, log_files: List[str],
+                               request_id: int, subscriber: Optional[Hashable] = None) -> Iterator[bytes]:
+        try:
+            yield from self.search_log_files(engine, search_query, log_files, request_id)
+        finally:
+            self.running.pop((subscriber, request_id), None)
+
+    '''
+    generator to search the log files and yield bounded batches of matched lines and the summary.
+    searching stops as soon as the query options are satisfied: count, exists and aggregate queries send no lines at
+    all, exists stops at the first matched line and limit / head stop once enough lines were found.
+    '''
+    def search_log_files(self, engine: SearchEngine, search_query: SearchQuery, log_files: List[str],
+                         request_id: int) -> Iterator[bytes]:
+
+        begin = time.time()
+        files = []
+        batch = []
+        batch_lines = 0
+        batch_size = 0
+        # matched lines the query may still return for all the files together
+        remaining = search_query.limit
+        exists = False
+
+        # a query cancelled or out of time while it waited for a query slot ends without searching at all
+        engine.should_stop()
+        for log_file in log_files:
+            if remaining == 0 or exists or engine.stopped:
+                break
+            # prefix matched lines with the file path when searching multiple files
+            prefix = log_file.encode() + b':' if len(log_files) > 1 else b''
+            file_summary = {'file': os.path.basename(log_file), 'count': 0}
+            try:
+                if search_query.mode == SearchQuery.MODE_COUNT:
+                    file_summary['count'] = self.count_file_matches(engine, search_query, log_file)
+                    files.append(file_summary)
+                    continue
+
+                if search_query.mode == SearchQuery.MODE_AGGREGATE:
+                    # the matched lines of all the files are aggregated here, only the partial aggregate is sent
+                    file_summary['count'] = search_query.aggregation.add_blocks(
+                        self.query_file_blocks(engine, search_query, log_file))
+                    files.append(file_summary)
+                    continue
+
+                if search_query.mode == SearchQuery.MODE_EXISTS:
+                    max_lines = 1
+                else:
+                    max_lines = min((n for n in (remaining, search_query.head, search_query.tail) if n is not None),
+                                    default=None)
+                if search_query.tail is not None:
+                    blocks = self.tail_file_blocks(engine, search_query, log_file, search_query.tail, file_summary)
+                else:
+                    # a worker process returns the matches of a whole range at once, limited queries usually
+                    # find their lines long before that in a single sequential pass
+                    blocks = self.query_file_blocks(engine, search_query, log_file, parallel=max_lines is None)
+                if max_lines is not None:
+                    blocks = LogSearcher.take_lines(blocks, max_lines, file_summary)
+
+                for num_lines, lines in blocks:
+                    file_summary['count'] += num_lines
+                    if search_query.mode == SearchQuery.MODE_EXISTS:
+                        exists = True
+                        continue
+                    if prefix:
+                        lines = prefix + lines[:-1].replace(b'\n', b'\n' + prefix) + b'\n'
+                    batch.append(lines)
+                    batch_lines += num_lines
+                    batch_size += len(lines)
+                    if batch_size >= Common.RESPONSE_CHUNK_SIZE:
+                        yield Protocol.encode_batch(request_id, batch_lines, b''.join(batch))
+                        batch = []
+                        batch_lines = 0
+                        batch_size = 0
+                if remaining is not None:
+                    remaining -= file_summary['count']
+            except OSError as e:
+                file_summary['error'] = f"search failed: {e}"
+            files.append(file_summary)
+
+        if batch:
+            yield Protocol.encode_batch(request_id, batch_lines, b''.join(batch))
+
+        summary = {
+            'files': files,
+            'bytes_scanned': engine.bytes_scanned,
+            'elapsed': time.time() - begin,
+        }
+        self.metrics.increment('queries')
+        self.metrics.increment('bytes_scanned', engine.bytes_scanned)
+        self.metrics.increment('lines_matched', sum(file_summary['count'] for file_summary in files))
+        if engine.stopped:
+            self.metrics.increment('queries_partial')
+            # the file being searched when the search stopped, later files were not searched at all
+            if files:
+                files[-1]['truncated'] = True
+            summary['partial'] = 'cancelled' if engine.cancelled else 'deadline exceeded'
+        if search_query.mode == SearchQuery.MODE_EXISTS:
+            summary['exists'] = exists
+        if search_query.mode == SearchQuery.MODE_AGGREGATE:
+            summary['aggregate'] = search_query.aggregation.partial()
+        yield Protocol.encode_summary(request_id, summary)
+
+    '''
+    generator passing on blocks of matched lines until max_lines lines were yielded, the last block is cut short.
+    the source generator is closed right away, so the search behind it stops (pending parallel ranges are cancelled).
+    the file summary is flagged as truncated when a matched line past max_lines was seen, further matches of the file
+    are not searched for.
+    '''
+    @staticmethod
+    def take_lines(blocks: Iterator[Tuple[int, bytes]], max_lines: int,
+                   file_summary: Dict) -> Iterator[Tuple[int, bytes]]:
+        try:
+            for num_lines, lines in blocks:
+                if num_lines <= max_lines:
+                    max_lines -= num_lines
+                    yield num_lines, lines
+                    if max_lines == 0:
+                        return
+                    continue
+                end = -1
+                for _ in range(max_lines):
+                    end = lines.index(b'\n', end + 1)
+                file_summary['truncated'] = True
+                yield max_lines, lines[:end + 1]
+                return
+        finally:
+            blocks.close()
+
+    '''
+    blocks of the last max_lines matched lines of a single log file, the file summary is flagged as truncated when the
+    file has earlier matched lines
+    '''
+    def tail_file_blocks(self, engine: SearchEngine, search_query: SearchQuery, log_file: str,
+                         max_lines: int, file_summary: Dict) -> Iterator[Tuple[int, bytes]]:
+        # one line more than returned tells whether there are earlier matches
+        if not search_query.has_time_window() and search_query.where is None and \
+                CompressedLog.detect_format(log_file) is None:
+            lines = engine.tail_file_matches(log_file, max_lines + 1)
+        else:
+            # compressed files cannot be read backwards and filtered lines are not counted by a backward search,
+            # keep the last lines of a full search
+            lines = deque(maxlen=max_lines + 1)
+            for _, block in self.query_file_blocks(engine, search_query, log_file):
+                lines.extend(line + b'\n' for line in block[:-1].split(b'\n'))
+        if len(lines) > max_lines:
+            file_summary['truncated'] = True
+            lines = list(lines)[1:]
+        return SearchEngine.group_blocks(iter(lines), Common.RESPONSE_CHUNK_SIZE)
+
+    '''
+    count the matched lines of a single log file without building any block of lines. the lines themselves are only
+    needed, and searched for, to filter them by a field query or a time window and for compressed files. a count is
+    served from the cached result of the same search when the file did not change, but is not cached itself.
+    '''
+    def count_file_matches(self, engine: SearchEngine, search_query: SearchQuery, log_file: str) -> int:
+        if search_query.where is not None or search_query.has_time_window() or \
+                CompressedLog.detect_format(log_file) is not None:
+            return sum(num_lines for num_lines, _ in self.query_file_blocks(engine, search_query, log_file,
+                                                                             store=False))
+
+        start = 0
+        count = 0
+        if self.cache is not None:
+            entry = self.cache.get(ResultCache.make_key(engine.search_strings, log_file))
+            stat = os.stat(log_file)
+            if entry is not None and entry.inode == stat.st_ino and entry.file_size == stat.st_size and \
+                    entry.mtime == stat.st_mtime_ns:
+                # only a partially written last line is left to search
+                start = entry.size
+                count = sum(num_lines for num_lines, _ in entry.blocks)
+
+        index = self.indexer.get_index(log_file) if self.indexer is not None else None
+        candidates = index.candidate_spans(engine.literals) if index is not None else None
+        if candidates is not None:
+            spans, indexed_size = candidates
+            return count + engine.count_file_matches(log_file, start, spans=spans, indexed_size=indexed_size)
+        if self.scanner is not None:
+            return count + self.scanner.count_file_matches(engine, log_file, start)
+        return count + engine.count_file_matches(log_file, start)
+
+    '''
+    blocks of matched lines of a single log file, restricted to the time window of the query if it has one. Lines are
+    parsed into fields only when the query has a field query, and only the lines matched by the search strings are.
+
+    @params store: whether the matched lines are stored in the result cache
+    '''
+    def query_file_blocks(self, engine: SearchEngine, search_query: SearchQuery, log_file: str,
+                          parallel: bool = True, store: bool = True) -> Iterator[Tuple[int, bytes]]:
+        segments = self.segments.get_segments(log_file) if self.segments is not None else None
+        candidates = None
+        # the sparse timestamp index narrows time windows down cheaper than filtering the timestamp column
+        if segments is not None and search_query.where is not None and not search_query.has_time_window():
+            candidates = segments.candidate_spans(search_query.where.condition)
+        if candidates is not None:
+            blocks = self.segment_file_blocks(engine, log_file, *candidates)
+        elif search_query.has_time_window():
+            blocks = self.time_window_file_blocks(engine, search_query, log_file, parallel)
+        else:
+            blocks = self.iter_log_file_blocks(engine, log_file, parallel, store)
+        if search_query.where is not None:
+            blocks = search_query.where.filter_blocks(blocks)
+        return blocks
+
+    '''
+    blocks of matched lines of a single log file, only the lines selected by filtering the columnar segments of the
+    file for the field query are searched, plus the data appended after the last segment. the field query verifies
+    the matched lines afterwards.
+
+    @params spans: sorted (start, end) byte ranges of the candidate lines selected by the segments
+    @params covered_size: size of the log file covered by the segments
+    '''
+    def segment_file_blocks(self, engine: SearchEngine, log_file: str, spans: List[Tuple[int, int]],
+                            covered_size: int) -> Iterator[Tuple[int, bytes]]:
+        return SearchEngine.group_blocks(engine.iter_indexed_matches(log_file, spans, covered_size),
+                                         Common.RESPONSE_CHUNK_SIZE)
+
+    '''
+    generator yielding blocks of matched lines of a single log file within the time window of the query. only the
+    byte range of the window found with the sparse timestamp index is searched (only the blocks of the window for
+    compressed files), the matched lines are checked against the window. results are not cached.
+    '''
+    def time_window_file_blocks(self, engine: SearchEngine, search_query: SearchQuery, log_file: str,
+                                parallel: bool = True) -> Iterator[Tuple[int, bytes]]:
+        time_from = search_query.time_from.encode() if search_query.time_from is not None else None
+        time_to = search_query.time_to.encode() if search_query.time_to is not None else None
+
+        if CompressedLog.detect_format(log_file) is not None:
+            blocks = self.search_compressed_file_blocks(engine, log_file, parallel, time_from, time_to)
+        else:
+            time_index = self.time_indexes.get(log_file)
+            if time_index is None:
+                time_index = self.time_indexes.setdefault(log_file, TimeIndex(log_file))
+            start, end = time_index.byte_range(time_from, time_to)
+            blocks = self.search_file_blocks(engine, log_file, start, end, parallel)
+        return TimeIndex.filter_blocks(blocks, time_from, time_to)
+
+    '''
+    generator yielding blocks of matched lines of a single log file, served from the result cache when the file did not
+    change since the same query was last run. When the file has only grown, just the appended data is searched.
+
+    @params store: whether the matched lines are stored in the result cache, a cached result is used either way
+    '''
+    def iter_log_file_blocks(self, engine: SearchEngine, log_file: str, parallel: bool = True,
+                             store: bool = True) -> Iterator[Tuple[int, bytes]]:
+
+        if self.cache is None:
+            yield from self.search_file_blocks(engine, log_file, parallel=parallel)
+            return
+
+        key = ResultCache.make_key(engine.search_strings, log_file)
+        # compressed rotations are never appended to, they are searched and cached whole
+        compressed = CompressedLog.detect_format(log_file) is not None
+        with open(log_file, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            entry = self.cache.get(key)
+
+            if entry is not None and entry.inode == stat.st_ino and entry.file_size == stat.st_size and \
+                    entry.mtime == stat.st_mtime_ns:
+                # file did not change at all
+                complete_size = entry.size
+                start = entry.size
+            else:
+                # only the complete lines are cached, a partially written last line is searched on every query
+                complete_size = stat.st_size if compressed else ResultCache.complete_size(f, stat.st_size)
+                appended = not compressed and entry is not None and entry.inode == stat.st_ino and \
+                    entry.size <= complete_size and ResultCache.fingerprint(f, entry.size) == entry.fingerprint
+                start = entry.size if appended else 0
+                if not appended:
+                    entry = None
+
+            if entry is not None:
+                yield from entry.blocks
+
+            if start < complete_size:
+                # matched lines collected for the cache, None when they are not cached
+                blocks = None
+                if store:
+                    blocks = list(entry.blocks) if entry is not None else []
+                nbytes = entry.nbytes if entry is not None else 0
+                for block in self.search_file_blocks(engine, log_file, start, complete_size, parallel):
+                    yield block
+                    if blocks is not None:
+                        blocks.append(block)
+                        nbytes += len(block[1])
+                        # result is too large to be cached, stop collecting it
+                        if nbytes > self.cache.max_entry_bytes:
+                            blocks = None
+                # results of a search which stopped early are incomplete
+                if blocks is not None and not engine.stopped:
+                    self.cache.put(key, CachedResult(stat.st_ino, stat.st_size, stat.st_mtime_ns, complete_size,
+                                                     ResultCache.fingerprint(f, complete_size), blocks))
+
+        if complete_size < stat.st_size:
+            yield from SearchEngine.group_blocks(engine.iter_file_matches(log_file, complete_size, stat.st_size),
+                                                 Common.RESPONSE_CHUNK_SIZE)
+
+    '''
+    generator yielding blocks of matched lines of a part of a single log file. Only the candidate lines selected by the
+    token index are read when the query has indexable literals, otherwise the file is scanned once for all the
+    concurrent queries scanning it and large files are scanned by the worker processes.
+
+    @params start: offset to start searching at, must be at a line boundary
+    @params end: offset to stop searching at, defaults to the end of the file
+    @params parallel: whether large files may be scanned by the worker processes
+    '''
+    def search_file_blocks(self, engine: SearchEngine, log_file: str, start: int = 0,
+                           end: Optional[int] = None, parallel: bool = True) -> Iterator[Tuple[int, bytes]]:
+
+        if CompressedLog.detect_format(log_file) is not None:
+            return self.search_compressed_file_blocks(engine, log_file, parallel)
+
+        index = self.indexer.get_index(log_file) if self.indexer is not None else None
+        candidates = index.candidate_spans(engine.literals) if index is not None else None
+        if candidates is not None:
+            # regex still verifies every candidate line
+            spans, indexed_size = candidates
+            return SearchEngine.group_blocks(engine.iter_indexed_matches(log_file, spans, indexed_size, end, start),
+                                             Common.RESPONSE_CHUNK_SIZE)
+
+        if self.coalescer is not None:
+            return self.coalescer.iter_file_blocks(engine, log_file, start, end, parallel)
+
+        if self.scanner is not None and parallel:
+            return self.scanner.iter_file_blocks(engine, log_file, Common.RESPONSE_CHUNK_SIZE, start, end)
+
+        return SearchEngine.group_blocks(engine.iter_file_matches(log_file, start, end), Common.RESPONSE_CHUNK_SIZE)
+
+    '''
+    generator yielding blocks of matched lines of a whole compressed log file. Blocks without candidate lines of the
+    token index or outside the time window are not decompressed, the others are decompressed in parallel by the
+    decompression threads.
+    '''
+    def search_compressed_file_blocks(self, engine: SearchEngine, log_file: str, parallel: bool = True,
+                                      time_from: Optional[bytes] = None,
+                                      time_to: Optional[bytes] = None) -> Iterator[Tuple[int, bytes]]:
+
+        stat = os.stat(log_file)
+        compressed_log = self.compressed_logs.get(log_file)
+        if compressed_log is None or not compressed_log.is_current(stat):
+            compressed_log = CompressedLog(log_file, stat)
+            self.compressed_logs[log_file] = compressed_log
+
+        spans = None
+        index = self.indexer.get_index(log_file) if self.indexer is not None else None
+        # an index of a previous version of the file, or one still being rebuilt, cannot narrow down the search
+        if index is not None and index.inode == stat.st_ino and index.compressed_size == stat.st_size:
+            candidates = index.candidate_spans(engine.literals)
+            if candidates is not None:
+                spans = candidates[0]
+
+        executor = self.decompress_pool if parallel else None
+        return compressed_log.iter_file_blocks(engine, Common.RESPONSE_CHUNK_SIZE, executor,
+                                               2 * self.decompress_workers, spans, time_from, time_to)
@@ -0,0 +1,428 @@
+import functools
+import glob
+import hashlib
+import json
+import logging
+import mmap
+import operator
+import os
+import re
+import struct
+import threading
+import time
+from array import array
+from typing import Dict, Iterator, List, Optional, Tuple, final
+from compressed_log import CompressedLog
+from field_query import AndCondition, Condition, FieldCondition, LogRecord, NotCondition, OrCondition
+from search_engine import SearchEngine
+
+try:
+    import numpy
+except ImportError:  # only the dictionary encoded columns are filtered without numpy, with bytes operations
+    numpy = None
+
+logger = logging.getLogger(__name__)
+
+
+class LogSegment(object):
+
+    '''
+    Immutable columnar segment of the lines of a byte range of a log file: the line offsets, the timestamps as
+    YYMMDDHHMMSS integers, the pids, and the dictionary encoded levels and components. The message text stays in the
+    log file and is only read for the lines selected by filtering the columns. Segment files are memory mapped,
+    columns are numpy arrays when numpy is installed and memoryviews of the mapping otherwise. Without numpy the
+    integer columns are not filtered, comparing them line by line would cost as much as scanning the lines.
+
+    Lines which do not parse into all the columns (e.g. stack traces, values beyond the dictionary size) are marked as
+    not parsed and always selected, the field query verifies every selected line.
+
+    @params path: path to the segment file
+    '''
+
+    MAGIC: final = b'LOGSEG01'
+
+    FORMAT_VERSION: final = 1
+
+    # name and array typecode of every column
+    COLUMNS: final = (('offset', 'Q'), ('timestamp', 'q'), ('pid', 'q'), ('level', 'B'), ('component', 'B'),
+                      ('parsed', 'B'))
+
+    # dictionary encoded fields, code 0 is for values which could not be encoded
+    DICTIONARY_FIELDS: final = ('level', 'component')
+    MAX_DICTIONARY_SIZE: final = 255
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(LogSegment.MAGIC)] != LogSegment.MAGIC:
+            raise ValueError(f'{path} is not a log segment')
+        header_offset, = struct.unpack_from('<Q', self.data, len(self.data) - 8)
+        self.header = json.loads(self.data[header_offset:len(self.data) - 8])
+        if self.header['version'] != LogSegment.FORMAT_VERSION:
+            raise ValueError(f'{path} has an unsupported segment version')
+
+        self.start = self.header['start']
+        self.end = self.header['end']
+        self.num_lines = self.header['num_lines']
+        # dictionary values are stored as latin-1 text, which maps every byte value to one character
+        self.dictionaries = {field: [value.encode('latin-1') for value in self.header['dictionaries'][field]]
+                             for field in LogSegment.DICTIONARY_FIELDS}
+        self.columns = {}
+        for name, typecode in LogSegment.COLUMNS:
+            offset = self.header['columns'][name]
+            if numpy is not None:
+                self.columns[name] = numpy.frombuffer(self.data, typecode, self.num_lines, offset)
+            else:
+                itemsize = array(typecode).itemsize
+                self.columns[name] = memoryview(self.data)[offset:offset + self.num_lines * itemsize].cast(typecode)
+        # bytes with one 0x01 lane per line, the identity of the bitwise operations on masks without numpy
+        self.all_lines = int.from_bytes(b'\x01' * self.num_lines, 'little')
+        self.unparsed = self.invert(self.code_mask('parsed', {1}))
+
+    '''
+    write the segment of newline terminated lines starting at an offset of a log file and open it
+    '''
+    @staticmethod
+    def build(path: str, data: bytes, start: int, inode: int, fingerprint: str) -> 'LogSegment':
+        columns = {name: array(typecode) for name, typecode in LogSegment.COLUMNS}
+        dictionaries = {field: {} for field in LogSegment.DICTIONARY_FIELDS}
+        record = LogRecord()
+        offset = start
+        for line in data[:-1].split(b'\n'):
+            columns['offset'].append(offset)
+            offset += len(line) + 1
+            record.parse(line)
+            timestamp = record.date + record.time
+            timestamp = int(timestamp) if len(timestamp) == 12 and timestamp.isdigit() else -1
+            # pids are compared as text, only canonical numbers can be compared as integers
+            pid = int(record.pid) if record.pid.isdigit() and record.pid[:1] != b'0' else -1
+            codes = [LogSegment.encode(dictionaries[field], getattr(record, field))
+                     for field in LogSegment.DICTIONARY_FIELDS]
+            columns['timestamp'].append(timestamp)
+            columns['pid'].append(pid)
+            columns['level'].append(codes[0])
+            columns['component'].append(codes[1])
+            columns['parsed'].append(1 if timestamp >= 0 and pid >= 0 and all(codes) else 0)
+
+        header = {
+            'version': LogSegment.FORMAT_VERSION,
+            'inode': inode,
+            'fingerprint': fingerprint,
+            'start': start,
+            'end': offset,
+            'num_lines': len(columns['offset']),
+            'dictionaries': {field: [value.decode('latin-1') for value in dictionaries[field]]
+                             for field in LogSegment.DICTIONARY_FIELDS},
+            'columns': {},
+        }
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(LogSegment.MAGIC)
+            for name, _ in LogSegment.COLUMNS:
+                # columns are aligned for the memory mapped arrays
+                f.write(b'\0' * (-f.tell() % 8))
+                header['columns'][name] = f.tell()
+                columns[name].tofile(f)
+            header_offset = f.tell()
+            f.write(json.dumps(header).encode())
+            f.write(struct.pack('<Q', header_offset))
+        os.replace(tmp_path, path)
+        return LogSegment(path)
+
+    @staticmethod
+    def encode(dictionary: Dict[bytes, int], value: bytes) -> int:
+        code = dictionary.get(value)
+        if code is None:
+            if len(dictionary) >= LogSegment.MAX_DICTIONARY_SIZE:
+                return 0
+            code = dictionary[value] = len(dictionary) + 1
+        return code
+
+    '''
+    mask of the lines whose one byte column value is one of a set of codes
+    '''
+    def code_mask(self, column: str, codes) -> object:
+        if numpy is not None:
+            return numpy.isin(self.columns[column], list(codes))
+        table = bytes(1 if code in codes else 0 for code in range(256))
+        return int.from_bytes(self.columns[column].tobytes().translate(table), 'little')
+
+    '''
+    mask of the lines whose integer column value (modulo a number if given) compares to a value with <, <=, >, >= or =,
+    numpy only
+    '''
+    def compare_mask(self, column: str, compare: str, value: int, modulo: Optional[int] = None) -> object:
+        values = self.columns[column]
+        if modulo is not None:
+            values = values % modulo
+        return {'<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge,
+                '=': operator.eq}[compare](values, value)
+
+    def invert(self, mask) -> object:
+        return ~mask if numpy is not None else self.all_lines ^ mask
+
+    '''
+    numbers of the lines selected by a mask
+    '''
+    def mask_lines(self, mask) -> Iterator[int]:
+        if numpy is not None:
+            return iter(numpy.flatnonzero(mask).tolist())
+        return (match.start() for match in re.finditer(b'\x01', mask.to_bytes(self.num_lines, 'little')))
+
+    '''
+    mask of the parsed lines which may match a condition, None if the columns cannot narrow it down, and whether
+    the mask is exact for the parsed lines (only exact masks can be inverted)
+    '''
+    def condition_mask(self, condition: Condition) -> Tuple[Optional[object], bool]:
+        if isinstance(condition, NotCondition):
+            mask, exact = self.condition_mask(condition.condition)
+            if mask is None or not exact:
+                return None, False
+            return self.invert(mask), True
+        if isinstance(condition, (AndCondition, OrCondition)):
+            results = [self.condition_mask(child) for child in condition.conditions]
+            exact = all(child_exact for _, child_exact in results)
+            masks = [mask for mask, _ in results if mask is not None]
+            if isinstance(condition, AndCondition):
+                # conditions the columns cannot evaluate only make the mask a superset
+                return (functools.reduce(operator.and_, masks), exact) if masks else (None, False)
+            if len(masks) < len(results):
+                return None, False
+            return functools.reduce(operator.or_, masks), exact
+        if isinstance(condition, FieldCondition):
+            return self.field_mask(condition)
+        return None, False
+
+    def field_mask(self, condition: FieldCondition) -> Tuple[Optional[object], bool]:
+        field = condition.field
+        value = condition.value
+        if field in LogSegment.DICTIONARY_FIELDS:
+            # the condition is evaluated once per dictionary value instead of once per line
+            codes = {code for code, encoded in enumerate(self.dictionaries[field], 1)
+                     if condition.matches_value(encoded)}
+            return self.code_mask(field, codes), True
+        if condition.operator == '!=':
+            mask, exact = self.field_mask(FieldCondition(field, '=', value))
+            return (self.invert(mask), True) if mask is not None and exact else (None, False)
+        if field == 'pid' and condition.operator == '=' and (not value.isdigit() or value[:1] == '0'):
+            # parsed pids are canonical numbers
+            return self.code_mask('parsed', set()), True
+        if numpy is None:
+            # the remaining conditions compare the integer columns, the row scan is as fast without numpy
+            return None, False
+        if field == 'pid' and condition.operator != '~':
+            number = int(value) if condition.operator == '=' else condition.number
+            return self.compare_mask('pid', condition.operator, number), True
+        if field == 'date' and condition.operator != '~' and len(value) == 6 and value.isdigit():
+            first = int(value) * 1000000
+            last = first + 999999
+            if condition.operator == '=':
+                return self.compare_mask('timestamp', '>=', first) & self.compare_mask('timestamp', '<=', last), True
+            bound = {'<': first, '<=': last, '>': last, '>=': first}[condition.operator]
+            return self.compare_mask('timestamp', condition.operator, bound), True
+        if field == 'time' and condition.operator != '~' and len(value) == 6 and value.isdigit():
+            return self.compare_mask('timestamp', condition.operator, int(value), 1000000), True
+        return None, False
+
+    '''
+    sorted (start, end) byte ranges of the lines which may match a condition, None if the columns cannot narrow the
+    condition down
+    '''
+    def candidate_spans(self, condition: Condition) -> Optional[List[Tuple[int, int]]]:
+        mask, _ = self.condition_mask(condition)
+        if mask is None:
+            return None
+
+        offsets = self.columns['offset']
+        spans = []
+        for line in self.mask_lines(mask | self.unparsed):
+            start = int(offsets[line])
+            end = int(offsets[line + 1]) if line + 1 < self.num_lines else self.end
+            # adjacent lines are searched as a single range
+            if spans and spans[-1][1] == start:
+                spans[-1] = (spans[-1][0], end)
+            else:
+                spans.append((start, end))
+        return spans
+
+
+class LogSegments(object):
+
+    '''
+    Columnar segments covering a log file from its beginning. Data appended to the log file is converted into new
+    segments once at least MIN_SEGMENT_SIZE bytes of complete lines were appended, the rest of the file is searched
+    without them.
+
+    @params log_file: path to the log file
+    @params segment_dir: directory the segment files are written to
+    '''
+
+    # bytes of the log file converted into a single segment at most
+    MAX_SEGMENT_SIZE: final = 64 * 1024 * 1024
+
+    # appended bytes worth a new segment
+    MIN_SEGMENT_SIZE: final = 1024 * 1024
+
+    # bytes hashed from the start of the file to detect files replaced in place
+    FINGERPRINT_SIZE: final = 4096
+
+    def __init__(self, log_file: str, segment_dir: str) -> None:
+        self.log_file = log_file
+        digest = hashlib.sha1(os.path.abspath(log_file).encode()).hexdigest()[:12]
+        self.path_prefix = os.path.join(segment_dir, f'{os.path.basename(log_file)}.{digest}')
+        self.inode = None
+        self.fingerprint = None
+        # replaced as a whole, so queries always see a consistent list
+        self.segments: List[LogSegment] = []
+
+    @property
+    def covered_size(self) -> int:
+        return self.segments[-1].end if self.segments else 0
+
+    '''
+    open the segment files written by a previous run or by another process which still belong to the log file, the
+    segments opened already are kept
+    '''
+    def load(self) -> None:
+        with open(self.log_file, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            fingerprint = hashlib.sha1(f.read(LogSegments.FINGERPRINT_SIZE)).hexdigest()
+        opened = {segment.path: segment for segment in self.segments}
+        segments = []
+        for path in glob.glob(self.path_prefix + '.*.seg'):
+            segment = opened.get(path)
+            # a segment of a rotated log file may have been replaced by a segment of the new file
+            if segment is None or segment.header['inode'] != stat.st_ino or \
+                    segment.header['fingerprint'] != fingerprint:
+                try:
+                    segment = LogSegment(path)
+                except (OSError, ValueError, KeyError):
+                    continue
+            if segment.header['inode'] == stat.st_ino and segment.header['fingerprint'] == fingerprint and \
+                    segment.end <= stat.st_size:
+                segments.append(segment)
+        segments.sort(key=lambda segment: segment.start)
+        # only segments continuing each other from the start of the file are used
+        covered = 0
+        for i, segment in enumerate(segments):
+            if segment.start != covered:
+                segments = segments[:i]
+                break
+            covered = segment.end
+        self.inode = stat.st_ino
+        self.fingerprint = fingerprint
+        self.segments = segments
+
+    '''
+    convert the complete lines appended since the last update into new segments, returns True if segments changed
+    '''
+    def update(self) -> bool:
+        with open(self.log_file, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            fingerprint = hashlib.sha1(f.read(LogSegments.FINGERPRINT_SIZE)).hexdigest()
+            covered = self.covered_size
+
+            # log file was rotated, truncated or rewritten: start over
+            changed = stat.st_ino != self.inode or stat.st_size < covered or \
+                (covered >= LogSegments.FINGERPRINT_SIZE and fingerprint != self.fingerprint)
+            if changed:
+                self.segments = []
+                for path in glob.glob(self.path_prefix + '.*.seg'):
+                    os.remove(path)
+                self.inode = stat.st_ino
+                covered = 0
+            self.fingerprint = fingerprint
+
+            segments = list(self.segments)
+            while stat.st_size - covered >= LogSegments.MIN_SEGMENT_SIZE:
+                f.seek(covered)
+                data = f.read(min(LogSegments.MAX_SEGMENT_SIZE, stat.st_size - covered))
+                end = data.rfind(b'\n') + 1
+                if end == 0:
+                    break
+                segments.append(LogSegment.build(f'{self.path_prefix}.{covered}.seg', data[:end], covered,
+                                                 stat.st_ino, fingerprint))
+                covered += end
+                changed = True
+            self.segments = segments
+        return changed
+
+    '''
+    sorted (start, end) byte ranges of the lines which may match a condition and the size of the log file covered by
+    the segments, None if the columns cannot narrow the condition down and the lines are better scanned
+    '''
+    def candidate_spans(self, condition: Condition) -> Optional[Tuple[List[Tuple[int, int]], int]]:
+        segments = self.segments
+        spans = []
+        for segment in segments:
+            segment_spans = segment.candidate_spans(condition)
+            if segment_spans is None:
+                return None
+            spans.extend(segment_spans)
+        return spans, segments[-1].end if segments else 0
+
+
+class SegmentBuilder(object):
+
+    '''
+    Converts the plain log files of a server into columnar segments in the background, loads the segments written by
+    previous runs at startup and converts the data appended to the log files.
+
+    @params logpath: log file, directory or glob pattern served by the server
+    @params segment_dir: directory the segment files are written to
+    @params read_only: only open the segments written by another process (e.g. another server worker), instead of
+                       converting the log files
+    '''
+
+    # seconds between checks of the log files for appended data
+    REFRESH_INTERVAL: final = 5.0
+
+    def __init__(self, logpath: str, segment_dir: str, read_only: bool = False) -> None:
+        self.logpath = logpath
+        self.segment_dir = segment_dir
+        self.read_only = read_only
+        self.segments: Dict[str, LogSegments] = {}
+        # segments which finished their first conversion and can be used by queries
+        self.ready: Dict[str, LogSegments] = {}
+
+    '''
+    start the background conversion thread
+    '''
+    def start(self) -> None:
+        os.makedirs(self.segment_dir, exist_ok=True)
+        thread = threading.Thread(target=self.run, name='log-segments', daemon=True)
+        thread.start()
+
+    '''
+    convert all the plain log files once, compressed rotations are not converted
+    '''
+    def refresh(self) -> None:
+        for log_file in SearchEngine.resolve_log_files(self.logpath):
+            if CompressedLog.detect_format(log_file) is not None:
+                continue
+            try:
+                segments = self.segments.get(log_file)
+                if segments is None or self.read_only:
+                    segments = segments or LogSegments(log_file, self.segment_dir)
+                    segments.load()
+                    self.segments[log_file] = segments
+                begin = time.time()
+                if not self.read_only and segments.update():
+                    logger.info('converted %s into segments up to %s bytes in %s seconds', log_file,
+                                segments.covered_size, time.time() - begin)
+                self.ready[log_file] = segments
+            except OSError as e:
+                logger.warning('failed to convert %s into segments: %s', log_file, e)
+                self.ready.pop(log_file, None)
+
+    def run(self) -> None:
+        while True:
+            self.refresh()
+            time.sleep(SegmentBuilder.REFRESH_INTERVAL)
+
+    '''
+    segments of a log file if they are ready to be used by queries
+    '''
+    def get_segments(self, log_file: str) -> Optional[LogSegments]:
+        return self.ready.get(log_file)
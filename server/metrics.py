@@ -0,0 +1,151 @@
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, final
+
+
+class Histogram(object):
+
+    '''
+    Distribution of observed values in exponential buckets, percentiles are estimated by the upper bounds of the
+    buckets (within about 20%)
+    '''
+
+    # upper bounds of consecutive buckets grow by this factor
+    GROWTH: final = 2 ** 0.25
+
+    # values at or below this land in the first bucket
+    MIN_VALUE: final = 1e-6
+
+    def __init__(self) -> None:
+        # number of observed values per bucket index, the upper bound of bucket i is GROWTH ** i
+        self.buckets: Dict[int, int] = {}
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        index = math.ceil(math.log(max(value, Histogram.MIN_VALUE), Histogram.GROWTH))
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, percentile: float) -> float:
+        rank = math.ceil(self.count * percentile / 100)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return min(Histogram.GROWTH ** index, self.max)
+        return self.max
+
+    def snapshot(self) -> Dict:
+        if self.count == 0:
+            return {'count': 0}
+        return {'count': self.count, 'sum': self.sum, 'max': self.max, 'p50': self.percentile(50),
+                'p95': self.percentile(95), 'p99': self.percentile(99)}
+
+
+class Metrics(object):
+
+    '''
+    Counters, gauges and histograms of a server, updated by the event loop and the query threads and reported by the
+    stats query
+    '''
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters: Dict[str, int] = {}
+        self.gauges: Dict[str, int] = {}
+        self.histograms: Dict[str, Histogram] = {}
+
+    def increment(self, name: str, value: int = 1) -> None:
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    '''
+    add a delta to a gauge, e.g. +1 and -1 as connections open and close
+    '''
+    def adjust(self, name: str, delta: int) -> None:
+        with self.lock:
+            self.gauges[name] = self.gauges.get(name, 0) + delta
+
+    def observe(self, name: str, value: float) -> None:
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+
+    def snapshot(self) -> Dict:
+        with self.lock:
+            return {
+                'uptime': time.time() - self.started,
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+                'histograms': {name: histogram.snapshot() for name, histogram in self.histograms.items()},
+            }
+
+
+class QueryTrace(object):
+
+    '''
+    Seconds a query spent in every phase on the server: waiting for a query slot (queue), parsing, searching the log
+    files (scan), encoding and compressing the response frames (serialize) and waiting for the client to take them
+    (send). The phases of a query are timed by one thread at a time.
+
+    @params metrics: metrics the durations are recorded to once the query ends
+    '''
+
+    SPANS: final = ('queue', 'parse', 'scan', 'serialize', 'send')
+
+    def __init__(self, metrics: Metrics) -> None:
+        self.metrics = metrics
+        self.begin = time.perf_counter()
+        self.spans: Dict[str, float] = dict.fromkeys(QueryTrace.SPANS, 0.0)
+        self.bytes_sent = 0
+        # seconds from the start to the end of the query, set when it ended
+        self.elapsed = 0.0
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans[name] += time.perf_counter() - begin
+
+    def add(self, name: str, seconds: float) -> None:
+        self.spans[name] += seconds
+
+    '''
+    record the durations of the query once it ended
+    '''
+    def finish(self) -> None:
+        self.elapsed = time.perf_counter() - self.begin
+        for name, seconds in self.spans.items():
+            self.metrics.observe(f'query_{name}_seconds', seconds)
+        self.metrics.observe('query_total_seconds', self.elapsed)
+        self.metrics.increment('bytes_sent', self.bytes_sent)
+
+    '''
+    durations of the query formatted for the log, only built when the log shows them
+    '''
+    def __str__(self) -> str:
+        spans = ', '.join(f'{name} {seconds * 1000:.1f}ms' for name, seconds in self.spans.items())
+        return f'{self.elapsed * 1000:.1f}ms ({spans}), sent {self.bytes_sent} bytes'
+
+
+'''
+configure the leveled log of a server, e.g. warning to keep the per query messages off the hot path
+
+@params workers: whether the server runs several worker processes, their messages are tagged with the process name
+'''
+def configure_logging(level: str, workers: bool = False) -> None:
+    process = ' %(processName)s' if workers else ''
+    logging.basicConfig(level=getattr(logging, level.upper(), logging.INFO),
+                        format=f'%(asctime)s %(levelname)s{process} %(name)s: %(message)s')
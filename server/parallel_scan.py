@@ -0,0 +1,192 @@
+import functools
+import mmap
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List, Optional, Tuple, final
+from search_engine import SearchEngine
+
+
+'''
+engine of the search strings in a worker process, cached so patterns are compiled once per worker and query
+'''
+@functools.lru_cache(maxsize=32)
+def get_engine(search_strings: Tuple[str, ...]) -> SearchEngine:
+    return SearchEngine(list(search_strings))
+
+
+'''
+initializer of a worker process: exit once the server process is gone, e.g. a server worker was killed and is
+restarted with a new pool, the worker would otherwise wait for tasks forever
+'''
+def watch_server(server_pid: int) -> None:
+    def watch() -> None:
+        while os.getppid() == server_pid:
+            time.sleep(1)
+        os._exit(0)
+
+    threading.Thread(target=watch, name='watch-server', daemon=True).start()
+
+
+'''
+scan a line aligned byte range of a log file in a worker process
+
+@params search_strings: search strings of the query
+@params path: path to the log file
+@params start: offset of the first line of the range
+@params end: offset one past the last line of the range
+@params block_size: size of the blocks matched lines are grouped into
+'''
+def scan_range(search_strings: Tuple[str, ...], path: str, start: int, end: int,
+               block_size: int) -> List[Tuple[int, bytes]]:
+    engine = get_engine(search_strings)
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return list(SearchEngine.group_blocks(engine.scan(data, start, end), block_size))
+
+
+'''
+count the matched lines of a line aligned byte range of a log file in a worker process
+'''
+def count_range(search_strings: Tuple[str, ...], path: str, start: int, end: int) -> int:
+    engine = get_engine(search_strings)
+    return engine.count_file_matches(path, start, end)
+
+
+class ParallelScanner(object):
+
+    '''
+    Scans large log files on all the cores by splitting them into line aligned byte ranges which
+    are searched by a pool of worker processes, the matches are merged back in file order.
+
+    @params workers: number of worker processes
+    '''
+
+    # size of the byte range searched by a single task
+    RANGE_SIZE: final = 8 * 1024 * 1024
+
+    def __init__(self, workers: int) -> None:
+        self.workers = workers
+        # spawn rather than fork, the server process runs threads (e.g. the indexer)
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                            initializer=watch_server, initargs=(os.getpid(),))
+
+    '''
+    split a part of a log file into line aligned byte ranges of about RANGE_SIZE bytes
+
+    @params path: path to the log file
+    @params start: offset of the first line to split
+    @params end: offset to stop at, defaults to the end of the file
+    '''
+    @staticmethod
+    def split_ranges(path: str, start: int = 0, end: Optional[int] = None) -> List[Tuple[int, int]]:
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            end = size if end is None else min(end, size)
+            if end <= start:
+                return []
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                ranges = []
+                while start < end:
+                    range_end = data.find(b'\n', min(start + ParallelScanner.RANGE_SIZE, end) - 1, end)
+                    range_end = end if range_end < 0 else range_end + 1
+                    ranges.append((start, range_end))
+                    start = range_end
+                return ranges
+
+    '''
+    generator yielding blocks of matched lines of a log file in file order.
+    files smaller than two ranges are not worth the inter process overhead and are searched in this process.
+
+    @params engine: engine of the query
+    @params path: path to the log file
+    @params block_size: size of the blocks matched lines are grouped into
+    @params start: offset to start searching at, must be at a line boundary
+    @params end: offset to stop searching at, defaults to the end of the file
+    '''
+    def iter_file_blocks(self, engine: SearchEngine, path: str, block_size: int, start: int = 0,
+                         end: Optional[int] = None) -> Iterator[Tuple[int, bytes]]:
+        ranges = self.split_ranges(path, start, end)
+        if len(ranges) < 2:
+            yield from SearchEngine.group_blocks(engine.iter_file_matches(path, start, end), block_size)
+            return
+
+        for _, blocks in self.iter_range_blocks(engine, path, block_size, ranges):
+            yield from blocks
+
+    '''
+    generator yielding the end offset and the blocks of matched lines of every range searched by the worker processes,
+    in file order
+
+    @params ranges: line aligned byte ranges of the log file, see split_ranges
+    '''
+    def iter_range_blocks(self, engine: SearchEngine, path: str, block_size: int,
+                          ranges: List[Tuple[int, int]]) -> Iterator[Tuple[int, List[Tuple[int, bytes]]]]:
+        search_strings = tuple(engine.search_strings)
+        pending = deque()
+        try:
+            for range_start, range_end in ranges:
+                if engine.should_stop():
+                    return
+                # bound the ranges in flight so results of later ranges do not pile up in memory
+                if len(pending) >= 2 * self.workers:
+                    yield self.range_blocks(engine, *pending.popleft())
+                future = self.executor.submit(scan_range, search_strings, path, range_start, range_end, block_size)
+                pending.append((future, range_start, range_end))
+            while pending and not engine.should_stop():
+                yield self.range_blocks(engine, *pending.popleft())
+        finally:
+            # query was abandoned, stopped early or failed, do not waste the workers on its remaining ranges
+            for future, _, _ in pending:
+                future.cancel()
+
+    '''
+    wait for the blocks of matched lines of a range, returned with the end offset of the range
+    '''
+    @staticmethod
+    def range_blocks(engine: SearchEngine, future, range_start: int,
+                     range_end: int) -> Tuple[int, List[Tuple[int, bytes]]]:
+        return range_end, ParallelScanner.range_result(engine, future, range_end - range_start)
+
+    '''
+    count the matched lines of a log file, the ranges are counted by the worker processes without sending any line
+    back. files smaller than two ranges are counted in this process.
+
+    @params engine: engine of the query
+    @params path: path to the log file
+    @params start: offset to start searching at, must be at a line boundary
+    @params end: offset to stop searching at, defaults to the end of the file
+    '''
+    def count_file_matches(self, engine: SearchEngine, path: str, start: int = 0, end: Optional[int] = None) -> int:
+        ranges = self.split_ranges(path, start, end)
+        if len(ranges) < 2:
+            return engine.count_file_matches(path, start, end)
+
+        search_strings = tuple(engine.search_strings)
+        futures = [(self.executor.submit(count_range, search_strings, path, range_start, range_end),
+                    range_end - range_start) for range_start, range_end in ranges]
+        count = 0
+        try:
+            for future, range_size in futures:
+                if engine.should_stop():
+                    break
+                count += self.range_result(engine, future, range_size)
+        finally:
+            for future, _ in futures:
+                future.cancel()
+        return count
+
+    '''
+    wait for the result of a range, only ranges whose result was used count as scanned
+    '''
+    @staticmethod
+    def range_result(engine: SearchEngine, future, range_size: int):
+        result = future.result()
+        engine.bytes_scanned += range_size
+        return result
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False)
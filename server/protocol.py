@@ -0,0 +1,185 @@
+import json
+import struct
+from typing import Dict, List, Optional, Tuple, final
+from compression import Codec, Compression
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class Protocol(object):
+
+    '''
+    Wire format shared by the servers and the client.
+
+    Every message is a frame: a fixed header (protocol version, frame type, request id, payload length) followed by
+    the payload. A client sends a REQUEST frame with the query text, the server answers with any number of BATCH frames
+    carrying matched lines followed by exactly one SUMMARY frame, or a single ERROR frame. All the response frames carry
+    the request id of the query, so many queries can be in flight on a single long-lived connection. A follow query
+    keeps receiving BATCH frames with the lines appended to the log files until the client sends a CANCEL frame with
+    its request id, the server then ends the response with the SUMMARY frame. A CANCEL frame for any other query stops
+    its search, its response ends with the lines matched so far and a SUMMARY frame flagged as partial.
+
+    A server supporting compression opens the connection with a HELLO frame advertising the codecs it supports. Only
+    then a client may send a HELLO frame offering the compression codecs it supports, the server answers with a HELLO
+    frame naming the codec it picked (empty for none). From then on the server compresses the payloads of its frames
+    with that codec, except the ones which are too small to shrink, and flags them in the frame type. A client talking
+    to a server which advertised nothing never offers codecs, and a server never compresses frames for a client which
+    offered none, so both keep exchanging uncompressed frames with peers which do not know about compression.
+    '''
+
+    VERSION: final = 2
+
+    # version, frame type, request id, payload length
+    HEADER: final = struct.Struct('!BBII')
+
+    # upper bound on a single frame payload, protects both sides from corrupt length fields
+    MAX_FRAME_SIZE: final = 64 * 1024 * 1024
+
+    FRAME_REQUEST: final = 1
+    FRAME_BATCH: final = 2
+    FRAME_SUMMARY: final = 3
+    FRAME_ERROR: final = 4
+    FRAME_CANCEL: final = 5
+    FRAME_HELLO: final = 6
+
+    # set in the frame type of frames whose payload is compressed with the codec of the connection
+    COMPRESSED_FLAG: final = 0x80
+
+    # batch payload starts with the number of lines in the batch
+    BATCH_HEADER: final = struct.Struct('!I')
+
+    '''
+    encode a frame of the provided type
+    '''
+    @staticmethod
+    def encode_frame(frame_type: int, request_id: int, payload: bytes) -> bytes:
+        return Protocol.HEADER.pack(Protocol.VERSION, frame_type, request_id, len(payload)) + payload
+
+    '''
+    encode a HELLO frame with comma separated codec names
+    '''
+    @staticmethod
+    def encode_hello(codec_names: List[str]) -> bytes:
+        return Protocol.encode_frame(Protocol.FRAME_HELLO, 0, ','.join(codec_names).encode())
+
+    '''
+    compress the payload of an encoded frame with the codec of a connection, the frame is sent raw without a codec
+    or when its payload does not shrink
+    '''
+    @staticmethod
+    def compress_frame(frame: bytes, codec: Optional[Codec]) -> bytes:
+        if codec is None or len(frame) - Protocol.HEADER.size < Compression.MIN_COMPRESS_SIZE:
+            return frame
+        version, frame_type, request_id, _ = Protocol.HEADER.unpack_from(frame)
+        payload = codec.compress(memoryview(frame)[Protocol.HEADER.size:])
+        if len(payload) >= len(frame) - Protocol.HEADER.size:
+            return frame
+        return Protocol.HEADER.pack(version, frame_type | Protocol.COMPRESSED_FLAG, request_id, len(payload)) + payload
+
+    '''
+    decompress the payload of a received frame if it is flagged as compressed, returns the plain frame type and payload
+    '''
+    @staticmethod
+    def decompress_payload(frame_type: int, payload: bytes, codec: Optional[Codec]) -> Tuple[int, bytes]:
+        if not frame_type & Protocol.COMPRESSED_FLAG:
+            return frame_type, payload
+        if codec is None:
+            raise ProtocolError('compressed frame received before a codec was negotiated')
+        try:
+            return frame_type & ~Protocol.COMPRESSED_FLAG, codec.decompress(payload, Protocol.MAX_FRAME_SIZE)
+        except ValueError as e:
+            raise ProtocolError(f'invalid compressed frame: {e}')
+
+    '''
+    decode a frame header and validate version and payload length
+
+    @params header: HEADER.size bytes read from the stream
+    '''
+    @staticmethod
+    def decode_header(header: bytes) -> Tuple[int, int, int]:
+        version, frame_type, request_id, length = Protocol.HEADER.unpack(header)
+        if version != Protocol.VERSION:
+            raise ProtocolError(f'unsupported protocol version {version}')
+        if length > Protocol.MAX_FRAME_SIZE:
+            raise ProtocolError(f'frame of {length} bytes exceeds maximum frame size')
+        return frame_type, request_id, length
+
+    '''
+    encode a batch of newline terminated lines into a BATCH frame
+
+    @params num_lines: number of lines in the batch
+    @params lines: joined newline terminated lines
+    '''
+    @staticmethod
+    def encode_batch(request_id: int, num_lines: int, lines: bytes) -> bytes:
+        payload = Protocol.BATCH_HEADER.pack(num_lines) + lines
+        return Protocol.encode_frame(Protocol.FRAME_BATCH, request_id, payload)
+
+    '''
+    decode a BATCH frame payload into the line count and the newline terminated lines
+    '''
+    @staticmethod
+    def decode_batch(payload: bytes) -> Tuple[int, bytes]:
+        (num_lines,) = Protocol.BATCH_HEADER.unpack_from(payload)
+        return num_lines, payload[Protocol.BATCH_HEADER.size:]
+
+    '''
+    encode a SUMMARY frame with per file counts, bytes scanned and timing
+    '''
+    @staticmethod
+    def encode_summary(request_id: int, summary: Dict) -> bytes:
+        return Protocol.encode_frame(Protocol.FRAME_SUMMARY, request_id, json.dumps(summary).encode())
+
+    @staticmethod
+    def decode_summary(payload: bytes) -> Dict:
+        return json.loads(payload.decode())
+
+    '''
+    read a single frame from an asyncio stream reader, returns None when the peer closed the connection
+
+    @params codec: codec negotiated for the connection, compressed payloads are decompressed with it
+    '''
+    @staticmethod
+    async def read_frame(reader, codec: Optional[Codec] = None) -> Optional[Tuple[int, int, bytes]]:
+        header = await reader.read(Protocol.HEADER.size)
+        if not header:
+            return None
+        if len(header) < Protocol.HEADER.size:
+            header += await reader.readexactly(Protocol.HEADER.size - len(header))
+        frame_type, request_id, length = Protocol.decode_header(header)
+        payload = await reader.readexactly(length) if length else b''
+        frame_type, payload = Protocol.decompress_payload(frame_type, payload, codec)
+        return frame_type, request_id, payload
+
+
+class FrameDecoder(object):
+
+    '''
+    Incremental decoder for frames received from non-blocking sockets in arbitrary pieces
+
+    @params codec: codec negotiated for the connection, compressed payloads are decompressed with it
+    '''
+    def __init__(self, codec: Optional[Codec] = None) -> None:
+        self.buffer = bytearray()
+        self.codec = codec
+
+    '''
+    add received bytes and return all the frames which are now complete
+    '''
+    def feed(self, data: bytes) -> List[Tuple[int, int, bytes]]:
+        self.buffer += data
+        frames = []
+        offset = 0
+        while len(self.buffer) - offset >= Protocol.HEADER.size:
+            frame_type, request_id, length = Protocol.decode_header(self.buffer[offset:offset + Protocol.HEADER.size])
+            end = offset + Protocol.HEADER.size + length
+            if len(self.buffer) < end:
+                break
+            payload = bytes(self.buffer[offset + Protocol.HEADER.size:end])
+            frame_type, payload = Protocol.decompress_payload(frame_type, payload, self.codec)
+            frames.append((frame_type, request_id, payload))
+            offset = end
+        del self.buffer[:offset]
+        return frames
@@ -0,0 +1,112 @@
+import asyncio
+from collections import OrderedDict, deque
+from typing import Callable, Deque, Dict, Hashable, Optional
+
+
+class QueryScheduler(object):
+
+    '''
+    Limits the number of queries executing at the same time and hands free slots to the waiting clients
+    in round robin order. While other clients have queries waiting, a single client can hold at most half of the
+    slots, so a client sending many expensive queries cannot starve the queries of the other clients. A client alone
+    on the server may use all the slots.
+
+    @params max_concurrent: maximum number of queries executing at the same time
+    '''
+    def __init__(self, max_concurrent: int) -> None:
+        self.max_concurrent = max_concurrent
+        self.max_per_client = max(1, max_concurrent // 2)
+        self.active = 0
+        self.active_per_client: Dict[Hashable, int] = {}
+        # functions starting the waiting queries of every client, clients are served in insertion order
+        self.waiting: Dict[Hashable, Deque[Callable[[], None]]] = OrderedDict()
+
+    def can_run(self, client: Hashable) -> bool:
+        if self.active >= self.max_concurrent:
+            return False
+        return self.active_per_client.get(client, 0) < self.max_per_client or \
+            all(waiting_client == client for waiting_client in self.waiting)
+
+    def grant(self, client: Hashable) -> None:
+        self.active += 1
+        self.active_per_client[client] = self.active_per_client.get(client, 0) + 1
+
+    '''
+    function to run a query of a client once it may execute, start is called right away if the client may use a free
+    slot and by the release of another query otherwise. the query gives up its slot with release when it ends.
+    returns whether the query was started right away.
+
+    @params client: identity of the client the query belongs to
+    @params start: function starting the query, the same function withdraws the query while it waits
+    '''
+    def submit(self, client: Hashable, start: Callable[[], None]) -> bool:
+        if client not in self.waiting and self.can_run(client):
+            self.grant(client)
+            start()
+            return True
+        self.waiting.setdefault(client, deque()).append(start)
+        return False
+
+    '''
+    coroutine to wait until the query of a client may execute, returns False without a slot if stop completed first,
+    e.g. because the client cancelled the query while it was waiting
+
+    @params client: identity of the client the query belongs to
+    @params stop: future completed to stop waiting for a slot
+    '''
+    async def acquire(self, client: Hashable, stop: Optional[asyncio.Future] = None) -> bool:
+        turn = asyncio.get_running_loop().create_future()
+
+        def start() -> None:
+            turn.set_result(None)
+
+        if self.submit(client, start):
+            return True
+        try:
+            await asyncio.wait([turn] if stop is None else [turn, stop], return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            if not self.withdraw(client, start):
+                # slot was handed over just before the cancellation, pass it on
+                self.release(client)
+            raise
+        if turn.done():
+            return True
+        self.withdraw(client, start)
+        return False
+
+    '''
+    function to give up the slot of a finished query and hand the free slots to the next clients in turn
+    '''
+    def release(self, client: Hashable) -> None:
+        self.active -= 1
+        self.active_per_client[client] -= 1
+        if self.active_per_client[client] == 0:
+            del self.active_per_client[client]
+
+        for waiting_client in list(self.waiting):
+            if self.active >= self.max_concurrent:
+                break
+            if waiting_client not in self.waiting or not self.can_run(waiting_client):
+                continue
+            starts = self.waiting.pop(waiting_client)
+            start = starts.popleft()
+            # client goes to the back of the line if it has more queries waiting
+            if starts:
+                self.waiting[waiting_client] = starts
+            self.grant(waiting_client)
+            start()
+
+    '''
+    function to remove a query which is still waiting for a slot, returns whether it was waiting
+    '''
+    def withdraw(self, client: Hashable, start: Callable[[], None]) -> bool:
+        starts = self.waiting.get(client)
+        if starts is None:
+            return False
+        try:
+            starts.remove(start)
+        except ValueError:
+            return False
+        if not starts:
+            del self.waiting[client]
+        return True
@@ -0,0 +1,107 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple, final
+
+
+class CachedResult(object):
+
+    '''
+    Matched lines of a query in the first `size` bytes of a log file
+
+    @params inode: inode of the log file when it was searched
+    @params file_size: size of the log file when it was searched
+    @params mtime: modification time of the log file in ns when it was searched
+    @params size: bytes of the log file covered by the result, always at a line boundary
+    @params fingerprint: hash of the bytes just before `size`, to check the file was only appended to since
+    @params blocks: blocks of matched lines, as (line count, joined lines)
+    '''
+
+    __slots__ = ('inode', 'file_size', 'mtime', 'size', 'fingerprint', 'blocks', 'nbytes')
+
+    def __init__(self, inode: int, file_size: int, mtime: int, size: int, fingerprint: bytes,
+                 blocks: List[Tuple[int, bytes]]) -> None:
+        self.inode = inode
+        self.file_size = file_size
+        self.mtime = mtime
+        self.size = size
+        self.fingerprint = fingerprint
+        self.blocks = blocks
+        self.nbytes = sum(len(lines) for _, lines in blocks)
+
+
+class ResultCache(object):
+
+    '''
+    LRU cache of query results per log file, bounded by the total size of the cached matched lines.
+
+    @params max_bytes: memory budget for the cached matched lines
+    '''
+
+    # bytes hashed before the end of a cached result to detect files which were rewritten instead of appended to
+    FINGERPRINT_SIZE: final = 4096
+
+    # bytes read at once from the end of the file looking for the last complete line
+    TAIL_READ_SIZE: final = 64 * 1024
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        # a single result may not take more than a quarter of the budget, larger results are not cached
+        self.max_entry_bytes = max_bytes // 4
+        self.nbytes = 0
+        # queries run in executor threads
+        self.lock = threading.Lock()
+        self.entries: Dict[Tuple[Tuple[str, ...], str], CachedResult] = OrderedDict()
+
+    '''
+    cache key of a query on a log file, the search strings are OR-ed so their order and duplicates do not matter
+    '''
+    @staticmethod
+    def make_key(search_strings: List[str], log_file: str) -> Tuple[Tuple[str, ...], str]:
+        return tuple(sorted(set(search_strings))), os.path.abspath(log_file)
+
+    def get(self, key) -> Optional[CachedResult]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry: CachedResult) -> None:
+        if entry.nbytes > self.max_entry_bytes:
+            return
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.nbytes -= previous.nbytes
+            self.entries[key] = entry
+            self.nbytes += entry.nbytes
+            # evict least recently used results until the cache fits in the budget again
+            while self.nbytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+    '''
+    hash of the FINGERPRINT_SIZE bytes before an offset of an open log file
+    '''
+    @staticmethod
+    def fingerprint(f, offset: int) -> bytes:
+        start = max(0, offset - ResultCache.FINGERPRINT_SIZE)
+        f.seek(start)
+        return hashlib.sha1(f.read(offset - start)).digest()
+
+    '''
+    offset just past the last complete line of the first `size` bytes of an open log file
+    '''
+    @staticmethod
+    def complete_size(f, size: int) -> int:
+        end = size
+        while end > 0:
+            start = max(0, end - ResultCache.TAIL_READ_SIZE)
+            f.seek(start)
+            newline = f.read(end - start).rfind(b'\n')
+            if newline >= 0:
+                return start + newline + 1
+            end = start
+        return 0
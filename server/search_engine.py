@@ -0,0 +1,281 @@
+import glob
+import mmap
+import os
+import re
+import time
+from typing import Iterator, List, Optional, Tuple, final
+
+try:
+    from re import _parser as sre_parse
+    from re import _constants as sre_constants
+except ImportError:  # python < 3.11
+    import sre_parse
+    import sre_constants
+
+
+class SearchEngine(object):
+
+    '''
+    Compile the OR-ed search strings of a query once into a single regex and search the log files with it, a running
+    search checks between two windows of the file whether it was cancelled or its deadline passed
+
+    @params search_strings: List of search strings or regexes from the user query
+    '''
+
+    # size of the byte ranges read backwards from the end of a file when only its last matches are needed
+    TAIL_RANGE_SIZE: final = 1024 * 1024
+
+    # bytes searched by a single regex call, a running search checks whether it must stop between two of them
+    SCAN_WINDOW_SIZE: final = 4 * 1024 * 1024
+
+    def __init__(self, search_strings: List[str]) -> None:
+        self.search_strings = search_strings
+        # grep -E semantics: a line matches if any of the patterns matches, ^ and $ anchor on line boundaries
+        combined = b'|'.join(b'(?:' + search_string.encode() + b')' for search_string in search_strings)
+        self.regex = re.compile(combined, re.MULTILINE)
+        # total size of the log files scanned by this engine
+        self.bytes_scanned = 0
+        # literal which every line matched by the pattern must contain, one per search string
+        self.literals = [SearchEngine.required_literal(search_string) for search_string in search_strings]
+        # time.time() at which the search stops, None to search until the end
+        self.deadline = None
+        # set by another thread to stop the search, e.g. when the client cancelled the query
+        self.cancelled = False
+        # whether the search stopped before the end, so its matches are partial
+        self.stopped = False
+
+    '''
+    whether the search must stop because the query was cancelled or its deadline passed
+    '''
+    def should_stop(self) -> bool:
+        if self.cancelled or (self.deadline is not None and time.time() >= self.deadline):
+            self.stopped = True
+        return self.stopped
+
+    '''
+    extract the longest literal which every match of a search string must contain,
+    returns empty bytes if the search string has no such literal (e.g. top level alternation)
+    '''
+    @staticmethod
+    def required_literal(search_string: str) -> bytes:
+        pattern = search_string.encode()
+        if re.compile(pattern).flags & re.IGNORECASE:
+            return b''
+
+        longest = b''
+        run = bytearray()
+        # only consecutive literals of the top level concatenation are required,
+        # anything else (classes, repeats, groups, anchors) ends the current run
+        for op, av in sre_parse.parse(pattern):
+            if op is sre_constants.LITERAL:
+                run.append(av)
+                continue
+            if len(run) > len(longest):
+                longest = bytes(run)
+            run = bytearray()
+        if len(run) > len(longest):
+            longest = bytes(run)
+        return longest
+
+    '''
+    expand the configured log path into the list of log files to search.
+    log path can be a single file, a directory or a glob pattern.
+    '''
+    @staticmethod
+    def resolve_log_files(logpath: str) -> List[str]:
+        if os.path.isdir(logpath):
+            return sorted(os.path.join(logpath, name) for name in os.listdir(logpath)
+                          if os.path.isfile(os.path.join(logpath, name)))
+        if glob.has_magic(logpath):
+            return sorted(path for path in glob.glob(logpath) if os.path.isfile(path))
+        return [logpath]
+
+    '''
+    scan a byte range of a buffer and yield the (start, end) offsets of every line which matches the compiled regex,
+    without its newline. The range is searched in line aligned windows of SCAN_WINDOW_SIZE bytes, the scan ends early
+    once the search must stop.
+
+    @params data: buffer to scan (bytes or mmap)
+    @params start: offset of the first byte of the range, must be at a line boundary
+    @params end: offset one past the last byte of the range
+    '''
+    def scan_spans(self, data, start: int, end: int) -> Iterator[Tuple[int, int]]:
+        search = self.regex.search
+        pos = start
+        window_end = start
+        try:
+            while pos < end:
+                if pos >= window_end:
+                    if self.should_stop():
+                        break
+                    window_end = data.find(b'\n', pos + SearchEngine.SCAN_WINDOW_SIZE, end) + 1 or end
+                match = search(data, pos, window_end)
+                if match is None:
+                    pos = window_end
+                    continue
+
+                # widen the match to the line which contains it
+                match_start = match.start()
+                newline = data.rfind(b'\n', pos, match_start)
+                line_start = pos if newline < 0 else newline + 1
+                line_end = data.find(b'\n', match_start, end)
+                line_end = end if line_end < 0 else line_end
+
+                # a match spanning a newline (e.g. a negated character class) is not a match for grep,
+                # so re-check the pattern against the line alone
+                if match.end() <= line_end or search(data, line_start, line_end) is not None:
+                    yield line_start, line_end
+
+                pos = line_end + 1
+        finally:
+            # a query which stopped early only scanned the range up to its last match
+            self.bytes_scanned += min(pos, end) - start
+
+    '''
+    scan a byte range of a buffer and yield every line which matches the compiled regex, see scan_spans
+    '''
+    def scan(self, data, start: int, end: int) -> Iterator[bytes]:
+        for line_start, line_end in self.scan_spans(data, start, end):
+            yield data[line_start:line_end] + b'\n'
+
+    '''
+    scan a byte range of a buffer and return the number of lines which match the compiled regex, no line is copied
+    '''
+    def count_matches(self, data, start: int, end: int) -> int:
+        return sum(1 for _ in self.scan_spans(data, start, end))
+
+    '''
+    single pass over a memory mapped log file yielding all the matched lines
+
+    @params path: path to the log file
+    @params start: offset to start searching at, must be at a line boundary
+    @params end: offset to stop searching at, defaults to the end of the file
+    '''
+    def iter_file_matches(self, path: str, start: int = 0, end: Optional[int] = None) -> Iterator[bytes]:
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            end = size if end is None else min(end, size)
+            # mmap cannot map empty files
+            if end <= start:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                yield from self.scan(data, start, end)
+
+    '''
+    search only the candidate lines of a log file selected by an index, plus the tail of the file
+    which was appended after the index was last updated
+
+    @params path: path to the log file
+    @params spans: sorted (start, end) byte ranges of the candidate lines
+    @params indexed_size: size of the file covered by the index
+    @params end: offset to stop searching at, defaults to the end of the file
+    @params start: offset to start searching at, must be at a line boundary
+    '''
+    def iter_indexed_matches(self, path: str, spans: List[Tuple[int, int]], indexed_size: int,
+                             end: Optional[int] = None, start: int = 0) -> Iterator[bytes]:
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            # file was truncated or rotated since the index was built, the spans are meaningless
+            if size < indexed_size:
+                yield from self.iter_file_matches(path, start, end)
+                return
+            end = size if end is None else min(end, size)
+            if end <= start:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for span_start, span_end in spans:
+                    if span_start < start:
+                        continue
+                    if span_start >= end:
+                        break
+                    yield from self.scan(data, span_start, min(span_end, end))
+                tail_start = max(indexed_size, start)
+                if tail_start < end:
+                    yield from self.scan(data, tail_start, end)
+
+    '''
+    count the matched lines of a memory mapped log file. When spans are given only the candidate lines selected by an
+    index are searched, plus the tail of the file which was appended after the index was last updated.
+
+    @params path: path to the log file
+    @params start: offset to start searching at, must be at a line boundary
+    @params end: offset to stop searching at, defaults to the end of the file
+    @params spans: sorted (start, end) byte ranges of the candidate lines, None to search the whole range
+    @params indexed_size: size of the file covered by the index
+    '''
+    def count_file_matches(self, path: str, start: int = 0, end: Optional[int] = None,
+                           spans: Optional[List[Tuple[int, int]]] = None, indexed_size: int = 0) -> int:
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            # file was truncated or rotated since the index was built, the spans are meaningless
+            if size < indexed_size:
+                spans = None
+            end = size if end is None else min(end, size)
+            # mmap cannot map empty files
+            if end <= start:
+                return 0
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if spans is None:
+                    return self.count_matches(data, start, end)
+                count = 0
+                for span_start, span_end in spans:
+                    if span_start < start:
+                        continue
+                    if span_start >= end:
+                        break
+                    count += self.count_matches(data, span_start, min(span_end, end))
+                tail_start = max(indexed_size, start)
+                if tail_start < end:
+                    count += self.count_matches(data, tail_start, end)
+                return count
+
+    '''
+    search a log file backwards in ranges of TAIL_RANGE_SIZE bytes and return its last matched lines in file order,
+    reading only as much of the end of the file as needed
+
+    @params path: path to the log file
+    @params max_lines: number of matched lines to return from the end of the file
+    '''
+    def tail_file_matches(self, path: str, max_lines: int) -> List[bytes]:
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return []
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                # matched lines of every range, from the last range of the file to the first
+                ranges = []
+                num_lines = 0
+                end = size
+                while end > 0 and num_lines < max_lines:
+                    # move the start of the range back to a line boundary
+                    start = data.rfind(b'\n', 0, max(0, end - SearchEngine.TAIL_RANGE_SIZE)) + 1
+                    lines = list(self.scan(data, start, end))
+                    ranges.append(lines)
+                    num_lines += len(lines)
+                    end = start
+        return [line for lines in reversed(ranges) for line in lines][-max_lines:]
+
+    '''
+    group matched lines into blocks of about block_size bytes, yielding the line count and the joined lines of every
+    block
+    '''
+    @staticmethod
+    def group_blocks(lines: Iterator[bytes], block_size: int) -> Iterator[Tuple[int, bytes]]:
+        block = []
+        size = 0
+        for line in lines:
+            block.append(line)
+            size += len(line)
+            if size >= block_size:
+                yield len(block), b''.join(block)
+                block = []
+                size = 0
+        if block:
+            yield len(block), b''.join(block)
+
+    '''
+    search a single log file and return the match count together with the matched lines
+    '''
+    def search_file(self, path: str) -> Tuple[int, List[bytes]]:
+        lines = list(self.iter_file_matches(path))
+        return len(lines), lines
@@ -0,0 +1,176 @@
+import ast
+import re
+import time
+from typing import List, Optional, Tuple, final
+from aggregation import Aggregation
+from field_query import FieldQuery
+
+
+class SearchQuery(object):
+
+    '''
+    Parsed search query: the OR-ed search strings and the options deciding how much of the result is needed
+
+    @params search_strings: List of search strings or regexes
+    @params mode: MODE_LINES to return matched lines, MODE_COUNT for match counts only,
+                  MODE_EXISTS to only tell whether any line matches, MODE_AGGREGATE for the aggregate only
+    @params limit: maximum number of matched lines returned for all the files together
+    @params head: maximum number of matched lines returned from the beginning of every file
+    @params tail: maximum number of matched lines returned from the end of every file
+    @params time_from: earliest `YYMMDD HHMMSS` timestamp of the matched lines
+    @params time_to: latest `YYMMDD HHMMSS` timestamp of the matched lines
+    @params where: structured query the fields of the matched lines must match
+    @params aggregation: aggregate of the matched lines computed in MODE_AGGREGATE
+    @params follow: whether to keep sending the matched lines appended to the log files instead of searching them
+    @params timeout: seconds after which the search stops and the lines matched so far are returned as partial results
+    '''
+
+    MODE_LINES: final = 'lines'
+    MODE_COUNT: final = 'count'
+    MODE_EXISTS: final = 'exists'
+    MODE_AGGREGATE: final = 'aggregate'
+
+    TIMESTAMP_REGEX: final = re.compile(r'\d{6} \d{6}')
+
+    # start of the field query, which takes the rest of the query
+    WHERE_REGEX: final = re.compile(r'(?:^|\s)where(?:\s|$)', re.IGNORECASE)
+
+    # units of the duration of a `last` time window
+    DURATION_UNITS: final = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+    def __init__(self, search_strings: List[str], mode: str = MODE_LINES, limit: Optional[int] = None,
+                 head: Optional[int] = None, tail: Optional[int] = None, time_from: Optional[str] = None,
+                 time_to: Optional[str] = None, where: Optional[FieldQuery] = None,
+                 aggregation: Optional[Aggregation] = None, follow: bool = False,
+                 timeout: Optional[int] = None) -> None:
+        self.search_strings = search_strings
+        self.mode = mode
+        self.limit = limit
+        self.head = head
+        self.tail = tail
+        self.time_from = time_from
+        self.time_to = time_to
+        self.where = where
+        self.aggregation = aggregation
+        self.follow = follow
+        self.timeout = timeout
+
+    def has_time_window(self) -> bool:
+        return self.time_from is not None or self.time_to is not None
+
+    '''
+    search strings the log files are scanned for. A query with only a field query scans for a literal every line
+    matching it contains (so the token index can select the candidate lines) or matches every line when there is none.
+    '''
+    def engine_search_strings(self) -> List[str]:
+        if self.search_strings:
+            return self.search_strings
+        literal = self.where.required_literal() if self.where is not None else ''
+        return [re.escape(literal)]
+
+    '''
+    whether an option value is a duration of the form <n>s|m|h|d
+    '''
+    @staticmethod
+    def is_duration(text: str) -> bool:
+        return text[:-1].isdigit() and int(text[:-1]) > 0 and text[-1:] in SearchQuery.DURATION_UNITS
+
+    @staticmethod
+    def duration_seconds(text: str) -> int:
+        return int(text[:-1]) * SearchQuery.DURATION_UNITS[text[-1]]
+
+    '''
+    split the search strings list literal from the options following it
+    '''
+    @staticmethod
+    def split_search_strings(text: str) -> Tuple[List[str], str]:
+        # search strings may contain ']' themselves, try every closing bracket until the literal parses
+        end = text.find(']')
+        while end >= 0:
+            try:
+                search_strings = ast.literal_eval(text[:end + 1].strip())
+            except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError):
+                end = text.find(']', end + 1)
+                continue
+            if not isinstance(search_strings, (list, tuple)) or \
+                    not all(isinstance(search_string, str) for search_string in search_strings):
+                raise ValueError('search strings must be a list of strings')
+            return list(search_strings), text[end + 1:]
+        raise ValueError('missing list of search strings')
+
+    '''
+    parse a query of the form search ['<query string 1>', ...] [count | exists | limit <n> | head <n> | tail <n>]
+    [count by <field>[,<field>...] | histogram <n>s|m|h|d | top <k> <field> | distinct <field>]
+    [from <YYMMDD HHMMSS>] [to <YYMMDD HHMMSS>] [last <n>s|m|h|d] [timeout <n>s|m|h|d] [follow] [where <field query>]
+    '''
+    @staticmethod
+    def parse(query: str) -> 'SearchQuery':
+        query_prefix = "search "
+        if not query.startswith(query_prefix):
+            raise ValueError('query must start with search')
+
+        search_strings, options = SearchQuery.split_search_strings(query[len(query_prefix):])
+        search_query = SearchQuery(search_strings)
+
+        # the field query takes the rest of the query, its values may look like options
+        where = SearchQuery.WHERE_REGEX.search(options)
+        if where is not None:
+            search_query.where = FieldQuery(options[where.end():])
+            options = options[:where.start()]
+
+        tokens = options.split()
+        i = 0
+        while i < len(tokens):
+            option = tokens[i].lower()
+            if option == 'count' and i + 2 < len(tokens) and tokens[i + 1].lower() == 'by':
+                search_query.aggregation = Aggregation(Aggregation.KIND_COUNT, tokens[i + 2].lower().split(','))
+                i += 3
+            elif option == 'histogram' and i + 1 < len(tokens) and SearchQuery.is_duration(tokens[i + 1]):
+                search_query.aggregation = Aggregation(Aggregation.KIND_HISTOGRAM, [],
+                                                       interval=SearchQuery.duration_seconds(tokens[i + 1]))
+                i += 2
+            elif option == 'top' and i + 2 < len(tokens) and tokens[i + 1].isdigit() and int(tokens[i + 1]) > 0:
+                search_query.aggregation = Aggregation(Aggregation.KIND_TOP, [tokens[i + 2].lower()],
+                                                       k=int(tokens[i + 1]))
+                i += 3
+            elif option == 'distinct' and i + 1 < len(tokens):
+                search_query.aggregation = Aggregation(Aggregation.KIND_DISTINCT, [tokens[i + 1].lower()])
+                i += 2
+            elif option == 'timeout' and i + 1 < len(tokens) and SearchQuery.is_duration(tokens[i + 1]):
+                search_query.timeout = SearchQuery.duration_seconds(tokens[i + 1])
+                i += 2
+            elif option == 'follow':
+                search_query.follow = True
+                i += 1
+            elif option in (SearchQuery.MODE_COUNT, SearchQuery.MODE_EXISTS):
+                search_query.mode = option
+                i += 1
+            elif option in ('limit', 'head', 'tail') and i + 1 < len(tokens) and tokens[i + 1].isdigit() \
+                    and int(tokens[i + 1]) > 0:
+                setattr(search_query, option, int(tokens[i + 1]))
+                i += 2
+            elif option in ('from', 'to') and i + 2 < len(tokens) and \
+                    SearchQuery.TIMESTAMP_REGEX.fullmatch(f'{tokens[i + 1]} {tokens[i + 2]}'):
+                setattr(search_query, 'time_' + option, f'{tokens[i + 1]} {tokens[i + 2]}')
+                i += 3
+            elif option == 'last' and i + 1 < len(tokens) and SearchQuery.is_duration(tokens[i + 1]):
+                # log timestamps are in the local time of the server
+                duration = SearchQuery.duration_seconds(tokens[i + 1])
+                search_query.time_from = time.strftime('%y%m%d %H%M%S', time.localtime(time.time() - duration))
+                i += 2
+            else:
+                raise ValueError(f'invalid option {tokens[i]}')
+
+        if search_query.follow and (search_query.mode != SearchQuery.MODE_LINES or search_query.aggregation or
+                                    search_query.limit or search_query.head or search_query.tail or
+                                    search_query.timeout):
+            raise ValueError('follow cannot be combined with count, exists, aggregates, limit, head, tail or timeout')
+
+        if search_query.aggregation is not None:
+            # an aggregate needs every matched line
+            if search_query.mode != SearchQuery.MODE_LINES or search_query.limit or search_query.head or \
+                    search_query.tail:
+                raise ValueError('aggregates cannot be combined with count, exists, limit, head or tail')
+            search_query.mode = SearchQuery.MODE_AGGREGATE
+
+        return search_query
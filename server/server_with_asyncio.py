@@ -1,8 +1,20 @@
 import asyncio
+import logging
 import sys
-from utils import Utils
+import time
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 from common import Common
-import os
+from compression import Compression
+from protocol import Protocol, ProtocolError
+from log_follower import LogFollower
+from log_searcher import LogSearcher
+from metrics import QueryTrace, configure_logging
+from query_scheduler import QueryScheduler
+from workers import WorkerSupervisor
+
+logger = logging.getLogger('server')
 
 
 """
@@ -12,14 +24,108 @@ class ServerWithAsyncio :
     # Dictionary to keep track of connected clients
     connected_clients = {}
     
-    # Constructor function to set hostname, port and log file path
-    def __init__(self,hostname, port, log_file):
+    # Constructor function to set hostname, port, log file path and additional server settings
+    def __init__(self,hostname, port, log_file, options: Optional[dict] = None):
         self.hostname = hostname
         self.port = port
         self.log_file = log_file
+        # Own copy of the settings, the caller's dict is never modified
+        self.options = dict(options) if options is not None else {}
+        # Searcher of the log files, created when the server starts
+        self.searcher = None
+        # Queries are executed in a thread pool, at most max_queries at a time
+        max_queries = self.options.get('max_queries', Common.DEFAULT_MAX_QUERIES)
+        self.scheduler = QueryScheduler(max_queries)
+        self.executor = ThreadPoolExecutor(max_workers=max_queries, thread_name_prefix='query')
+        # Lock serializing the frames written to every connected client, follow queries push frames to them too
+        self.write_locks = {}
+        # Compression codec negotiated with every connected client, None for raw frames
+        self.codecs = {}
+        # Task polling the log files for follow queries, only running while clients follow the logs
+        self.follow_task = None
+        # Futures completed to cancel the queries waiting for a free query slot, by writer and request id
+        self.waiting_queries = {}
+
+    """
+    Function run in the executor to search for the next frame of a response and compress it with the codec of the
+    connection, returns None at the end of the response
+    """
+    @staticmethod
+    def next_frame(chunks, codec, trace):
+        with trace.span('scan'):
+            chunk = next(chunks, None)
+        if chunk is None:
+            return None
+        with trace.span('serialize'):
+            return Protocol.compress_frame(chunk, codec)
+
+    """
+    Function to process a single client query and stream the response frames tagged with the request id.
 
+    @params writer: Writer object for connected client
+    @params write_lock: Lock serializing frames of concurrent queries on the same connection
+    @params request_id: Request id of the query as sent by the client
+    @params query: Query text
+    @params client_addr: Address metadata of the connected client
+    @params codec: Compression codec of the connection, None to send raw frames
+    @params received: time.time() at which the request frame arrived, the deadline of the query counts from it
     """
-    Main function to process client query. 
+    async def handle_query_task(self, writer, write_lock, request_id, query, client_addr, codec=None, received=None):
+
+        trace = QueryTrace(self.searcher.metrics)
+        loop = asyncio.get_running_loop()
+
+        # Call function to parse client query, the log files are searched lazily while iterating the response.
+        # The query is registered right away, so it can be cancelled while it waits for a query slot.
+        # Follow queries are subscribed to with the writer, their matches are pushed by follow_logs
+        with trace.span('parse'):
+            return_code, chunks = self.searcher.prepare_search_response(query, request_id, writer, received)
+        self.update_follow_task()
+        # Error responses are printed below, they are small and sent raw
+        if return_code == 1:
+            codec = None
+
+        # Wait for a free query slot, slots are handed to the waiting clients in turn. A query cancelled while
+        # waiting leaves the queue, its response ends right away without a search, so it needs no slot
+        cancelled = loop.create_future()
+        self.waiting_queries[(writer, request_id)] = cancelled
+        try:
+            with trace.span('queue'):
+                admitted = await self.scheduler.acquire(client_addr, cancelled)
+        finally:
+            del self.waiting_queries[(writer, request_id)]
+
+        try:
+            while True:
+                # Search for the next frame in the executor so the event loop keeps serving other clients
+                chunk = await loop.run_in_executor(self.executor, self.next_frame, chunks, codec, trace)
+                if chunk is None:
+                    break
+
+                # If retrun code is error code, send error response to server
+                if return_code == 1:
+                    logger.info("response: %s", chunk[Protocol.HEADER.size:].decode())
+
+                # Add frame with a batch of matched lines to the buffer and wait for the client to
+                # drain it before searching further, so memory stays bounded
+                with trace.span('send'):
+                    async with write_lock:
+                        writer.write(chunk)
+                        await writer.drain()
+                trace.bytes_sent += len(chunk)
+        except ConnectionError as e:
+            logger.warning("failed to send response for request %s to %s: %s", request_id, client_addr, e)
+            return
+        finally:
+            if admitted:
+                self.scheduler.release(client_addr)
+            trace.finish()
+
+        logger.debug("request %s from %s took %s", request_id, client_addr, trace)
+
+    """
+    Main function to read client queries. The connection is kept open across many queries and
+    every query runs in its own task, so several queries can be in flight on one connection.
     
     @params reader: Reader object for connected client
     @params writer: Writer object for connected client
@@ -27,66 +133,142 @@ class ServerWithAsyncio :
     """
     async def handle_client_task(self, reader, writer, client_addr):
 
+        write_lock = asyncio.Lock()
+        self.write_locks[writer] = write_lock
+        # in-flight queries of this connection
+        query_tasks = set()
+        # responses are sent raw until the client negotiated a codec
+        codec = None
+
+        # Advertise the compression codecs of the server, a client only offers its codecs after this
+        try:
+            async with write_lock:
+                writer.write(Protocol.encode_hello(Compression.available()))
+                await writer.drain()
+        except ConnectionError:
+            pass
+
         while True:
-            # Read query from client
-            data = await reader.read(Common.MAX_QUERY_SIZE)
-            # If there is no data, close the connection and exit
-            if data == b'':
-                print("Close the connection")
-                writer.close()
+            # Read request frame from client
+            try:
+                frame = await Protocol.read_frame(reader)
+            except (ProtocolError, asyncio.IncompleteReadError, ConnectionError) as e:
+                logger.warning("invalid request from %s: %s", client_addr, e)
+                break
+            received = time.time()
+
+            # If the client closed the connection, exit
+            if frame is None:
+                break
+
+            frame_type, request_id, payload = frame
+            if frame_type == Protocol.FRAME_HELLO:
+                # Pick the compression codec of the connection from the codecs offered by the client
+                codec = Compression.negotiate(payload.decode())
+                self.codecs[writer] = codec
+                logger.debug("Compressing responses to %s with %s", client_addr, codec.name if codec else 'no codec')
+                try:
+                    async with write_lock:
+                        writer.write(Protocol.encode_hello([codec.name] if codec else []))
+                        await writer.drain()
+                except ConnectionError:
+                    break
+                continue
+            if frame_type == Protocol.FRAME_CANCEL:
+                # Stop searching for a query, the response of a follow query is ended with its summary here
+                summary = self.searcher.cancel(writer, request_id)
+                # A query still waiting for a query slot leaves the queue
+                cancelled = self.waiting_queries.get((writer, request_id))
+                if cancelled is not None and not cancelled.done():
+                    cancelled.set_result(None)
+                self.update_follow_task()
+                logger.debug("Cancelled query %s from %s", request_id, client_addr)
+                if summary is not None:
+                    try:
+                        async with write_lock:
+                            writer.write(Protocol.compress_frame(summary, codec))
+                            await writer.drain()
+                    except ConnectionError:
+                        break
+                continue
+            if frame_type != Protocol.FRAME_REQUEST:
+                logger.warning("unexpected frame type %s from %s", frame_type, client_addr)
                 break
-            
+
             # Decode the query
-            query = data.decode()
-            print(f"Got query from {client_addr}: {query}")
-
-            # Call function to parse client query and prepare the grep command
-            return_code, cmds = Common.prepare_grep_shell_cmds(query, self.log_file)
-            
-            # If retrun code is error code, send error response to server
-            if return_code == 1:
-                print(f"response: {cmds[0].decode()}")
-                writer.write(cmds[0])
-            # If return code is a success code, execute grep command on shell
-            else:
-                output = b''
-
-                # logic to add file names and match count for all the files
-                if os.path.isfile(self.log_file):
-                    output = bytes(self.log_file, 'utf-8')
-                    output += b': '
-                
-                # logic to convert multiple lines grep output to a single line
-                line_count = Utils.execute_shell(cmds[0].decode())
-                if os.path.isfile(self.log_file):
-                    output += line_count
-                    output = output.decode().split('/')[-1]
-                    output = output.strip().encode()
-                    output += b'\n'
-                else:
-                    files = line_count.decode().splitlines()
-                    output += files[0].split('/')[-1].strip().encode()
-                    for file in files[1:]:
-                        output += b','
-                        output += file.split('/')[-1].strip().encode()
-                    output += b'\n'
-                
-                print(f'{output}')
-
-                # Till now, the output contains only the line match counts
-                # Now, we execute another grep command to fetch the actual match lines
-
-                logs = Utils.execute_shell(cmds[1].decode())
-                output += logs
-                print(f"sending {len(output)} bytes")
-
-                # Add output to the buffer
-                writer.write(output)
-
-            # Drain buffer and send the output to the server
-            await writer.drain()
-            # Close the connection
-            writer.close()
+            query = payload.decode()
+            logger.debug("Got query %s from %s: %s", request_id, client_addr, query)
+
+            task = asyncio.create_task(self.handle_query_task(writer, write_lock, request_id, query, client_addr,
+                                                              codec, received))
+            query_tasks.add(task)
+            task.add_done_callback(query_tasks.discard)
+
+        # Stop queries which can no longer be answered and close the connection
+        for task in query_tasks:
+            task.cancel()
+        self.searcher.cancel_all(writer)
+        self.update_follow_task()
+        del self.write_locks[writer]
+        self.codecs.pop(writer, None)
+        logger.debug("Close the connection to %s", client_addr)
+        writer.close()
+
+    """
+    Function to start polling the log files when the first client follows them and to stop polling when the last
+    follow query was cancelled or its client disconnected
+    """
+    def update_follow_task(self):
+        if self.searcher.follower.has_subscriptions():
+            if self.follow_task is None or self.follow_task.done():
+                self.follow_task = asyncio.create_task(self.follow_logs())
+        elif self.follow_task is not None:
+            self.follow_task.cancel()
+            self.follow_task = None
+
+    """
+    Function to poll the log files for appended data while clients follow them and push the matched lines
+    """
+    async def follow_logs(self):
+        loop = asyncio.get_running_loop()
+        follower = self.searcher.follower
+        while follower.has_subscriptions():
+            await asyncio.sleep(LogFollower.POLL_INTERVAL)
+
+            # Read and search the appended data in the executor so the event loop keeps serving other clients
+            frames = await loop.run_in_executor(self.executor, self.poll_follower)
+            frames_per_writer = {}
+            for writer, frame in frames:
+                frames_per_writer.setdefault(writer, []).append(frame)
+            # A slow client does not hold back the pushes to the other clients
+            await asyncio.gather(*(self.push_frames(writer, frames) for writer, frames in frames_per_writer.items()))
+
+    """
+    Function run in the executor to search the data appended to the log files for the follow queries, returns the
+    frames to push compressed with the codecs of their clients
+    """
+    def poll_follower(self):
+        return [(writer, Protocol.compress_frame(frame, self.codecs.get(writer)))
+                for writer, frame in self.searcher.follower.poll()]
+
+    """
+    Function to push the frames of follow queries to a client
+
+    @params writer: Writer object for connected client
+    @params frames: Frames with batches of matched lines
+    """
+    async def push_frames(self, writer, frames):
+        write_lock = self.write_locks.get(writer)
+        # Client disconnected since the poll
+        if write_lock is None:
+            return
+        try:
+            async with write_lock:
+                writer.writelines(frames)
+                await writer.drain()
+        except ConnectionError as e:
+            logger.warning("failed to push follow matches: %s", e)
+            self.searcher.follower.unsubscribe_all(writer)
 
     """
     This function is a callback function and is run as soon as a client connects to the server.
@@ -100,41 +282,70 @@ class ServerWithAsyncio :
         client_addr = writer.get_extra_info('peername')
         # Add client in the connected clients dictionary
         self.connected_clients[client_socket] = client_addr
-        print(self.connected_clients)
+        self.searcher.metrics.adjust('active_connections', 1)
+        self.searcher.metrics.increment('connections')
+        logger.debug("Got a connection from %s, %s clients connected", client_addr, len(self.connected_clients))
 
         # Call function to read and process client query and wait till its complete
-        await self.handle_client_task(reader, writer, client_addr)
-        # After successful completion and disconnection, delete the client from the connected clients dict.
-        del self.connected_clients[client_socket]
-        print(self.connected_clients)
+        try:
+            await self.handle_client_task(reader, writer, client_addr)
+        finally:
+            # After successful completion and disconnection, delete the client from the connected clients dict.
+            del self.connected_clients[client_socket]
+            self.searcher.metrics.adjust('active_connections', -1)
 
     """
     Function to start server
+
+    @params listen_socket: Listening socket of a worker of a server with several worker processes, the server binds
+                           hostname and port itself without it
     """
-    async def start_server(self):
-        # Call asyncio start_server function and provide a callback function, hostname and port
-        server = await asyncio.start_server(
-            self.handle_client, self.hostname, self.port)
+    async def start_server(self, listen_socket=None):
+        # Build or load the token indexes in the background while already serving queries
+        self.searcher = LogSearcher.create(self.log_file, self.options)
+
+        if listen_socket is None:
+            # Call asyncio start_server function and provide a callback function, hostname and port
+            server = await asyncio.start_server(
+                self.handle_client, self.hostname, self.port)
 
-        addrs = ', '.join(str(sock.getsockname()) for sock in server.sockets)
-        print(f'Serving on {addrs}')
+            addrs = ', '.join(str(sock.getsockname()) for sock in server.sockets)
+            logger.info('Serving on %s', addrs)
+        else:
+            # Serve as a worker on the listening socket provided by the supervisor
+            server = await asyncio.start_server(self.handle_client, sock=listen_socket)
+            logger.info("worker %s serving on %s", self.options.get('worker'), listen_socket.getsockname())
 
         # Keep the server running forever and actively listening for client connections
         async with server:
             await server.serve_forever()
 
     
-    def main(self):
+    def main(self, listen_socket=None):
 
         # start server
-        asyncio.run(self.start_server())
+        asyncio.run(self.start_server(listen_socket))
+
+    """
+    Function to serve as one of the worker processes of a server with several workers
+    """
+    @staticmethod
+    def serve_worker(hostname, port, log_file, options, worker_id, listen_socket):
+        worker_options = WorkerSupervisor.worker_options(options, worker_id)
+        ServerWithAsyncio(hostname, port, log_file, worker_options).main(listen_socket)
 
 
 if __name__ == "__main__":
 
     # Parse command line arguments and extract hostname, port and log file path from the user provided values
-    hostname, port, log_file = Common.parse_server_cmdline_args(sys.argv[1:])
-    # Instantiate a server
-    serverObject = ServerWithAsyncio(hostname, port, log_file)
-    # Start the server
-    serverObject.main()
+    hostname, port, log_file, options = Common.parse_server_cmdline_args(sys.argv[1:])
+    configure_logging(options['log_level'], options['workers'] > 1)
+    if options['workers'] > 1:
+        # Start the worker processes, the supervisor restarts the workers which die
+        supervisor = WorkerSupervisor(options['workers'], hostname, port)
+        supervisor.run(partial(ServerWithAsyncio.serve_worker, hostname, port, log_file, options))
+    else:
+        # Instantiate a server
+        serverObject = ServerWithAsyncio(hostname, port, log_file, options)
+        # Start the server
+        serverObject.main()
@@ -1,92 +1,401 @@
 #!/opt/homebrew/bin/python3
 import sys
-import os
+import time
+import logging
+import queue
 import socket
 import selectors
-from typing import List, Tuple
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Deque, Dict, Iterator, List, Optional, Set, Tuple, final
 from selectors import SelectorKey
-from utils import Utils
 from common import Common
+from compression import Codec, Compression
+from protocol import FrameDecoder, Protocol, ProtocolError
+from log_follower import LogFollower
+from log_searcher import LogSearcher
+from metrics import QueryTrace, configure_logging
+from query_scheduler import QueryScheduler
+from workers import WorkerSupervisor
+
+logger = logging.getLogger('server')
+
+
+class ClientConnection(object):
+
+    '''
+    State of a connected client: its partially received request frames, the frames queued for sending and the
+    responses waiting for room in the queue
+
+    @params client_socket: non-blocking socket of the client
+    @params address: address of the client
+    '''
+
+    def __init__(self, client_socket: socket.socket, address) -> None:
+        self.socket = client_socket
+        self.address = address
+        self.decoder = FrameDecoder()
+        # compression codec negotiated with the client, frames are sent raw until then
+        self.codec: Optional[Codec] = None
+        # frames waiting to be sent, the first one may have been sent partially
+        self.output: Deque[memoryview] = deque()
+        self.output_size = 0
+        # events the socket is registered for
+        self.events = selectors.EVENT_READ
+        # responses of the queries of the client which wait for the queued frames to be sent before searching further,
+        # with their traces and the time they were paused at
+        self.paused: Dict[int, Tuple[Iterator[bytes], QueryTrace, float]] = {}
+        # functions starting the queries of the client which wait for a free query slot, by request id
+        self.waiting: Dict[int, Callable[..., None]] = {}
+        # request ids of the queries of the client holding a query slot
+        self.admitted: Set[int] = set()
+        self.closed = False
+
+    def queue(self, frame: bytes) -> None:
+        self.output.append(memoryview(frame))
+        self.output_size += len(frame)
+
+    '''
+    send as much of the queued frames as the socket accepts without blocking, returns whether all of them were sent
+    '''
+    def flush(self) -> bool:
+        while self.output:
+            view = self.output[0]
+            try:
+                sent = self.socket.send(view)
+            except BlockingIOError:
+                return False
+            self.output_size -= sent
+            if sent < len(view):
+                # the rest of the frame is sent once the socket is writable again, slicing does not copy it
+                self.output[0] = view[sent:]
+                return False
+            self.output.popleft()
+        return True
 
 
 class ServerWithSelect(object):
 
+    '''
+    Single threaded selector loop serving all the clients. Queries are searched in a thread pool one frame at a time,
+    every frame found is handed back to the selector loop, which wakes up, queues the frame for its client and sends
+    it when the client socket is writable. A slow client only holds back its own queries. Queries wait for a free
+    query slot of the scheduler before they are searched, slots are handed to the waiting clients in turn.
+    '''
+
+    # bytes queued for a client beyond which its queries wait for the client to read before searching further
+    MAX_OUTPUT_SIZE: final = 4 * 1024 * 1024
+
     def __init__(self) -> None:
-        pass
+        # searcher of the log files, created when the server starts
+        self.searcher = None
+        self.selector = None
+        # thread pool searching the queries and the scheduler of their slots, created when the server starts
+        self.executor = None
+        self.scheduler = None
+        # connected clients by socket
+        self.clients: Dict[socket.socket, ClientConnection] = {}
+        # functions handed to the selector loop by the executor threads
+        self.completions = queue.SimpleQueue()
+        # socket pair waking up the selector loop when the executor threads handed it functions
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
+        # whether the executor is polling the log files for the follow queries
+        self.polling = False
 
     '''
-    function to process requests from user and returns responses
+    function to process requests from user and returns an iterator over response chunks,
+    follow queries are subscribed to with the client socket
+
+    @params received: time.time() at which the request frame arrived, the deadline of the query counts from it
     '''
-    def process_request(self, query: str, log_file: str) -> bytes:
+    def process_request(self, query: str, request_id: int = 0, client_socket: socket.socket = None,
+                        received: Optional[float] = None) -> Iterator[bytes]:
 
-        return_code, cmds = Common.prepare_grep_shell_cmds(query, log_file)
+        return_code, chunks = self.searcher.prepare_search_response(query, request_id, client_socket, received)
         if return_code == 1:
-            print(f"response: {cmds[0].decode()}")
-            return cmds[0]
+            chunks = list(chunks)
+            logger.info("response: %s", chunks[0][Protocol.HEADER.size:].decode())
+            chunks = iter(chunks)
+        return chunks
+
+    '''
+    function to run a function in the selector loop, called by the executor threads
+    '''
+    def complete(self, function: Callable[[], None]) -> None:
+        self.completions.put(function)
+        try:
+            self.wakeup_writer.send(b'\0')
+        except BlockingIOError:
+            # the selector loop has plenty of wake ups pending already
+            pass
+
+    '''
+    function to start searching for a query once it was given a query slot, or without one when it was cancelled while
+    waiting for a slot, its response then ends right away
+
+    @params queued: time.perf_counter() at which the query started waiting for a slot
+    '''
+    def start_query(self, connection: ClientConnection, request_id: int, chunks: Iterator[bytes], trace: QueryTrace,
+                    queued: float, admitted: bool = True) -> None:
+        del connection.waiting[request_id]
+        if admitted:
+            connection.admitted.add(request_id)
+        trace.add('queue', time.perf_counter() - queued)
+        self.submit_search(connection, request_id, chunks, trace)
+
+    '''
+    function to give up the query slot of a query once its response ended
+    '''
+    def finish_query(self, connection: ClientConnection, request_id: int) -> None:
+        if request_id in connection.admitted:
+            connection.admitted.remove(request_id)
+            self.scheduler.release(connection.address)
+
+    '''
+    function to search for the next frame of a response in the executor
+    '''
+    def submit_search(self, connection: ClientConnection, request_id: int, chunks: Iterator[bytes],
+                      trace: QueryTrace) -> None:
+        self.executor.submit(self.search_next_frame, connection, request_id, chunks, trace, time.perf_counter())
+
+    '''
+    function run in an executor thread to search for the next frame of a response and compress it with the codec of
+    the client, None at its end
+
+    @params submitted: time.perf_counter() at which the search was submitted to the executor
+    '''
+    def search_next_frame(self, connection: ClientConnection, request_id: int, chunks: Iterator[bytes],
+                          trace: QueryTrace, submitted: float) -> None:
+        trace.add('queue', time.perf_counter() - submitted)
+        try:
+            with trace.span('scan'):
+                frame = next(chunks, None)
+        except Exception as e:
+            logger.error("search for request %s failed: %s", request_id, e)
+            frame = Protocol.encode_frame(Protocol.FRAME_ERROR, request_id, f"search failed: {e}".encode())
+            chunks = iter([])
+        if frame is not None:
+            with trace.span('serialize'):
+                frame = Protocol.compress_frame(frame, connection.codec)
+        self.complete(partial(self.queue_response_frame, connection, request_id, chunks, trace, frame))
+
+    '''
+    function to queue the frame of a response found by the executor and search for the next one if the client keeps
+    up with reading the response
+    '''
+    def queue_response_frame(self, connection: ClientConnection, request_id: int, chunks: Iterator[bytes],
+                             trace: QueryTrace, frame: bytes) -> None:
+        # the search of a closed connection was cancelled, the rest of its response is not needed
+        if connection.closed or frame is None:
+            self.finish_query(connection, request_id)
+            trace.finish()
+            logger.debug("request %s from %s took %s", request_id, connection.address, trace)
+            return
+        connection.queue(frame)
+        trace.bytes_sent += len(frame)
+        if connection.output_size < ServerWithSelect.MAX_OUTPUT_SIZE:
+            self.submit_search(connection, request_id, chunks, trace)
         else:
-            output = b''
-
-            # logic to add file names and match count for all the files
-            if os.path.isfile(log_file):
-                output = bytes(log_file, 'utf-8')
-                output += b': '
-
-            line_count = Utils.execute_shell(cmds[0].decode())
-            if os.path.isfile(log_file):
-                    output += line_count
-                    output = output.decode().split('/')[-1]
-                    output = output.strip().encode()
-                    output += b'\n'
-            else:
-                files = line_count.decode().splitlines()
-                output += files[0].split('/')[-1].strip().encode()
-                for file in files[1:]:
-                    output += b','
-                    output += file.split('/')[-1].strip().encode()
-                output += b'\n'
-            
-            print(f'{output}')
-
-            logs = Utils.execute_shell(cmds[1].decode())
-            output += logs
-            print(f"sending {len(output)} bytes")
-            return output
+            connection.paused[request_id] = (chunks, trace, time.perf_counter())
+        self.send(connection)
+
+    '''
+    function to send the queued frames of a client, the socket is watched for writability while frames are left
+    '''
+    def send(self, connection: ClientConnection) -> None:
+        try:
+            sent_all = connection.flush()
+        except OSError as e:
+            logger.warning("failed to send to %s: %s", connection.address, e)
+            self.close(connection)
+            return
+
+        events = selectors.EVENT_READ if sent_all else selectors.EVENT_READ | selectors.EVENT_WRITE
+        if events != connection.events:
+            self.selector.modify(connection.socket, events)
+            connection.events = events
+
+        # resume the responses which waited for the client to read, the wait counts as sending
+        if connection.paused and connection.output_size < ServerWithSelect.MAX_OUTPUT_SIZE:
+            for request_id, (chunks, trace, paused) in connection.paused.items():
+                trace.add('send', time.perf_counter() - paused)
+                self.submit_search(connection, request_id, chunks, trace)
+            connection.paused.clear()
+
+    '''
+    function to read the request frames a client sent and start or cancel its queries
+    '''
+    def receive(self, connection: ClientConnection) -> None:
+        try:
+            data = connection.socket.recv(Common.MAX_QUERY_SIZE)
+        except BlockingIOError:
+            return
+        except ConnectionError:
+            # treat a reset connection like a closed one
+            data = b''
+
+        if len(data) == 0:  # empty data indicates that client has closed the connection
+            logger.debug("client %s closed connection", connection.address)
+            self.close(connection)
+            return
+
+        received = time.time()
+        try:
+            frames = connection.decoder.feed(data)
+        except ProtocolError as e:
+            logger.warning("invalid request from %s: %s", connection.address, e)
+            self.close(connection)
+            return
+
+        for frame_type, request_id, payload in frames:
+            if frame_type == Protocol.FRAME_HELLO:
+                # pick the compression codec of the connection from the codecs offered by the client
+                connection.codec = Compression.negotiate(payload.decode())
+                codec_name = connection.codec.name if connection.codec is not None else ''
+                logger.debug("compressing responses to %s with %s", connection.address, codec_name or 'no codec')
+                connection.queue(Protocol.encode_hello([codec_name] if codec_name else []))
+                self.send(connection)
+                continue
+            if frame_type == Protocol.FRAME_CANCEL:
+                # stop a query, the response of a follow query is ended with its summary here
+                summary = self.searcher.cancel(connection.socket, request_id)
+                # a query still waiting for a query slot leaves the queue
+                start = connection.waiting.get(request_id)
+                if start is not None and self.scheduler.withdraw(connection.address, start):
+                    start(admitted=False)
+                if summary is not None:
+                    connection.queue(Protocol.compress_frame(summary, connection.codec))
+                    self.send(connection)
+                continue
+            if frame_type != Protocol.FRAME_REQUEST:
+                logger.warning("unexpected frame type %s from %s", frame_type, connection.address)
+                self.close(connection)
+                return
+            logger.debug("Got query %s from %s: %s", request_id, connection.address, payload)
+            trace = QueryTrace(self.searcher.metrics)
+            # frames with batches of matched lines are sent as the log files are searched
+            with trace.span('parse'):
+                chunks = self.process_request(payload.decode(), request_id, connection.socket, received)
+            start = partial(self.start_query, connection, request_id, chunks, trace, time.perf_counter())
+            connection.waiting[request_id] = start
+            self.scheduler.submit(connection.address, start)
+
+    '''
+    function run in an executor thread to search the data appended to the log files for the follow queries and compress
+    the frames with the codecs of their clients
+    '''
+    def poll_follow_matches(self) -> None:
+        try:
+            frames = []
+            for client_socket, frame in self.searcher.follower.poll():
+                connection = self.clients.get(client_socket)
+                codec = connection.codec if connection is not None else None
+                frames.append((client_socket, Protocol.compress_frame(frame, codec)))
+        except Exception as e:
+            logger.error("failed to poll the log files: %s", e)
+            frames = []
+        self.complete(partial(self.push_follow_matches, frames))
+
+    '''
+    function to queue the matched lines appended to the log files for the following clients
+    '''
+    def push_follow_matches(self, frames: List[Tuple[socket.socket, bytes]]) -> None:
+        self.polling = False
+        connections = set()
+        for client_socket, frame in frames:
+            connection = self.clients.get(client_socket)
+            if connection is not None:
+                connection.queue(frame)
+                connections.add(connection)
+        for connection in connections:
+            self.send(connection)
+
+    '''
+    function to close a client connection and cancel its queries
+    '''
+    def close(self, connection: ClientConnection) -> None:
+        if connection.closed:
+            return
+        logger.debug("closing client connection: %s", connection.address)
+        connection.closed = True
+        self.searcher.metrics.adjust('active_connections', -1)
+        for request_id, (_, trace, _) in connection.paused.items():
+            self.finish_query(connection, request_id)
+            trace.finish()
+        connection.paused.clear()
+        for start in connection.waiting.values():
+            self.scheduler.withdraw(connection.address, start)
+        connection.waiting.clear()
+        # unregister client connection for notifications
+        self.selector.unregister(connection.socket)
+        self.searcher.cancel_all(connection.socket)
+        # remove from stored clients
+        del self.clients[connection.socket]
+        connection.socket.close()
 
     '''
     function to start server on hostname and port
+
+    @params listen_socket: listening socket of a worker of a server with several worker processes, the server binds
+                           hostname and port itself without it
     '''
-    def start(self, hostname, port, log_file):
+    def start(self, hostname, port, log_file, options: Optional[dict] = None,
+              listen_socket: Optional[socket.socket] = None):
 
         server_address = (hostname, port)
+        # own copy of the settings, the caller's dict is never modified
+        options = dict(options) if options is not None else {}
+
+        # build or load the token indexes in the background while already serving queries
+        self.searcher = LogSearcher.create(log_file, options)
+        max_queries = options.get('max_queries', Common.DEFAULT_MAX_QUERIES)
+        self.scheduler = QueryScheduler(max_queries)
+        self.executor = ThreadPoolExecutor(max_workers=max_queries, thread_name_prefix='query')
+
+        if listen_socket is None:
+            # creating socket to listen for requests for searching logs
+            log_query_socket = socket.socket()
 
-        # creating socket to listen for requests for searching logs
-        log_query_socket = socket.socket()
+            log_query_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+            # bind and listen for connections
+            log_query_socket.bind(server_address)
+            log_query_socket.listen()
+            logger.info("Serving on %s", server_address)
+        else:
+            # a worker of a server with several worker processes, listening on the socket the supervisor provided
+            log_query_socket = listen_socket
+            logger.info("worker %s serving on %s", options.get('worker'), server_address)
 
-        log_query_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         # configure socket as non-blocking
         log_query_socket.setblocking(False)
 
-        # bind and listen for connections
-        log_query_socket.bind(server_address)
-        log_query_socket.listen()
-
         # using selector to use OS event notification interface for monitoring events on socket fd
-        selector = selectors.DefaultSelector()
+        self.selector = selectors.DefaultSelector()
 
-        # register log_query_socket for READ events
-        selector.register(log_query_socket, selectors.EVENT_READ)
+        # register log_query_socket and the wake up socket for READ events
+        self.selector.register(log_query_socket, selectors.EVENT_READ)
+        self.selector.register(self.wakeup_reader, selectors.EVENT_READ)
 
-        # dict to track clients
-        clients = {}
+        follower = self.searcher.follower
+        last_poll = time.time()
 
         # main loop for handling requests
         while True:
 
-            # wait for events on registerd socket FDs for 1 second
-            events: List[Tuple[SelectorKey, int]] = selector.select(timeout=1)
+            # wait for events on registerd socket FDs for 1 second, or until the next poll of the log files
+            # while clients follow them
+            timeout = LogFollower.POLL_INTERVAL if follower.has_subscriptions() else 1
+            events: List[Tuple[SelectorKey, int]] = self.selector.select(timeout=timeout)
 
-            if len(events) == 0:  # select timer expired no notifications from socket FDs
-                continue
+            if follower.has_subscriptions() and not self.polling and \
+                    time.time() - last_poll >= LogFollower.POLL_INTERVAL:
+                self.polling = True
+                self.executor.submit(self.poll_follow_matches)
+                last_poll = time.time()
 
             for event, mask in events:
 
@@ -95,37 +404,65 @@ class ServerWithSelect(object):
 
                 if event_socket == log_query_socket:
                     # READ event from server socket must be client connection
-                    client_connection, address = log_query_socket.accept()
+                    try:
+                        client_connection, address = log_query_socket.accept()
+                    except BlockingIOError:
+                        continue
                     # mark client connection as non-blocking
                     client_connection.setblocking(False)
-                    print(f"Got a connection from {address}")
+                    logger.debug("Got a connection from %s", address)
+                    self.searcher.metrics.adjust('active_connections', 1)
+                    self.searcher.metrics.increment('connections')
                     # register client connection for event notification
-                    selector.register(client_connection, selectors.EVENT_READ)
+                    self.selector.register(client_connection, selectors.EVENT_READ)
                     # store the connection details into a dict
-                    clients[client_connection] = address
+                    connection = ClientConnection(client_connection, address)
+                    self.clients[client_connection] = connection
+                    # advertise the compression codecs of the server, a client only offers its codecs after this
+                    connection.queue(Protocol.encode_hello(Compression.available()))
+                    self.send(connection)
+                elif event_socket == self.wakeup_reader:
+                    try:
+                        while self.wakeup_reader.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    # run the functions handed over by the executor threads
+                    while True:
+                        try:
+                            function = self.completions.get_nowait()
+                        except queue.Empty:
+                            break
+                        function()
                 else:
-                    data = event_socket.recv(Common.MAX_QUERY_SIZE)
+                    connection = self.clients.get(event_socket)
+                    # connection was closed by an earlier event
+                    if connection is None:
+                        continue
+                    if mask & selectors.EVENT_WRITE:
+                        self.send(connection)
+                    if mask & selectors.EVENT_READ and not connection.closed:
+                        self.receive(connection)
 
-                    if len(data) > 0:
-                        print(f"Got query from {clients[event_socket]}: {data}")
-                        output = self.process_request(data.decode(), log_file)
-                        Utils.socket_send_bytes(event_socket, output)
-                    else:  # empty data indicates that client has closed the connection
-                        print(f"client {clients[event_socket]} closed connection")
 
-                    print(f"closing client connection: {clients[event_socket]}")
-                    # unregister client connection for notifications
-                    selector.unregister(event_socket)
-                    # remove from stored clients
-                    del clients[event_socket]
-                    # close connection
-                    event_socket.close()
+'''
+function to serve as one of the worker processes of a server with several workers
+'''
+def serve_worker(hostname, port, log_file, options, worker_id: int, listen_socket: socket.socket) -> None:
+    ServerWithSelect().start(hostname=hostname, port=port, log_file=log_file,
+                             options=WorkerSupervisor.worker_options(options, worker_id), listen_socket=listen_socket)
 
 
 if __name__ == "__main__":
 
-    hostname, port, log_file = Common.parse_server_cmdline_args(sys.argv[1:])
+    hostname, port, log_file, options = Common.parse_server_cmdline_args(sys.argv[1:])
+    configure_logging(options['log_level'], options['workers'] > 1)
 
-    server = ServerWithSelect()
+    if options['workers'] > 1:
+        # the supervisor restarts the workers which die
+        WorkerSupervisor(options['workers'], hostname, port).run(partial(serve_worker, hostname, port, log_file,
+                                                                         options))
+    else:
+        server = ServerWithSelect()
 
-    server.start(hostname=hostname, port=port, log_file=log_file)
+        server.start(hostname=hostname, port=port, log_file=log_file, options=options)
@@ -0,0 +1,362 @@
+import logging
+import mmap
+import os
+import queue
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple, final
+from common import Common
+from parallel_scan import ParallelScanner
+from search_engine import SearchEngine
+
+try:
+    from re import _parser as sre_parse
+except ImportError:  # python < 3.11
+    import sre_parse
+
+logger = logging.getLogger(__name__)
+
+
+class ScanMember(object):
+
+    '''
+    A query taking part in a shared scan, its matched lines are split out of the matches of the shared scan. A query
+    which does not take its blocks as fast as the shared scan finds them is detached from the shared scan and searches
+    the rest of the file on its own, so it never holds back the other queries.
+
+    @params engine: engine of the query
+    @params start: offset the shared scan starts searching at
+    '''
+
+    # blocks of matched lines queued for a query, the query is detached from the shared scan beyond
+    MAX_QUEUED_BLOCKS: final = 16
+
+    def __init__(self, engine: SearchEngine, start: int) -> None:
+        self.engine = engine
+        self.start = start
+        # offset of the file up to which all the matched lines were queued for the query
+        self.position = start
+        # lists of blocks of matched lines for the query, ended by None, by the exception which failed the scan or by
+        # the offset the query searches on its own from once it was detached
+        self.blocks = queue.SimpleQueue()
+        # blocks queued and not taken by the query yet, guarded by the lock
+        self.queued = 0
+        self.lock = threading.Lock()
+        # literal prefilter: a line only matches if it contains the literal of one of the search strings,
+        # unless one of them has no literal
+        self.literals = engine.literals if all(engine.literals) else None
+        self.block: List[bytes] = []
+        self.block_size = 0
+        # complete blocks waiting to be queued with the next flush
+        self.ready: List[Tuple[int, bytes]] = []
+        # set once the query takes no more blocks, because it ended, stopped, was detached or was abandoned
+        self.done = False
+        # the groups of the search strings are renumbered in the combined regex of a shared scan, so backreferences
+        # would refer to the groups of other queries: queries with groups are searched on their own
+        self.coalescable = not any(ScanMember.has_groups(search_string) for search_string in engine.search_strings)
+
+    '''
+    whether a search string has capturing groups, backreferences and conditionals need one
+    '''
+    @staticmethod
+    def has_groups(search_string: str) -> bool:
+        try:
+            return sre_parse.parse(search_string.encode()).state.groups > 1
+        except re.error:
+            return False
+
+    def matches(self, line: bytes) -> bool:
+        if self.literals is not None and not any(literal in line for literal in self.literals):
+            return False
+        return self.engine.regex.search(line) is not None
+
+    '''
+    add a matched line, returns whether a complete block waits to be queued
+    '''
+    def add(self, line: bytes) -> bool:
+        self.block.append(line)
+        self.block_size += len(line) + 1
+        if self.block_size >= Common.RESPONSE_CHUNK_SIZE:
+            self.ready.append((len(self.block), b'\n'.join(self.block) + b'\n'))
+            self.block = []
+            self.block_size = 0
+            return True
+        return False
+
+    '''
+    queue the blocks of the matched lines found before position, the query is detached if too many blocks are queued
+    already
+
+    @params position: offset of the file the shared scan searched up to, the current position if not given
+    '''
+    def flush(self, position: Optional[int] = None) -> None:
+        if self.block:
+            self.ready.append((len(self.block), b'\n'.join(self.block) + b'\n'))
+            self.block = []
+            self.block_size = 0
+        if self.ready:
+            with self.lock:
+                # a query is handed at least a single flush, however many blocks it holds
+                full = self.queued > 0 and self.queued + len(self.ready) > ScanMember.MAX_QUEUED_BLOCKS
+                if not full:
+                    self.queued += len(self.ready)
+            if full:
+                self.detach()
+                return
+            self.blocks.put(self.ready)
+            self.ready = []
+        if position is not None:
+            self.position = position
+
+    '''
+    take a list of blocks off the queue of the query
+    '''
+    def taken(self, blocks: List[Tuple[int, bytes]]) -> None:
+        with self.lock:
+            self.queued -= len(blocks)
+
+    '''
+    stop handing matches to a query which fell behind, it searches the file on its own from the last position all
+    its matched lines were queued at
+    '''
+    def detach(self) -> None:
+        logger.debug("query fell behind the shared scan, searching on its own from offset %s", self.position)
+        self.engine.bytes_scanned += self.position - self.start
+        self.done = True
+        self.blocks.put(self.position)
+
+    '''
+    end the blocks of the query, the bytes scanned so far by the shared scan count as scanned by the query
+
+    @params position: offset of the file the shared scan searched up to, see flush
+    '''
+    def finish(self, bytes_scanned: int, position: Optional[int] = None, error: Optional[Exception] = None) -> None:
+        if self.done:
+            return
+        if error is None:
+            self.flush(position)
+            if self.done:
+                return
+        self.engine.bytes_scanned += bytes_scanned
+        self.done = True
+        self.blocks.put(error)
+
+
+class SharedScanEngine(SearchEngine):
+
+    '''
+    Engine of the OR-ed search strings of all the queries of a shared scan, the scan stops once every query stopped
+    '''
+
+    def __init__(self, shared_scan: 'SharedScan') -> None:
+        super().__init__([search_string for member in shared_scan.members
+                          for search_string in member.engine.search_strings])
+        self.shared_scan = shared_scan
+
+    def should_stop(self) -> bool:
+        self.stopped = not self.shared_scan.end_stopped_members(self.bytes_scanned)
+        return self.stopped
+
+
+class SharedScan(object):
+
+    '''
+    A single pass over a part of a log file for the queries which arrived within the coalescing window. The file is
+    searched with the combined regex of all the queries and every matched line is handed to the queries it matches.
+
+    @params log_file: path to the log file
+    @params start: offset to start searching at, must be at a line boundary
+    @params end: offset to stop searching at, None for the end of the file
+    @params scanner: pool of worker processes scanning large files, the file is scanned in process without it
+    '''
+
+    def __init__(self, log_file: str, start: int, end: Optional[int], scanner: Optional[ParallelScanner]) -> None:
+        self.log_file = log_file
+        self.start = start
+        self.end = end
+        self.scanner = scanner
+        self.members: List[ScanMember] = []
+        self.lock = threading.Lock()
+
+    '''
+    add a query to the scan, returns False if its search strings cannot be combined with the ones of the other
+    queries (e.g. global inline flags, groups) and it has to be searched on its own
+    '''
+    def add(self, member: ScanMember) -> bool:
+        if self.members and not (member.coalescable and self.members[0].coalescable):
+            return False
+        search_strings = [search_string for other in self.members for search_string in other.engine.search_strings]
+        try:
+            re.compile(b'|'.join(b'(?:' + search_string.encode() + b')'
+                                 for search_string in search_strings + member.engine.search_strings))
+        except re.error:
+            return False
+        self.members.append(member)
+        return True
+
+    '''
+    end the queries which stopped or were abandoned, returns whether any query still takes matches
+    '''
+    def end_stopped_members(self, bytes_scanned: int) -> bool:
+        with self.lock:
+            active = False
+            for member in self.members:
+                if not member.done and member.engine.should_stop():
+                    member.finish(bytes_scanned)
+                active = active or not member.done
+            return active
+
+    '''
+    run the scan and split the matched lines by query, called by a thread of the coalescer once the coalescing window
+    closed
+    '''
+    def run(self) -> None:
+        engine = SharedScanEngine(self)
+        if len(self.members) > 1:
+            logger.debug("shared scan of %s for %s queries", self.log_file, len(self.members))
+        error = None
+        position = None
+        try:
+            ranges = self.scanner.split_ranges(self.log_file, self.start, self.end) if self.scanner is not None else []
+            if len(ranges) < 2:
+                position = self.scan_file(engine)
+            else:
+                position = self.scan_ranges(engine, ranges)
+        except Exception as e:
+            # the queries fail like a search of their own would
+            error = e
+        finally:
+            with self.lock:
+                for member in self.members:
+                    member.finish(engine.bytes_scanned, position, error)
+
+    '''
+    search the file in this thread, the matched lines are queued for the queries as soon as they fill a block.
+    returns the offset the file was searched up to, None if the scan stopped early.
+    '''
+    def scan_file(self, engine: SearchEngine) -> Optional[int]:
+        with open(self.log_file, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            end = size if self.end is None else min(self.end, size)
+            # mmap cannot map empty files
+            if end <= self.start:
+                return end
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                # every match of the combined regex is a match of the only query
+                single = len(self.members) == 1
+                for line_start, line_end in engine.scan_spans(data, self.start, end):
+                    line = data[line_start:line_end]
+                    for member in self.members:
+                        if not member.done and (single or member.matches(line)) and member.add(line):
+                            member.flush(line_end + 1)
+        return None if engine.stopped else end
+
+    '''
+    search the ranges of the file with the worker processes, the matched lines of every range are queued for the
+    queries once the range was split up. returns the offset the file was searched up to, None if the scan stopped early.
+    '''
+    def scan_ranges(self, engine: SearchEngine, ranges: List[Tuple[int, int]]) -> Optional[int]:
+        single = len(self.members) == 1
+        for range_end, blocks in self.scanner.iter_range_blocks(engine, self.log_file, Common.RESPONSE_CHUNK_SIZE,
+                                                                 ranges):
+            members = [member for member in self.members if not member.done]
+            if not members:
+                return None
+            for _, lines in blocks:
+                for line in lines[:-1].split(b'\n'):
+                    for member in members:
+                        if single or member.matches(line):
+                            member.add(line)
+            for member in members:
+                if not member.done:
+                    member.flush(range_end)
+        return None if engine.stopped else ranges[-1][1]
+
+
+class ScanCoalescer(object):
+
+    '''
+    Coalesces the full scans of the same part of a log file requested by concurrent queries into a single shared scan.
+    The first query opens a coalescing window, the queries arriving until the window closes join its scan. The shared
+    scans run in a bounded pool of threads. A query waiting for the blocks of a shared scan stops waiting once it is
+    cancelled or its deadline passed.
+
+    @params window: seconds the first query of a shared scan waits for other queries to join it
+    @params scanner: pool of worker processes scanning large files, files are scanned in process without it
+    @params max_scans: number of shared scans running at the same time
+    '''
+
+    # seconds a query waits for the next blocks of a shared scan before it checks whether it has to stop
+    POLL_INTERVAL: final = 0.05
+
+    def __init__(self, window: float, scanner: Optional[ParallelScanner] = None,
+                 max_scans: int = Common.DEFAULT_MAX_QUERIES) -> None:
+        self.window = window
+        self.scanner = scanner
+        self.executor = ThreadPoolExecutor(max_workers=max_scans, thread_name_prefix='shared-scan')
+        self.lock = threading.Lock()
+        # shared scans whose window is still open by log file, byte range and whether they may scan in parallel
+        self.open_scans: Dict[Tuple[str, int, Optional[int], bool], SharedScan] = {}
+
+    '''
+    generator yielding blocks of matched lines of a part of a log file for a query, taken from a shared scan
+
+    @params start: offset to start searching at, must be at a line boundary
+    @params end: offset to stop searching at, defaults to the end of the file
+    @params parallel: whether large files may be scanned by the worker processes
+    '''
+    def iter_file_blocks(self, engine: SearchEngine, log_file: str, start: int = 0, end: Optional[int] = None,
+                         parallel: bool = True) -> Iterator[Tuple[int, bytes]]:
+        member = ScanMember(engine, start)
+        key = (log_file, start, end, parallel and self.scanner is not None)
+        with self.lock:
+            shared_scan = self.open_scans.get(key)
+            if shared_scan is None or not shared_scan.add(member):
+                shared_scan = SharedScan(log_file, start, end, self.scanner if key[3] else None)
+                shared_scan.add(member)
+                if member.coalescable:
+                    self.open_scans[key] = shared_scan
+                    closes = time.monotonic() + self.window
+                else:
+                    # no other query joins the scan, there is nothing to wait for
+                    closes = time.monotonic()
+                self.executor.submit(self.run_scan, key, shared_scan, closes)
+        try:
+            while True:
+                try:
+                    item = member.blocks.get(timeout=ScanCoalescer.POLL_INTERVAL)
+                except queue.Empty:
+                    # a cancelled or timed out query does not wait for the shared scan to get to it
+                    if engine.should_stop():
+                        return
+                    continue
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                if isinstance(item, int):
+                    # the query fell behind the shared scan and searches the rest of the file on its own
+                    if key[3]:
+                        yield from self.scanner.iter_file_blocks(engine, log_file, Common.RESPONSE_CHUNK_SIZE, item,
+                                                                 end)
+                    else:
+                        yield from SearchEngine.group_blocks(engine.iter_file_matches(log_file, item, end),
+                                                             Common.RESPONSE_CHUNK_SIZE)
+                    return
+                member.taken(item)
+                yield from item
+        finally:
+            # the query was abandoned (e.g. limit reached), the shared scan stops handing it matches
+            member.done = True
+
+    '''
+    close the window of a shared scan at the given time.monotonic() and run it
+    '''
+    def run_scan(self, key: Tuple[str, int, Optional[int], bool], shared_scan: SharedScan, closes: float) -> None:
+        time.sleep(max(0.0, closes - time.monotonic()))
+        with self.lock:
+            if self.open_scans.get(key) is shared_scan:
+                del self.open_scans[key]
+        shared_scan.run()
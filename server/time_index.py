@@ -0,0 +1,148 @@
+import bisect
+import mmap
+import os
+import re
+import threading
+from array import array
+from typing import Iterator, List, Optional, Tuple, final
+
+
+class TimeIndex(object):
+
+    '''
+    Sparse index of a log file mapping the timestamps of sampled lines to their byte offsets, so a time window can be
+    turned into the byte range of the file to search with a binary search. Log lines start with a `YYMMDD HHMMSS`
+    timestamp which orders correctly as bytes. The index is built lazily by the first time window query and extended
+    as the file grows.
+
+    @params log_file: path to the indexed log file
+    '''
+
+    TIMESTAMP_REGEX: final = re.compile(rb'\d{6} \d{6}')
+
+    # bytes between two sampled lines, a time window search reads at most this much outside the window on each side
+    SAMPLE_INTERVAL: final = 256 * 1024
+
+    # bytes searched after a sampling point for a line starting with a timestamp
+    MAX_SAMPLE_SEARCH: final = 64 * 1024
+
+    def __init__(self, log_file: str) -> None:
+        self.log_file = log_file
+        # queries of the same file extend the index from executor threads
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        self.inode = None
+        self.file_size = 0
+        # timestamps of the sampled lines, made non decreasing, and the offsets of the lines
+        self.timestamps: List[bytes] = []
+        self.offsets = array('Q')
+        # offset the next sample is taken at
+        self.next_sample = 0
+
+    '''
+    timestamp of the line starting at an offset of a buffer, None if the line does not start with one
+    '''
+    @staticmethod
+    def line_timestamp(data, offset: int) -> Optional[bytes]:
+        match = TimeIndex.TIMESTAMP_REGEX.match(data, offset)
+        return match.group() if match is not None else None
+
+    '''
+    bring the index up to date with the log file, sampling only the data appended since the last update
+    '''
+    def update(self) -> None:
+        with open(self.log_file, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            # log file was rotated or truncated: start over
+            if stat.st_ino != self.inode or stat.st_size < self.file_size:
+                self.reset()
+                self.inode = stat.st_ino
+            self.file_size = stat.st_size
+            if self.next_sample >= stat.st_size:
+                return
+
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                pos = self.next_sample
+                while pos < stat.st_size:
+                    # first line starting with a timestamp after the sampling point, skipping continuation lines
+                    line_start = TimeIndex.next_line(data, pos, stat.st_size)
+                    timestamp = None
+                    while 0 <= line_start < stat.st_size and line_start - pos <= TimeIndex.MAX_SAMPLE_SEARCH:
+                        timestamp = TimeIndex.line_timestamp(data, line_start)
+                        if timestamp is not None:
+                            break
+                        line_start = TimeIndex.next_line(data, line_start + 1, stat.st_size)
+                    if timestamp is None:
+                        # rest of the file is a partially written line, sample it again later
+                        if not 0 <= line_start < stat.st_size:
+                            break
+                        pos = line_start
+                        self.next_sample = pos
+                        continue
+
+                    # lines slightly out of order must not break the binary search
+                    if self.timestamps and timestamp < self.timestamps[-1]:
+                        timestamp = self.timestamps[-1]
+                    self.timestamps.append(timestamp)
+                    self.offsets.append(line_start)
+                    pos = line_start + TimeIndex.SAMPLE_INTERVAL
+                    self.next_sample = pos
+
+    '''
+    offset of the first line starting at or after an offset, -1 if no line starts there before the end
+    '''
+    @staticmethod
+    def next_line(data, offset: int, end: int) -> int:
+        if offset == 0 or data[offset - 1] == ord('\n'):
+            return offset
+        newline = data.find(b'\n', offset, end)
+        return newline + 1 if newline >= 0 else -1
+
+    '''
+    byte range (start, end) of the log file holding the lines of a time window, end is None for the end of the file
+
+    @params time_from: earliest timestamp of the window, None for no lower bound
+    @params time_to: latest timestamp of the window, None for no upper bound
+    '''
+    def byte_range(self, time_from: Optional[bytes], time_to: Optional[bytes]) -> Tuple[int, Optional[int]]:
+        with self.lock:
+            self.update()
+            start = 0
+            if time_from is not None:
+                # last sampled line before the window, lines after it may belong to the window
+                sample = bisect.bisect_left(self.timestamps, time_from) - 1
+                if sample >= 0:
+                    start = self.offsets[sample]
+            end = None
+            if time_to is not None:
+                # first sampled line after the window, no line after it belongs to the window
+                sample = bisect.bisect_right(self.timestamps, time_to)
+                if sample < len(self.timestamps):
+                    end = self.offsets[sample]
+            return start, end
+
+    '''
+    whether a line lies in a time window, lines without a timestamp (e.g. stack traces) are kept
+    '''
+    @staticmethod
+    def in_window(line: bytes, time_from: Optional[bytes], time_to: Optional[bytes]) -> bool:
+        timestamp = TimeIndex.line_timestamp(line, 0)
+        if timestamp is None:
+            return True
+        return (time_from is None or timestamp >= time_from) and (time_to is None or timestamp <= time_to)
+
+    '''
+    generator dropping the matched lines outside a time window from blocks of matched lines
+    '''
+    @staticmethod
+    def filter_blocks(blocks: Iterator[Tuple[int, bytes]], time_from: Optional[bytes],
+                      time_to: Optional[bytes]) -> Iterator[Tuple[int, bytes]]:
+        try:
+            for _, lines in blocks:
+                kept = [line for line in lines[:-1].split(b'\n') if TimeIndex.in_window(line, time_from, time_to)]
+                if kept:
+                    yield len(kept), b'\n'.join(kept) + b'\n'
+        finally:
+            blocks.close()
@@ -0,0 +1,464 @@
+import atexit
+import hashlib
+import json
+import logging
+import os
+import re
+import struct
+import threading
+import time
+from array import array
+from typing import Dict, Iterator, List, Optional, Tuple, final
+from compressed_log import CompressedLog
+from search_engine import SearchEngine
+
+logger = logging.getLogger(__name__)
+
+
+class TokenIndex(object):
+
+    '''
+    Inverted index of a single log file mapping tokens (block ids, IPs, component names, levels, ...)
+    to the numbers of the lines containing them.
+
+    The index file holds only data: the line offsets, the number of lines of every token and the concatenated line
+    numbers of all the tokens as arrays, the newline separated tokens, and a JSON header locating them.
+
+    @params log_file: path to the indexed log file
+    @params index_path: path of the file the index is persisted to
+    '''
+
+    MAGIC: final = b'TOKIDX03'
+
+    FORMAT_VERSION: final = 3
+
+    # tokens are maximal runs of these characters,
+    # e.g. blk_-6952295868487656571, 10.251.73.220, dfs.DataNode$PacketResponder
+    TOKEN_REGEX: final = re.compile(rb'[A-Za-z0-9_.$-]+')
+
+    # literals shorter than this match too many tokens for the index to pay off
+    MIN_LITERAL_SIZE: final = 3
+
+    # above this fraction of candidate lines a sequential scan is cheaper than jumping between lines
+    MAX_CANDIDATE_FRACTION: final = 0.05
+
+    # bytes hashed from the start of the file to detect files replaced in place
+    FINGERPRINT_SIZE: final = 4096
+
+    # bytes of the log file read and indexed at once
+    CHUNK_SIZE: final = 8 * 1024 * 1024
+
+    def __init__(self, log_file: str, index_path: str) -> None:
+        self.log_file = log_file
+        self.index_path = index_path
+        # guards the index structures shared between the indexing thread and queries
+        self.lock = threading.Lock()
+        self.reset()
+        # inode of the log file and indexed size of the persisted index, None if the index has not been persisted
+        self.persisted: Optional[Tuple[Optional[int], int]] = None
+        # time the index was last persisted or loaded
+        self.saved_at = 0.0
+
+    '''
+    drop all the indexed data
+    '''
+    def reset(self) -> None:
+        self.inode = None
+        self.fingerprint = b''
+        # size of a compressed log file when it was indexed, 0 for plain log files
+        self.compressed_size = 0
+        # file size covered by the index, always at a line boundary (decompressed size for compressed log files)
+        self.indexed_size = 0
+        # start offset of every indexed line
+        self.line_offsets = array('Q')
+        self.postings: Dict[bytes, array] = {}
+        # all the tokens separated by newlines, searched for tokens containing a literal
+        self.vocabulary = None
+
+    '''
+    load a persisted index, returns False if there is none or it cannot be used
+    '''
+    def load(self) -> bool:
+        try:
+            with open(self.index_path, 'rb') as f:
+                data = f.read()
+            if data[:len(TokenIndex.MAGIC)] != TokenIndex.MAGIC:
+                return False
+            header_offset, = struct.unpack_from('<Q', data, len(data) - 8)
+            header = json.loads(data[header_offset:len(data) - 8])
+            if header['version'] != TokenIndex.FORMAT_VERSION:
+                return False
+
+            sections = header['sections']
+            line_offsets = TokenIndex.read_array(data, 'Q', sections['line_offsets'], header['num_lines'])
+            counts = TokenIndex.read_array(data, 'Q', sections['counts'], header['num_tokens'])
+            tokens = data[sections['tokens']:header_offset].split(b'\n') if counts else []
+            if len(tokens) != len(counts):
+                raise ValueError('the tokens do not match their line counts')
+            postings = {}
+            offset = sections['postings']
+            for token, count in zip(tokens, counts):
+                postings[token] = TokenIndex.read_array(data, 'I', offset, count)
+                offset += count * postings[token].itemsize
+            if offset > sections['tokens']:
+                raise ValueError('the line numbers overlap the tokens')
+            fingerprint = bytes.fromhex(header['fingerprint'])
+        except (OSError, ValueError, KeyError, TypeError, struct.error):
+            return False
+
+        with self.lock:
+            self.inode = header['inode']
+            self.fingerprint = fingerprint
+            self.compressed_size = header['compressed_size']
+            self.indexed_size = header['indexed_size']
+            self.line_offsets = line_offsets
+            self.postings = postings
+            self.vocabulary = None
+            self.persisted = (self.inode, self.indexed_size)
+        self.saved_at = time.time()
+        return True
+
+    '''
+    array of count values of a typecode stored at an offset of the data of an index file
+    '''
+    @staticmethod
+    def read_array(data: bytes, typecode: str, offset: int, count: int) -> array:
+        values = array(typecode)
+        end = offset + count * values.itemsize
+        if offset < 0 or count < 0 or end > len(data):
+            raise ValueError('truncated index file')
+        values.frombytes(memoryview(data)[offset:end])
+        return values
+
+    '''
+    persist the index atomically next to the previous version
+    '''
+    def save(self) -> None:
+        with self.lock:
+            tokens = list(self.postings)
+            header = {
+                'version': TokenIndex.FORMAT_VERSION,
+                'inode': self.inode,
+                'fingerprint': self.fingerprint.hex(),
+                'compressed_size': self.compressed_size,
+                'indexed_size': self.indexed_size,
+                'num_lines': len(self.line_offsets),
+                'num_tokens': len(tokens),
+                'sections': {},
+            }
+            sections = header['sections']
+            tmp_path = self.index_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(TokenIndex.MAGIC)
+                sections['line_offsets'] = f.tell()
+                self.line_offsets.tofile(f)
+                sections['counts'] = f.tell()
+                array('Q', (len(self.postings[token]) for token in tokens)).tofile(f)
+                sections['postings'] = f.tell()
+                for token in tokens:
+                    self.postings[token].tofile(f)
+                sections['tokens'] = f.tell()
+                f.write(b'\n'.join(tokens))
+                header_offset = f.tell()
+                f.write(json.dumps(header).encode())
+                f.write(struct.pack('<Q', header_offset))
+            persisted = (self.inode, self.indexed_size)
+        os.replace(tmp_path, self.index_path)
+        self.persisted = persisted
+        self.saved_at = time.time()
+
+    '''
+    whether the index changed enough since it was persisted to be worth rewriting: it was never persisted, it was
+    rebuilt for a rotated or rewritten log file, or at least MIN_SAVE_SIZE bytes were indexed since
+    '''
+    def needs_save(self, min_size: int) -> bool:
+        if self.persisted is None:
+            return True
+        inode, indexed_size = self.persisted
+        return inode != self.inode or self.indexed_size < indexed_size or self.indexed_size - indexed_size >= min_size
+
+    '''
+    whether the index belongs to the current log file, e.g. after loading an index persisted by another process
+    '''
+    def matches_log_file(self) -> bool:
+        with open(self.log_file, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            fingerprint = hashlib.sha1(f.read(TokenIndex.FINGERPRINT_SIZE)).digest()
+        if stat.st_ino != self.inode:
+            return False
+        if self.compressed_size:
+            return stat.st_size == self.compressed_size and fingerprint == self.fingerprint
+        return stat.st_size >= self.indexed_size and \
+            (self.indexed_size < TokenIndex.FINGERPRINT_SIZE or fingerprint == self.fingerprint)
+
+    '''
+    bring the index up to date with the log file, indexing only the lines appended since the last update.
+    returns True if the index changed.
+    '''
+    def update(self) -> bool:
+        if CompressedLog.detect_format(self.log_file) is not None:
+            return self.update_compressed()
+
+        with open(self.log_file, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            fingerprint = hashlib.sha1(f.read(TokenIndex.FINGERPRINT_SIZE)).digest()
+
+            # log file was rotated, truncated or rewritten: start over
+            changed = stat.st_ino != self.inode or stat.st_size < self.indexed_size or \
+                (self.indexed_size >= TokenIndex.FINGERPRINT_SIZE and fingerprint != self.fingerprint)
+            if changed:
+                with self.lock:
+                    self.reset()
+                    self.inode = stat.st_ino
+
+            # read the appended data in bounded chunks, only complete lines are indexed,
+            # a partially written last line is indexed by a later update
+            f.seek(self.indexed_size)
+            while self.indexed_size < stat.st_size:
+                data = f.read(min(TokenIndex.CHUNK_SIZE, stat.st_size - self.indexed_size))
+                end = data.rfind(b'\n') + 1
+                if end == 0:
+                    break
+                self.add_lines(data[:end - 1])
+                f.seek(self.indexed_size)
+                changed = True
+
+            self.fingerprint = fingerprint
+
+        return changed
+
+    '''
+    index a compressed log file in a single pass over its decompressed lines. compressed rotations are not appended
+    to, the index is only rebuilt when the file was replaced or had not been fully written yet.
+    '''
+    def update_compressed(self) -> bool:
+        with open(self.log_file, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            fingerprint = hashlib.sha1(f.read(TokenIndex.FINGERPRINT_SIZE)).digest()
+
+        if stat.st_ino == self.inode and stat.st_size == self.compressed_size and fingerprint == self.fingerprint:
+            return False
+
+        with self.lock:
+            self.reset()
+            self.inode = stat.st_ino
+        for data in CompressedLog(self.log_file, stat).iter_chunks():
+            # only the last line of the file may lack its newline
+            self.add_lines(data[:-1] if data.endswith(b'\n') else data)
+        self.compressed_size = stat.st_size
+        self.fingerprint = fingerprint
+        return True
+
+    '''
+    index newline separated lines starting at the end of the indexed part of the file
+    '''
+    def add_lines(self, data: bytes) -> None:
+        line_offsets = array('Q')
+        postings: Dict[bytes, array] = {}
+        findall = TokenIndex.TOKEN_REGEX.findall
+        offset = self.indexed_size
+        for line_number, line in enumerate(data.split(b'\n'), len(self.line_offsets)):
+            line_offsets.append(offset)
+            offset += len(line) + 1
+            for token in set(findall(line)):
+                lines = postings.get(token)
+                if lines is None:
+                    postings[token] = array('I', (line_number,))
+                else:
+                    lines.append(line_number)
+
+        # merge the new postings while holding the lock so queries never see half updated lists
+        with self.lock:
+            self.line_offsets.extend(line_offsets)
+            for token, lines in postings.items():
+                existing = self.postings.get(token)
+                if existing is None:
+                    self.postings[token] = lines
+                else:
+                    existing.extend(lines)
+            self.indexed_size = offset
+            self.vocabulary = None
+
+    '''
+    join all the indexed tokens into a single buffer searched for tokens containing a literal
+    '''
+    def build_vocabulary(self) -> None:
+        self.vocabulary = b'\n' + b'\n'.join(self.postings) + b'\n'
+
+    '''
+    generator yielding all the indexed tokens containing a literal
+    '''
+    def tokens_containing(self, literal: bytes) -> Iterator[bytes]:
+        if self.vocabulary is None:
+            self.build_vocabulary()
+        vocabulary = self.vocabulary
+
+        pos = vocabulary.find(literal)
+        while pos >= 0:
+            token_start = vocabulary.rfind(b'\n', 0, pos) + 1
+            token_end = vocabulary.find(b'\n', pos)
+            yield vocabulary[token_start:token_end]
+            pos = vocabulary.find(literal, token_end)
+
+    '''
+    select the candidate lines which may match a query, given the literal required by every search string.
+    returns None if the index cannot narrow down the search, otherwise the sorted (start, end) byte ranges
+    of the candidate lines and the size of the file covered by the index.
+    '''
+    def candidate_spans(self, literals: List[bytes]) -> Optional[Tuple[List[Tuple[int, int]], int]]:
+        pieces = []
+        for literal in literals:
+            # a line containing the literal contains the literal's longest token piece inside one of its tokens
+            tokens = TokenIndex.TOKEN_REGEX.findall(literal)
+            piece = max(tokens, key=len) if tokens else b''
+            if len(piece) < TokenIndex.MIN_LITERAL_SIZE:
+                return None
+            pieces.append(piece)
+
+        with self.lock:
+            num_lines = len(self.line_offsets)
+            if num_lines == 0:
+                return None
+
+            max_candidates = num_lines * TokenIndex.MAX_CANDIDATE_FRACTION
+            candidates = set()
+            for piece in pieces:
+                for token in self.tokens_containing(piece):
+                    candidates.update(self.postings[token])
+                    if len(candidates) > max_candidates:
+                        return None
+
+            spans = []
+            for line_number in sorted(candidates):
+                start = self.line_offsets[line_number]
+                end = self.line_offsets[line_number + 1] if line_number + 1 < num_lines else self.indexed_size
+                spans.append((start, end))
+            return spans, self.indexed_size
+
+
+class LogIndexer(object):
+
+    '''
+    Builds the token indexes of all the log files in the background, loads persisted indexes at startup
+    and keeps them up to date as the log files grow.
+
+    @params logpath: log file, directory or glob pattern served by the server
+    @params index_dir: directory the indexes are persisted to
+    @params read_only: only load the indexes persisted by another process (e.g. another server worker) whenever they
+                       change, instead of building them
+    '''
+
+    # seconds between checks of the log files for appended data
+    REFRESH_INTERVAL: final = 5.0
+
+    # bytes of the log file indexed since the index was persisted which are worth rewriting the whole index file at
+    # once, smaller appends are persisted SAVE_INTERVAL seconds after the index was last persisted
+    MIN_SAVE_SIZE: final = 16 * 1024 * 1024
+
+    # seconds an update of the index may stay unpersisted, bounding how stale the indexes loaded by the other server
+    # workers get when the indexing worker is killed without running its exit handlers
+    SAVE_INTERVAL: final = 30.0
+
+    def __init__(self, logpath: str, index_dir: str, read_only: bool = False) -> None:
+        self.logpath = logpath
+        self.index_dir = index_dir
+        self.read_only = read_only
+        self.indexes: Dict[str, TokenIndex] = {}
+        # modification times of the index files loaded by a read only indexer
+        self.loaded: Dict[str, int] = {}
+        # indexes which finished their first build and can be used by queries
+        self.ready: Dict[str, TokenIndex] = {}
+
+    '''
+    start the background indexing thread
+    '''
+    def start(self) -> None:
+        os.makedirs(self.index_dir, exist_ok=True)
+        if not self.read_only:
+            atexit.register(self.save_all)
+        thread = threading.Thread(target=self.run, name='log-indexer', daemon=True)
+        thread.start()
+
+    '''
+    persist the indexes which changed since they were last persisted, called when the server exits
+    '''
+    def save_all(self) -> None:
+        for log_file, index in list(self.indexes.items()):
+            try:
+                if index.needs_save(1):
+                    index.save()
+            except OSError as e:
+                logger.warning('failed to persist the index of %s: %s', log_file, e)
+
+    '''
+    path of the persisted index of a log file
+    '''
+    def index_path(self, log_file: str) -> str:
+        digest = hashlib.sha1(os.path.abspath(log_file).encode()).hexdigest()[:12]
+        return os.path.join(self.index_dir, f'{os.path.basename(log_file)}.{digest}.idx')
+
+    '''
+    index all the log files once
+    '''
+    def refresh(self) -> None:
+        for log_file in SearchEngine.resolve_log_files(self.logpath):
+            index = self.indexes.get(log_file)
+            if index is None:
+                index = TokenIndex(log_file, self.index_path(log_file))
+                index.load()
+                self.indexes[log_file] = index
+            try:
+                begin = time.time()
+                if index.update():
+                    # build the vocabulary here rather than in the first query after the update
+                    with index.lock:
+                        index.build_vocabulary()
+                    logger.info('indexed %s up to %s bytes in %s seconds', log_file, index.indexed_size,
+                                time.time() - begin)
+                if index.needs_save(LogIndexer.MIN_SAVE_SIZE) or \
+                        (index.needs_save(1) and time.time() - index.saved_at >= LogIndexer.SAVE_INTERVAL):
+                    index.save()
+                self.ready[log_file] = index
+            except OSError as e:
+                logger.warning('failed to index %s: %s', log_file, e)
+                self.ready.pop(log_file, None)
+
+    '''
+    load the indexes persisted by the indexing process once more if they changed since they were last loaded
+    '''
+    def reload(self) -> None:
+        for log_file in SearchEngine.resolve_log_files(self.logpath):
+            index_path = self.index_path(log_file)
+            try:
+                mtime = os.stat(index_path).st_mtime_ns
+                if self.loaded.get(log_file) != mtime:
+                    index = TokenIndex(log_file, index_path)
+                    if index.load():
+                        with index.lock:
+                            index.build_vocabulary()
+                        self.indexes[log_file] = index
+                    else:
+                        self.indexes.pop(log_file, None)
+                    self.loaded[log_file] = mtime
+                index = self.indexes.get(log_file)
+                # the index is not used until the indexing process caught up with a rotated or rewritten log file
+                if index is not None and index.matches_log_file():
+                    self.ready[log_file] = index
+                else:
+                    self.ready.pop(log_file, None)
+            except OSError:
+                self.ready.pop(log_file, None)
+
+    def run(self) -> None:
+        while True:
+            if self.read_only:
+                self.reload()
+            else:
+                self.refresh()
+            time.sleep(LogIndexer.REFRESH_INTERVAL)
+
+    '''
+    index of a log file if it is ready to be used by queries
+    '''
+    def get_index(self, log_file: str) -> Optional[TokenIndex]:
+        return self.ready.get(log_file)
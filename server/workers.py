@@ -0,0 +1,132 @@
+import logging
+import multiprocessing
+import signal
+import socket
+import time
+from multiprocessing.connection import wait
+from typing import Callable, Dict, Optional, final
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerSupervisor(object):
+
+    '''
+    Runs a server in a number of worker processes sharing its port and restarts the workers which die. With
+    SO_REUSEPORT every worker listens on a socket of its own and the kernel spreads the connections across them,
+    otherwise the supervisor binds the port and the workers accept the connections of the inherited socket.
+
+    Workers are forked before the supervisor starts any thread, every worker then opens the log files, loads the
+    indexes and starts its query threads and scan workers on its own.
+
+    @params workers: number of worker processes
+    @params hostname: address the workers listen on
+    @params port: port the workers listen on
+    '''
+
+    # a worker dying sooner than this after its start is restarted only after this delay, so a worker failing at
+    # startup (e.g. the port is taken) is not restarted in a busy loop
+    MIN_UPTIME: final = 1.0
+
+    # scan worker processes of a worker when the server scans in parallel, a single scan worker would scan serially
+    MIN_SCAN_WORKERS: final = 2
+
+    def __init__(self, workers: int, hostname: str, port: int) -> None:
+        self.workers = workers
+        self.hostname = hostname
+        self.port = port
+        # listening socket inherited by the workers, None if every worker binds the port itself
+        self.listen_socket: Optional[socket.socket] = None
+        # running workers by worker id and the time they were started
+        self.processes: Dict[int, multiprocessing.Process] = {}
+        self.started: Dict[int, float] = {}
+        self.stopping = False
+
+    '''
+    create a listening socket on hostname and port, shared with the other workers through SO_REUSEPORT if requested
+    '''
+    @staticmethod
+    def create_listen_socket(hostname: str, port: int, reuse_port: bool = False) -> socket.socket:
+        # the address family of the hostname, e.g. IPv6 addresses
+        family, _, _, _, address = socket.getaddrinfo(hostname, port, type=socket.SOCK_STREAM)[0]
+        listen_socket = socket.socket(family, socket.SOCK_STREAM)
+        listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        listen_socket.bind(address)
+        listen_socket.listen()
+        return listen_socket
+
+    '''
+    settings of a worker: its id, and its share of the scan worker processes so the workers together run as many
+    as a single server would. A server scanning in parallel keeps scanning in parallel in every worker with at least
+    MIN_SCAN_WORKERS scan workers, even if the workers then run more of them together. Only worker 0 builds the token
+    indexes and the segments, the other workers load them.
+    '''
+    @staticmethod
+    def worker_options(options: Dict, worker_id: int) -> Dict:
+        scan_workers = options.get('scan_workers', 0)
+        if scan_workers > 1:
+            scan_workers = max(WorkerSupervisor.MIN_SCAN_WORKERS, scan_workers // options['workers'])
+        return dict(options, worker=worker_id, scan_workers=scan_workers)
+
+    '''
+    run a worker process, the listening socket of the worker is passed to serve
+
+    @params serve: function serving on a listening socket as the worker with the given id, never returns
+    '''
+    def run_worker(self, worker_id: int, serve: Callable[[int, socket.socket], None]) -> None:
+        # the supervisor stops the workers, terminal interrupts are for the supervisor only
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        listen_socket = self.listen_socket
+        if listen_socket is None:
+            listen_socket = WorkerSupervisor.create_listen_socket(self.hostname, self.port, reuse_port=True)
+        serve(worker_id, listen_socket)
+
+    def start_worker(self, worker_id: int, serve: Callable[[int, socket.socket], None]) -> None:
+        # forked so the workers inherit the listening socket, the supervisor runs no threads which could be
+        # forked in the middle of holding a lock
+        process = multiprocessing.get_context('fork').Process(target=self.run_worker, args=(worker_id, serve),
+                                                              name=f'worker-{worker_id}')
+        process.start()
+        self.processes[worker_id] = process
+        self.started[worker_id] = time.time()
+        logger.info("started worker %s (pid %s)", worker_id, process.pid)
+
+    def stop(self, signum=None, frame=None) -> None:
+        self.stopping = True
+
+    '''
+    start the workers and restart the ones which die until the supervisor is interrupted or terminated
+
+    @params serve: function serving on a listening socket as the worker with the given id, never returns
+    '''
+    def run(self, serve: Callable[[int, socket.socket], None]) -> None:
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            self.listen_socket = WorkerSupervisor.create_listen_socket(self.hostname, self.port)
+        signal.signal(signal.SIGTERM, self.stop)
+
+        for worker_id in range(self.workers):
+            self.start_worker(worker_id, serve)
+        logger.info("Serving on %s with %s workers", (self.hostname, self.port), self.workers)
+
+        try:
+            while not self.stopping:
+                sentinels = {process.sentinel: worker_id for worker_id, process in self.processes.items()}
+                for sentinel in wait(list(sentinels), timeout=1):
+                    worker_id = sentinels[sentinel]
+                    process = self.processes[worker_id]
+                    process.join()
+                    logger.warning("worker %s (pid %s) exited with code %s", worker_id, process.pid, process.exitcode)
+                    if time.time() - self.started[worker_id] < WorkerSupervisor.MIN_UPTIME:
+                        time.sleep(WorkerSupervisor.MIN_UPTIME)
+                    if not self.stopping:
+                        self.start_worker(worker_id, serve)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for process in self.processes.values():
+                process.terminate()
+            for process in self.processes.values():
+                process.join()
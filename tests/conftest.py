@@ -0,0 +1,18 @@
+import os
+import sys
+import pytest
+
+# the server modules import each other by their plain names, as when the servers are run from the server directory.
+# the client is imported as client.client from the repository root, like the distributed test does
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+
+'''
+fixture writing log files into a temporary directory, the lines are newline terminated
+'''
+@pytest.fixture
+def write_log(tmp_path):
+    def write(lines, name='machine.log'):
+        path = tmp_path / name
+        path.write_bytes(b''.join(line + b'\n' for line in lines))
+        return str(path)
+    return write
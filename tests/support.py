@@ -0,0 +1,69 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Tuple
+from log_searcher import LogSearcher
+from protocol import Protocol
+from server_with_asyncio import ServerWithAsyncio
+
+# lines in the format of the HDFS logs served by the servers, in time order
+SAMPLE_LINES = [
+    b'081109 203615 148 INFO dfs.DataNode$PacketResponder: PacketResponder 1 for block blk_388650490 terminating',
+    b'081109 203807 222 INFO dfs.DataNode$PacketResponder: PacketResponder 0 for block blk_-695229586 terminating',
+    b'081109 204005 35 INFO dfs.FSNamesystem: BLOCK* NameSystem.addStoredBlock: blockMap updated: 10.251.73.220:50010',
+    b'081109 204015 308 INFO dfs.DataNode$PacketResponder: PacketResponder 2 for block blk_822919380 terminating',
+    b'081109 204106 329 WARN dfs.DataNode$DataXceiver: Got exception while serving blk_-667095862',
+    b'081109 204132 26 INFO dfs.DataNode$DataXceiver: Receiving block blk_-562317679 src: /10.251.75.228:53725',
+    b'081109 204324 34 INFO dfs.DataNode$DataXceiver: Receiving block blk_579248908 src: /10.251.30.6:33145',
+    b'081109 204453 34 INFO dfs.FSNamesystem: BLOCK* NameSystem.allocateBlock: '
+    b'/mnt/hadoop/job_200811092030_0001/job.jar',
+]
+
+
+'''
+decode the frames of a response into the matched lines and the summary, an ERROR frame is returned as the summary
+{'error': <message>}
+'''
+def decode_response(frames: Iterable[bytes], request_id: int = 1) -> Tuple[List[bytes], Optional[Dict]]:
+    lines = []
+    summary = None
+    for frame in frames:
+        frame_type, frame_request_id, length = Protocol.decode_header(frame[:Protocol.HEADER.size])
+        payload = frame[Protocol.HEADER.size:]
+        assert frame_request_id == request_id and length == len(payload)
+        if frame_type == Protocol.FRAME_BATCH:
+            num_lines, batch = Protocol.decode_batch(payload)
+            assert batch.count(b'\n') == num_lines
+            lines.extend(batch.splitlines())
+        elif frame_type == Protocol.FRAME_SUMMARY:
+            summary = Protocol.decode_summary(payload)
+        elif frame_type == Protocol.FRAME_ERROR:
+            summary = {'error': payload.decode()}
+    return lines, summary
+
+
+'''
+run a query on a searcher and decode its response
+'''
+def run_query(searcher, query: str, request_id: int = 1) -> Tuple[List[bytes], Optional[Dict]]:
+    _, frames = searcher.prepare_search_response(query, request_id)
+    return decode_response(frames, request_id)
+
+
+'''
+serve log files with an asyncio server on a free loopback port of the running event loop, yields the server and its
+port
+
+@params options: server settings as parsed from the command line, indexing, scan workers and caching are off unless
+                 given
+'''
+@asynccontextmanager
+async def serve_logs(log_file: str, **options) -> AsyncIterator[Tuple[ServerWithAsyncio, int]]:
+    server = ServerWithAsyncio('127.0.0.1', 0, log_file, options)
+    server.searcher = LogSearcher.create(log_file, options)
+    listener = await asyncio.start_server(server.handle_client, '127.0.0.1', 0)
+    try:
+        yield server, listener.sockets[0].getsockname()[1]
+    finally:
+        listener.close()
+        await listener.wait_closed()
+        server.executor.shutdown(wait=False)
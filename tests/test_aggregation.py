@@ -0,0 +1,72 @@
+from aggregation import Aggregation, HyperLogLog
+from log_searcher import LogSearcher
+from search_query import SearchQuery
+from tests.support import SAMPLE_LINES, run_query
+
+
+def aggregate(searcher, query):
+    _, summary = run_query(searcher, query)
+    return summary['aggregate']
+
+
+def iter_blocks(lines):
+    yield len(lines), b''.join(line + b'\n' for line in lines)
+
+
+def test_count_by_fields(write_log):
+    searcher = LogSearcher.create(write_log(SAMPLE_LINES), {})
+    partial = aggregate(searcher, "search ['blk_'] count by level")
+    assert partial['groups'] == {'INFO': 5, 'WARN': 1}
+    partial = aggregate(searcher, "search ['Receiving'] count by level,pid")
+    assert partial['groups'] == {'INFO\t26': 1, 'INFO\t34': 1}
+
+
+def test_histogram_buckets_start_at_multiples_of_the_interval(write_log):
+    searcher = LogSearcher.create(write_log(SAMPLE_LINES), {})
+    partial = aggregate(searcher, "search ['dfs'] histogram 5m")
+    assert partial['groups'] == {'081109 203500': 2, '081109 204000': 6}
+
+
+def test_partials_of_several_servers_are_merged(write_log):
+    query = "search ['dfs'] count by component"
+    first = aggregate(LogSearcher.create(write_log(SAMPLE_LINES[:4], 'a.log'), {}), query)
+    second = aggregate(LogSearcher.create(write_log(SAMPLE_LINES[4:], 'b.log'), {}), query)
+    merged = Aggregation.merge([first, second])
+    assert merged['groups'] == {'dfs.DataNode$PacketResponder': 3, 'dfs.FSNamesystem': 2, 'dfs.DataNode$DataXceiver': 3}
+    assert Aggregation.format(merged).splitlines()[:2] == ['count by component:', 'dfs.DataNode$PacketResponder: 3']
+
+
+def test_only_the_largest_groups_are_sent(monkeypatch):
+    monkeypatch.setattr(Aggregation, 'MAX_GROUPS', 2)
+    aggregation = Aggregation(Aggregation.KIND_COUNT, ['pid'])
+    aggregation.add_blocks(iter_blocks(SAMPLE_LINES + [SAMPLE_LINES[7]]))
+    partial = aggregation.partial()
+    # ties are kept in the order the values were first seen
+    assert partial['groups'] == {'34': 3, '148': 1}
+    assert partial['other'] == 5
+
+
+def test_top_values():
+    search_query = SearchQuery.parse("search ['dfs'] top 1 component")
+    search_query.aggregation.add_blocks(iter_blocks(SAMPLE_LINES))
+    merged = Aggregation.merge([search_query.aggregation.partial()])
+    assert Aggregation.format(merged) == 'top 1 component:\ndfs.DataNode$PacketResponder: 3\n'
+
+
+def test_distinct_values_are_estimated():
+    sketches = []
+    for server in range(2):
+        sketch = HyperLogLog()
+        # the servers share half of their values
+        for value in range(server * 5000, server * 5000 + 10000):
+            sketch.add(b'blk_%d' % value)
+        sketches.append(sketch)
+    assert abs(sketches[0].estimate() - 10000) < 500
+    merged = HyperLogLog.decode(sketches[0].encode())
+    merged.merge(sketches[1])
+    assert abs(merged.estimate() - 15000) < 750
+    # small cardinalities are exact in practice
+    small = HyperLogLog()
+    for value in (b'a', b'b', b'c', b'a'):
+        small.add(value)
+    assert small.estimate() == 3
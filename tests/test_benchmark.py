@@ -0,0 +1,38 @@
+from benchmarks.benchmark import find_regressions, generate_log_file, latency_stats, parse_cmdline_args, percentile
+from field_query import LogRecord
+
+
+def test_generated_log_files_are_reproducible(tmp_path):
+    generate_log_file(str(tmp_path / 'a.log'), 64 * 1024, 425)
+    generate_log_file(str(tmp_path / 'b.log'), 64 * 1024, 425)
+    data = (tmp_path / 'a.log').read_bytes()
+    assert data == (tmp_path / 'b.log').read_bytes()
+    assert len(data) >= 64 * 1024
+    # every generated line has the fields of the HDFS logs
+    record = LogRecord()
+    assert all(record.parse(line).component and record.level in (b'INFO', b'WARN')
+               for line in data.splitlines()[:100])
+
+
+def test_percentile_is_the_nearest_rank():
+    values = [float(n) for n in range(1, 101)]
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile([3.0], 99) == 3
+    assert latency_stats([1.0, 3.0]) == {'p50': 1, 'p99': 3, 'mean': 2, 'min': 1, 'max': 3}
+
+
+def test_only_p50_regressions_past_the_tolerance_are_reported():
+    def results(*p50s):
+        return {'results': [{'server': 'asyncio', 'pattern': pattern, 'latency': {'p50': p50}}
+                            for pattern, p50 in zip(('rare', 'frequent'), p50s)]}
+
+    assert find_regressions(results(1.1, 3.0), results(1.0, 2.0), 0.2) == ['asyncio frequent: p50 2.0000s -> 3.0000s']
+    assert find_regressions(results(1.0), {}, 0.2) == []
+
+
+def test_command_line_patterns_replace_the_defaults():
+    settings = parse_cmdline_args(['--pattern=warn=WARN', '--implementations=select', '--runs=0'])
+    assert settings['patterns'] == {'warn': 'WARN'}
+    assert settings['implementations'] == ['select']
+    assert settings['runs'] == 1
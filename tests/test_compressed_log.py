@@ -0,0 +1,71 @@
+import gzip
+import os
+import pytest
+from compressed_log import CompressedLog
+from log_searcher import LogSearcher
+from search_engine import SearchEngine
+from tests.support import SAMPLE_LINES, run_query
+
+# the sample lines with a timestamp one second after the other
+LOG_DATA = b''.join(b'081109 20%02d%02d' % divmod(i, 60) + SAMPLE_LINES[i % len(SAMPLE_LINES)][13:] + b'\n'
+                    for i in range(400))
+
+
+@pytest.fixture
+def small_blocks(monkeypatch):
+    # small checkpoint intervals and reads, so the sample logs are split into many blocks
+    monkeypatch.setattr(CompressedLog, 'CHECKPOINT_INTERVAL', 2048)
+    monkeypatch.setattr(CompressedLog, 'READ_SIZE', 512)
+
+
+def write_gzip(tmp_path, data, name='machine.log.gz'):
+    path = tmp_path / name
+    path.write_bytes(gzip.compress(data))
+    return str(path)
+
+
+def test_format_is_detected_from_the_magic_bytes(tmp_path, write_log):
+    assert CompressedLog.detect_format(write_gzip(tmp_path, LOG_DATA)) == 'gzip'
+    assert CompressedLog.detect_format(write_log(SAMPLE_LINES)) is None
+    assert CompressedLog.detect_format(str(tmp_path / 'missing.log')) is None
+
+
+@pytest.mark.parametrize('decompress_workers', [0, 2])
+def test_compressed_file_matches_the_plain_file(tmp_path, small_blocks, decompress_workers):
+    searcher = LogSearcher(write_gzip(tmp_path, LOG_DATA), decompress_workers=decompress_workers)
+    expected = [line for line in LOG_DATA.splitlines() if b'Receiving block' in line]
+    # the first search records the checkpoints, the second searches the blocks between them
+    for _ in range(2):
+        lines, summary = run_query(searcher, "search ['Receiving block']")
+        assert lines == expected
+        assert summary['files'][0]['count'] == 100
+    compressed_log, = searcher.compressed_logs.values()
+    assert len(compressed_log.checkpoints) > 2
+    assert compressed_log.size == len(LOG_DATA)
+
+
+def test_blocks_end_at_line_boundaries(tmp_path, small_blocks):
+    path = write_gzip(tmp_path, LOG_DATA)
+    compressed_log = CompressedLog(path, os.stat(path))
+    assert b''.join(compressed_log.iter_chunks()) == LOG_DATA
+    blocks = [compressed_log.read_block(block) for block in range(len(compressed_log.checkpoints))]
+    assert b''.join(blocks) == LOG_DATA
+    assert all(block.endswith(b'\n') for block in blocks)
+
+
+def test_multi_member_files_are_searched_whole(tmp_path):
+    path = tmp_path / 'machine.log.gz'
+    path.write_bytes(gzip.compress(LOG_DATA) + gzip.compress(SAMPLE_LINES[4] + b'\n') + b'\0' * 16)
+    _, summary = run_query(LogSearcher(str(path)), "search ['Got exception'] count")
+    assert summary['files'][0]['count'] == 51
+
+
+def test_blocks_outside_the_time_window_are_not_decompressed(tmp_path, small_blocks):
+    path = write_gzip(tmp_path, LOG_DATA)
+    compressed_log = CompressedLog(path, os.stat(path))
+    for _ in compressed_log.iter_chunks():
+        pass
+    last = compressed_log.checkpoints[-1].timestamp
+    engine = SearchEngine(['.'])
+    matched = sum(num_lines for num_lines, _ in compressed_log.iter_file_blocks(engine, 1024, time_from=last))
+    assert 0 < matched < 400
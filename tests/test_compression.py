@@ -0,0 +1,114 @@
+import asyncio
+import sys
+import types
+import zlib
+import pytest
+import compression
+from client.client import ConnectionPool, process_cmd_line_args
+from compression import Codec, Compression, Lz4Codec, ZlibCodec
+from protocol import FrameDecoder, Protocol, ProtocolError
+from tests.support import SAMPLE_LINES, serve_logs
+
+# enough matched lines for a batch which is worth compressing
+LOG_LINES = SAMPLE_LINES * 50
+
+
+async def collect(connection, query):
+    frames = []
+    async for frame in connection.request(query):
+        frames.append(frame)
+    return frames
+
+
+def test_codecs_must_implement_compress_and_decompress():
+    with pytest.raises(TypeError):
+        Codec('none')
+
+
+def test_compressed_frames_are_flagged_and_decompressed():
+    codec = ZlibCodec()
+    frame = Protocol.encode_batch(1, len(LOG_LINES), b''.join(line + b'\n' for line in LOG_LINES))
+    compressed = Protocol.compress_frame(frame, codec)
+    assert len(compressed) < len(frame)
+    assert compressed[1] == Protocol.FRAME_BATCH | Protocol.COMPRESSED_FLAG
+    assert FrameDecoder(codec).feed(compressed) == [(Protocol.FRAME_BATCH, 1, frame[Protocol.HEADER.size:])]
+    # small frames are not worth compressing
+    small = Protocol.encode_frame(Protocol.FRAME_ERROR, 1, b'invalid query')
+    assert Protocol.compress_frame(small, codec) is small
+    with pytest.raises(ProtocolError):
+        FrameDecoder().feed(compressed)
+
+
+def test_oversized_payloads_are_rejected():
+    with pytest.raises(ValueError):
+        ZlibCodec().decompress(zlib.compress(b'x' * 2048), 1024)
+
+
+def test_lz4_frames_declaring_an_oversized_payload_are_not_decompressed(monkeypatch):
+    class Decompressor(object):
+        def decompress(self, data, max_length):
+            raise AssertionError('decompressed an oversized frame')
+
+    frame = types.SimpleNamespace(get_frame_info=lambda data: {'content_size': 2048},
+                                  LZ4FrameDecompressor=Decompressor)
+    monkeypatch.setattr(compression, 'lz4', types.SimpleNamespace(frame=frame))
+    with pytest.raises(ValueError):
+        Lz4Codec().decompress(b'frame', 1024)
+
+
+def test_lz4_round_trip():
+    pytest.importorskip('lz4.frame')
+    data = b''.join(line + b'\n' for line in LOG_LINES)
+    codec = Lz4Codec()
+    assert codec.decompress(codec.compress(data), len(data)) == data
+    with pytest.raises(ValueError):
+        codec.decompress(codec.compress(data), len(data) - 1)
+
+
+def test_codec_is_negotiated_after_the_server_advertised_it(write_log):
+    async def run():
+        async with serve_logs(write_log(LOG_LINES)) as (_, port):
+            pool = ConnectionPool(['zlib'])
+            connection = await pool.get_connection('127.0.0.1', port)
+            frames = await collect(connection, "search ['dfs']")
+            codec = connection.codec
+            await pool.close()
+            return frames, codec
+
+    frames, codec = asyncio.run(run())
+    assert codec.name == 'zlib'
+    lines = b''.join(Protocol.decode_batch(payload)[1] for frame_type, payload in frames
+                     if frame_type == Protocol.FRAME_BATCH)
+    assert lines == b''.join(line + b'\n' for line in LOG_LINES)
+
+
+def test_no_codecs_are_offered_to_a_server_which_advertised_none():
+    received = []
+
+    # a server which does not know about compression and answers every request with an empty summary
+    async def handle(reader, writer):
+        while True:
+            frame = await Protocol.read_frame(reader)
+            if frame is None:
+                break
+            received.append(frame[0])
+            writer.write(Protocol.encode_summary(frame[1], {'files': []}))
+
+    async def run():
+        listener = await asyncio.start_server(handle, '127.0.0.1', 0)
+        pool = ConnectionPool()
+        connection = await pool.get_connection('127.0.0.1', listener.sockets[0].getsockname()[1])
+        frames = await collect(connection, "search ['dfs']")
+        await pool.close()
+        listener.close()
+        return frames
+
+    assert asyncio.run(run()) == [(Protocol.FRAME_SUMMARY, b'{"files": []}')]
+    assert received == [Protocol.FRAME_REQUEST]
+
+
+def test_compression_option(monkeypatch):
+    monkeypatch.setattr(sys, 'argv', ['client.py', '--compression=zlib,none'])
+    assert process_cmd_line_args()[4] == ['zlib']
+    assert Compression.negotiate('snappy, ZLIB').name == 'zlib'
+    assert Compression.negotiate('snappy') is None
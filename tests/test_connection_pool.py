@@ -0,0 +1,49 @@
+import asyncio
+from client.client import ConnectionPool
+from protocol import Protocol
+from tests.support import SAMPLE_LINES, serve_logs
+
+
+async def collect(connection, query):
+    lines = []
+    async for frame_type, payload in connection.request(query):
+        if frame_type == Protocol.FRAME_BATCH:
+            lines.extend(Protocol.decode_batch(payload)[1].splitlines())
+        elif frame_type == Protocol.FRAME_SUMMARY:
+            return lines, Protocol.decode_summary(payload)
+
+
+def test_concurrent_queries_share_one_connection(write_log):
+    async def run():
+        async with serve_logs(write_log(SAMPLE_LINES)) as (server, port):
+            pool = ConnectionPool()
+            connections = await asyncio.gather(*(pool.get_connection('127.0.0.1', port) for _ in range(3)))
+            assert connections[0] is connections[1] is connections[2]
+            results = await asyncio.gather(collect(connections[0], "search ['WARN']"),
+                                           collect(connections[0], "search ['Receiving block']"),
+                                           collect(connections[0], "search ['PacketResponder']"))
+            assert len(server.connected_clients) == 1
+            await pool.close()
+            return results
+
+    (warn, _), (receiving, _), (responder, summary) = asyncio.run(run())
+    assert warn == [SAMPLE_LINES[4]]
+    assert receiving == SAMPLE_LINES[5:7]
+    assert responder == [SAMPLE_LINES[0], SAMPLE_LINES[1], SAMPLE_LINES[3]]
+    assert summary['files'][0]['count'] == 3
+
+
+def test_pool_reconnects_after_the_connection_closed(write_log):
+    async def run():
+        async with serve_logs(write_log(SAMPLE_LINES)) as (server, port):
+            pool = ConnectionPool()
+            first = await pool.get_connection('127.0.0.1', port)
+            await first.close()
+            second = await pool.get_connection('127.0.0.1', port)
+            result = await collect(second, "search ['WARN']")
+            await pool.close()
+            return first is second, result
+
+    reused, (lines, _) = asyncio.run(run())
+    assert not reused
+    assert lines == [SAMPLE_LINES[4]]
@@ -0,0 +1,80 @@
+import asyncio
+import sys
+import time
+from client.client import Client, ConnectionPool, process_cmd_line_args
+from log_searcher import LogSearcher
+from protocol import Protocol
+from tests.support import SAMPLE_LINES, decode_response, serve_logs
+
+
+def test_deadline_counts_from_the_arrival_of_the_request(write_log):
+    searcher = LogSearcher.create(write_log(SAMPLE_LINES), {})
+    _, frames = searcher.prepare_search_response("search ['dfs'] timeout 5s", 1, 'client', time.time() - 10)
+    lines, summary = decode_response(frames)
+    # the request waited past its deadline, nothing is searched
+    assert lines == [] and summary['files'] == []
+    assert summary['partial'] == 'deadline exceeded'
+
+    _, frames = searcher.prepare_search_response("search ['dfs'] timeout 5s", 1, 'client', time.time())
+    lines, summary = decode_response(frames)
+    assert lines == SAMPLE_LINES and 'partial' not in summary
+
+
+def test_queries_can_be_cancelled_before_their_search_starts(write_log):
+    searcher = LogSearcher.create(write_log(SAMPLE_LINES), {})
+    _, frames = searcher.prepare_search_response("search ['dfs']", 1, 'client')
+    assert searcher.cancel('client', 1) is None
+    lines, summary = decode_response(frames)
+    assert lines == [] and summary['partial'] == 'cancelled'
+    assert searcher.running == {}
+
+    # the queries of a closed connection are forgotten even if their response never starts
+    searcher.prepare_search_response("search ['dfs']", 2, 'client')
+    searcher.cancel_all('client')
+    assert searcher.running == {}
+
+
+def test_cancelled_query_leaves_the_queue_of_the_server(write_log):
+    async def run():
+        async with serve_logs(write_log(SAMPLE_LINES), max_queries=1) as (server, port):
+            # another client holds the only query slot
+            server.scheduler.submit('other', lambda: None)
+            pool = ConnectionPool()
+            connection = await pool.get_connection('127.0.0.1', port)
+            request_id = connection.allocate_request_id()
+            frames = []
+
+            async def query():
+                async for frame_type, payload in connection.request("search ['dfs']", request_id):
+                    frames.append((frame_type, payload))
+
+            task = asyncio.create_task(query())
+            while not server.waiting_queries:
+                await asyncio.sleep(0.01)
+            assert server.searcher.running
+            await connection.cancel(request_id)
+            await asyncio.wait_for(task, 5)
+            waiting = dict(server.scheduler.waiting)
+            await pool.close()
+            return frames, waiting
+
+    frames, waiting = asyncio.run(run())
+    assert [frame_type for frame_type, _ in frames] == [Protocol.FRAME_SUMMARY]
+    assert Protocol.decode_summary(frames[0][1])['partial'] == 'cancelled'
+    assert waiting == {}
+
+
+def test_queries_are_unbounded_without_a_client_timeout():
+    async def run():
+        return Client().apply_deadline("search ['dfs']"), Client(timeout=5).apply_deadline("search ['dfs']")
+
+    unbounded, bounded = asyncio.run(run())
+    assert unbounded == ("search ['dfs']", None)
+    assert bounded[0] == "search ['dfs'] timeout 5s" and bounded[1] is not None
+
+
+def test_timeout_option(monkeypatch):
+    monkeypatch.setattr(sys, 'argv', ['client.py'])
+    assert process_cmd_line_args()[3] == 0
+    monkeypatch.setattr(sys, 'argv', ['client.py', '--timeout=5'])
+    assert process_cmd_line_args()[3] == 5
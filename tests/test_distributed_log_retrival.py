@@ -43,6 +43,7 @@ async def validate_user_query(server_details: List, query: str, expected_log_cou
         background_tasks.append(client.fetch_logs_from_server(hostname, port, query))
 
     results = await asyncio.gather(*background_tasks, return_exceptions=True)
+    await client.close()
 
     for i in range(len(background_tasks)):
         actual_logs_count, _ = results[i]
@@ -0,0 +1,66 @@
+import pytest
+from field_query import AndCondition, Condition, FieldQuery, LogRecord
+from log_searcher import LogSearcher
+from search_query import SearchQuery
+from tests.support import SAMPLE_LINES, run_query
+
+
+def matching_lines(text):
+    field_query = FieldQuery(text)
+    record = LogRecord()
+    return [line for line in SAMPLE_LINES if field_query.condition.matches(record.parse(line))]
+
+
+def test_lines_are_split_into_fields():
+    record = LogRecord().parse(SAMPLE_LINES[4])
+    assert (record.date, record.time, record.pid, record.level) == (b'081109', b'204106', b'329', b'WARN')
+    assert record.component == b'dfs.DataNode$DataXceiver'
+    assert record.message == b'Got exception while serving blk_-667095862'
+    # a continuation line only has a message
+    record.parse(b'\tat org.apache.hadoop.Class.method')
+    assert record.level == b'' and record.message == b'\tat org.apache.hadoop.Class.method'
+
+
+def test_comparisons():
+    assert matching_lines('level=WARN') == [SAMPLE_LINES[4]]
+    assert matching_lines('pid>=300') == [SAMPLE_LINES[3], SAMPLE_LINES[4]]
+    assert matching_lines('pid<30') == [SAMPLE_LINES[5]]
+    assert matching_lines("message~'^Receiving block'") == SAMPLE_LINES[5:7]
+    assert matching_lines('component!=dfs.DataNode$PacketResponder and level=INFO') == \
+        [SAMPLE_LINES[2]] + SAMPLE_LINES[5:8]
+
+
+def test_precedence_and_parentheses():
+    # not binds tightest, then and, then or
+    assert matching_lines('level=WARN or pid=34 and component=dfs.FSNamesystem') == [SAMPLE_LINES[4], SAMPLE_LINES[7]]
+    assert matching_lines('(level=WARN or pid=34) and component=dfs.FSNamesystem') == [SAMPLE_LINES[7]]
+    assert matching_lines('not (level=INFO or pid>=1000)') == [SAMPLE_LINES[4]]
+
+
+def test_cheaper_conditions_are_evaluated_first():
+    condition = FieldQuery("message~'block' and level=INFO and component=dfs.FSNamesystem").condition
+    assert isinstance(condition, AndCondition)
+    assert [c.field for c in condition.conditions] == ['level', 'component', 'message']
+
+
+@pytest.mark.parametrize('text', ['level=', 'colour=red', 'pid<abc', "message~'('", '(level=WARN', 'level=WARN)'])
+def test_invalid_queries_are_rejected(text):
+    with pytest.raises(ValueError):
+        FieldQuery(text)
+
+
+def test_conditions_must_implement_matches():
+    with pytest.raises(TypeError):
+        Condition()
+
+
+def test_a_field_query_alone_scans_for_its_literal():
+    search_query = SearchQuery.parse("search [] where level=WARN and message~'Got exception'")
+    assert search_query.engine_search_strings() == ['Got\\ exception']
+
+
+def test_matched_lines_are_filtered_by_the_field_query(write_log):
+    searcher = LogSearcher.create(write_log(SAMPLE_LINES), {})
+    lines, summary = run_query(searcher, "search ['blk_'] where component=dfs.DataNode$DataXceiver")
+    assert lines == SAMPLE_LINES[4:7]
+    assert summary['files'][0]['count'] == 3
@@ -0,0 +1,111 @@
+import asyncio
+import os
+import pytest
+from client.client import ConnectionPool
+from log_follower import LogFollower
+from protocol import Protocol
+from search_engine import SearchEngine
+from search_query import SearchQuery
+from tests.support import SAMPLE_LINES, decode_response, serve_logs
+
+FOLLOW_QUERY = "search ['Receiving block'] follow"
+
+
+@pytest.fixture
+def fast_polls(monkeypatch):
+    monkeypatch.setattr(LogFollower, 'POLL_INTERVAL', 0.02)
+
+
+def append(log_file, data):
+    with open(log_file, 'ab') as f:
+        f.write(data)
+
+
+def subscribe(follower, subscriber='client', request_id=1):
+    search_query = SearchQuery.parse(FOLLOW_QUERY)
+    follower.subscribe(subscriber, request_id, SearchEngine(search_query.engine_search_strings()), search_query)
+
+
+def pushed_lines(frames):
+    return decode_response(frame for _, frame in frames)[0]
+
+
+def test_only_appended_complete_lines_are_pushed(write_log):
+    log_file = write_log(SAMPLE_LINES)
+    follower = LogFollower(log_file)
+    subscribe(follower)
+    assert follower.poll() == []
+
+    append(log_file, SAMPLE_LINES[5] + b'\n' + SAMPLE_LINES[6])
+    frames = follower.poll()
+    assert [subscriber for subscriber, _ in frames] == ['client']
+    assert pushed_lines(frames) == [SAMPLE_LINES[5]]
+    # the partially written line is pushed once it is complete
+    append(log_file, b'\n')
+    assert pushed_lines(follower.poll()) == [SAMPLE_LINES[6]]
+
+    _, summary = decode_response([follower.cancel('client', 1)])
+    assert summary['files'] == [{'file': 'machine.log', 'count': 2}]
+    assert not follower.has_subscriptions()
+
+
+def test_rotated_files_are_followed_from_their_beginning(write_log):
+    log_file = write_log(SAMPLE_LINES)
+    follower = LogFollower(log_file)
+    subscribe(follower)
+    os.remove(log_file)
+    write_log(SAMPLE_LINES[5:6])
+    assert pushed_lines(follower.poll()) == [SAMPLE_LINES[5]]
+
+
+def test_polling_stops_when_the_follow_query_is_cancelled(write_log, fast_polls):
+    log_file = write_log(SAMPLE_LINES)
+
+    async def run():
+        async with serve_logs(log_file) as (server, port):
+            pool = ConnectionPool()
+            connection = await pool.get_connection('127.0.0.1', port)
+            request_id = connection.allocate_request_id()
+            frames = []
+
+            async def follow():
+                async for frame_type, payload in connection.request(FOLLOW_QUERY, request_id):
+                    frames.append((frame_type, payload))
+
+            task = asyncio.create_task(follow())
+            while server.follow_task is None:
+                await asyncio.sleep(0.01)
+            append(log_file, SAMPLE_LINES[6] + b'\n')
+            while not frames:
+                await asyncio.sleep(0.01)
+            await connection.cancel(request_id)
+            await asyncio.wait_for(task, 5)
+            follow_task = server.follow_task
+            await pool.close()
+            return frames, follow_task
+
+    frames, follow_task = asyncio.run(run())
+    assert Protocol.decode_batch(frames[0][1]) == (1, SAMPLE_LINES[6] + b'\n')
+    assert frames[-1][0] == Protocol.FRAME_SUMMARY
+    assert follow_task is None
+
+
+def test_polling_stops_when_the_client_disconnects(write_log, fast_polls):
+    async def run():
+        async with serve_logs(write_log(SAMPLE_LINES)) as (server, port):
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(Protocol.encode_frame(Protocol.FRAME_REQUEST, 1, FOLLOW_QUERY.encode()))
+            await writer.drain()
+            while server.follow_task is None:
+                await asyncio.sleep(0.01)
+            follow_task = server.follow_task
+            writer.close()
+            await writer.wait_closed()
+            while server.follow_task is not None:
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0)
+            return server, follow_task
+
+    server, follow_task = asyncio.run(run())
+    assert follow_task.cancelled()
+    assert not server.searcher.follower.has_subscriptions()
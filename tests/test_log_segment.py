@@ -0,0 +1,87 @@
+import os
+import pytest
+import log_segment
+from field_query import FieldQuery
+from log_searcher import LogSearcher
+from log_segment import LogSegments, SegmentBuilder
+from tests.support import SAMPLE_LINES, run_query
+
+# the sample lines with a stack trace after the WARN line, which does not parse into the columns
+STACK_TRACE = b'\tat org.apache.hadoop.dfs.DataNode.run(DataNode.java:1234)'
+LOG_LINES = (SAMPLE_LINES[:5] + [STACK_TRACE] + SAMPLE_LINES[5:]) * 20
+
+
+@pytest.fixture
+def small_segments(monkeypatch):
+    monkeypatch.setattr(LogSegments, 'MIN_SEGMENT_SIZE', 1024)
+    monkeypatch.setattr(LogSegments, 'MAX_SEGMENT_SIZE', 4096)
+
+
+def build_segments(log_file, segment_dir):
+    builder = SegmentBuilder(log_file, str(segment_dir))
+    os.makedirs(segment_dir, exist_ok=True)
+    builder.refresh()
+    return builder
+
+
+def test_segments_cover_the_file(write_log, tmp_path, small_segments):
+    log_file = write_log(LOG_LINES)
+    segments = build_segments(log_file, tmp_path / 'segments').get_segments(log_file)
+    assert len(segments.segments) > 1
+    assert segments.segments[0].start == 0
+    assert all(a.end == b.start for a, b in zip(segments.segments, segments.segments[1:]))
+    assert os.path.getsize(log_file) - segments.covered_size < LogSegments.MIN_SEGMENT_SIZE
+
+
+def test_dictionary_columns_select_the_candidate_lines(write_log, tmp_path, small_segments):
+    log_file = write_log(LOG_LINES)
+    segments = build_segments(log_file, tmp_path / 'segments').get_segments(log_file)
+    spans, covered_size = segments.candidate_spans(FieldQuery('level=WARN').condition)
+    with open(log_file, 'rb') as f:
+        data = f.read(covered_size)
+    selected = [data[start:end] for start, end in spans]
+    # the WARN line and the stack trace after it, which could not be parsed
+    assert selected and all(chunk == b'\n'.join(LOG_LINES[4:6]) + b'\n' for chunk in selected)
+
+
+def test_integer_columns_are_not_filtered_without_numpy(write_log, tmp_path, small_segments, monkeypatch):
+    monkeypatch.setattr(log_segment, 'numpy', None)
+    log_file = write_log(LOG_LINES)
+    segments = build_segments(log_file, tmp_path / 'segments').get_segments(log_file)
+    assert segments.candidate_spans(FieldQuery('pid>300').condition) is None
+    assert segments.candidate_spans(FieldQuery("message~'Receiving'").condition) is None
+    # and the conditions the columns can evaluate narrow down the conjunction
+    assert segments.candidate_spans(FieldQuery('pid>300 and level=WARN').condition) is not None
+
+
+@pytest.mark.parametrize('where', ['level=WARN', 'component!=dfs.FSNamesystem and pid>=100', 'not level=INFO',
+                                   "date=081109 and time<204100 and message~'block'"])
+def test_segment_searches_match_the_row_scan(write_log, tmp_path, small_segments, where):
+    log_file = write_log(LOG_LINES)
+    query = f"search [] where {where}"
+    expected = run_query(LogSearcher.create(log_file, {}), query)[0]
+    searcher = LogSearcher(log_file, segments=build_segments(log_file, tmp_path / 'segments'))
+    assert run_query(searcher, query)[0] == expected
+
+
+def test_segments_of_a_rewritten_file_are_rebuilt(write_log, tmp_path, small_segments):
+    log_file = write_log(LOG_LINES)
+    builder = build_segments(log_file, tmp_path / 'segments')
+    os.remove(log_file)
+    write_log(list(reversed(LOG_LINES)))
+    builder.refresh()
+    segments = builder.get_segments(log_file)
+    with open(log_file, 'rb') as f:
+        assert segments.segments[0].header['inode'] == os.fstat(f.fileno()).st_ino
+    spans, _ = segments.candidate_spans(FieldQuery('level=WARN').condition)
+    with open(log_file, 'rb') as f:
+        data = f.read()
+    assert all(data[start:end].startswith((b'081109 204106', b'\tat')) for start, end in spans)
+
+
+def test_read_only_builders_load_the_segments_of_another_process(write_log, tmp_path, small_segments):
+    log_file = write_log(LOG_LINES)
+    builder = build_segments(log_file, tmp_path / 'segments')
+    reader = SegmentBuilder(log_file, str(tmp_path / 'segments'), read_only=True)
+    reader.refresh()
+    assert reader.get_segments(log_file).covered_size == builder.get_segments(log_file).covered_size
@@ -0,0 +1,54 @@
+import asyncio
+from client.client import Client, ResponseStream
+from tests.support import SAMPLE_LINES, serve_logs
+
+
+def merge(log_files, query, capfd):
+    async def run():
+        async with serve_logs(log_files[0]) as (_, first_port), serve_logs(log_files[1]) as (_, second_port):
+            client = Client()
+            servers = [('127.0.0.1', first_port), ('127.0.0.1', second_port)]
+            results = await client.print_merged_responses(servers, query)
+            await client.close()
+            return servers, results
+
+    servers, results = asyncio.run(run())
+    output = capfd.readouterr().out.encode().splitlines()
+    return servers, results, output
+
+
+def test_lines_of_all_the_servers_are_merged_by_timestamp(write_log, capfd):
+    log_files = [write_log(SAMPLE_LINES[0::2], 'a.log'), write_log(SAMPLE_LINES[1::2], 'b.log')]
+    servers, results, output = merge(log_files, "search ['dfs']", capfd)
+    prefixes = [f'{hostname}:{port}: '.encode() for hostname, port in servers]
+    assert output == [prefixes[i % 2] + line for i, line in enumerate(SAMPLE_LINES)]
+    assert [num_lines for num_lines, _ in results] == [4, 4]
+
+
+def test_lines_without_a_timestamp_stay_after_their_line(write_log, capfd):
+    stack_trace = b'\tat org.apache.hadoop.dfs.DataNode.run(DataNode.java:1234) dfs'
+    log_files = [write_log(SAMPLE_LINES[:5] + [stack_trace], 'a.log'), write_log(SAMPLE_LINES[5:], 'b.log')]
+    _, results, output = merge(log_files, "search ['dfs']", capfd)
+    assert [line.split(b': ', 1)[1] for line in output] == SAMPLE_LINES[:5] + [stack_trace] + SAMPLE_LINES[5:]
+    assert [num_lines for num_lines, _ in results] == [6, 3]
+
+
+def test_failed_servers_are_reported_after_the_merge(write_log, capfd):
+    async def run():
+        async with serve_logs(write_log(SAMPLE_LINES)) as (_, port):
+            client = Client()
+            results = await client.print_merged_responses([('127.0.0.1', port), ('127.0.0.1', 1)], "search ['WARN']")
+            await client.close()
+            return results
+
+    results = asyncio.run(run())
+    assert capfd.readouterr().out.encode().endswith(SAMPLE_LINES[4] + b'\n')
+    assert results[0][0] == 1
+    assert results[1][0] == 0 and results[1][1].startswith('Failed to fetch logs from server')
+
+
+def test_sort_key_skips_the_file_prefix():
+    stream = ResponseStream('127.0.0.1', 0, 1024)
+    assert stream.sort_key(b'/var/log/machine.log:' + SAMPLE_LINES[2]) == b'081109 204005'
+    assert stream.sort_key(b'\tat org.apache.hadoop.dfs.DataNode.run(DataNode.java:1234)') == b'081109 204005'
+    stream.close()
@@ -0,0 +1,99 @@
+import asyncio
+import logging
+import sys
+from client.client import ClientTrace, ConnectionPool, process_cmd_line_args
+from log_searcher import LogSearcher
+from metrics import Histogram, Metrics, QueryTrace
+from protocol import Protocol
+from tests.support import SAMPLE_LINES, run_query, serve_logs
+
+
+def test_percentiles_are_estimated_by_the_bucket_bounds():
+    histogram = Histogram()
+    for value in [0.001] * 90 + [0.1] * 9 + [2.0]:
+        histogram.observe(value)
+    snapshot = histogram.snapshot()
+    assert snapshot['count'] == 100 and snapshot['max'] == 2.0
+    assert abs(snapshot['sum'] - 2.99) < 1e-9
+    assert 0.001 <= snapshot['p50'] < 0.001 * Histogram.GROWTH
+    assert 0.1 <= snapshot['p95'] < 0.1 * Histogram.GROWTH
+    # percentiles never exceed the largest value
+    assert snapshot['p99'] <= 2.0
+    assert Histogram().snapshot() == {'count': 0}
+
+
+def test_counters_and_gauges():
+    metrics = Metrics()
+    metrics.increment('queries')
+    metrics.increment('bytes_scanned', 100)
+    metrics.adjust('active_connections', 1)
+    metrics.adjust('active_connections', -1)
+    snapshot = metrics.snapshot()
+    assert snapshot['counters'] == {'queries': 1, 'bytes_scanned': 100}
+    assert snapshot['gauges'] == {'active_connections': 0}
+
+
+def test_query_trace_records_its_spans_once_the_query_ended():
+    metrics = Metrics()
+    trace = QueryTrace(metrics)
+    with trace.span('scan'):
+        pass
+    trace.add('queue', 0.5)
+    trace.bytes_sent = 10
+    trace.finish()
+    histograms = metrics.snapshot()['histograms']
+    assert set(histograms) == {f'query_{name}_seconds' for name in QueryTrace.SPANS} | {'query_total_seconds'}
+    assert histograms['query_queue_seconds']['sum'] == 0.5
+    assert metrics.snapshot()['counters']['bytes_sent'] == 10
+    assert str(trace).endswith('sent 10 bytes')
+
+
+def test_query_traces_are_only_formatted_when_they_are_logged(monkeypatch):
+    formatted = []
+    monkeypatch.setattr(QueryTrace, '__str__', lambda trace: formatted.append(trace) or 'trace')
+    logger = logging.getLogger('server.test_metrics')
+    logger.setLevel(logging.INFO)
+    logger.debug("request %s took %s", 1, QueryTrace(Metrics()))
+    assert formatted == []
+
+
+def test_stats_query_reports_the_metrics_of_the_server(write_log):
+    searcher = LogSearcher.create(write_log(SAMPLE_LINES), {})
+    run_query(searcher, "search ['WARN']")
+    run_query(searcher, "search ['")
+    _, summary = run_query(searcher, LogSearcher.STATS_QUERY)
+    counters = summary['stats']['counters']
+    assert counters['queries'] == 1 and counters['queries_invalid'] == 1
+    assert counters['lines_matched'] == 1
+
+
+def test_server_traces_the_queries_it_answered(write_log):
+    async def run():
+        async with serve_logs(write_log(SAMPLE_LINES)) as (server, port):
+            pool = ConnectionPool()
+            connection = await pool.get_connection('127.0.0.1', port)
+            async for _ in connection.request("search ['dfs']"):
+                pass
+            stats = [frame async for frame in connection.request(LogSearcher.STATS_QUERY)]
+            await pool.close()
+            return stats
+
+    (frame_type, payload), = asyncio.run(run())
+    assert frame_type == Protocol.FRAME_SUMMARY
+    stats = Protocol.decode_summary(payload)['stats']
+    assert stats['counters']['connections'] == 1 and stats['gauges']['active_connections'] == 1
+    assert stats['histograms']['query_total_seconds']['count'] == 1
+
+
+def test_client_trace_format():
+    trace = ClientTrace()
+    trace.add(('host', 4000), 'connect', 0.002)
+    trace.add(('host', 4000), 'last_byte', 0.01)
+    assert trace.format() == 'trace of server (host:4000): connect 2.0ms, last_byte 10.0ms\n'
+
+
+def test_trace_option(monkeypatch):
+    monkeypatch.setattr(sys, 'argv', ['client.py', '--trace=True'])
+    assert process_cmd_line_args()[5] is True
+    monkeypatch.setattr(sys, 'argv', ['client.py'])
+    assert process_cmd_line_args()[5] is False
@@ -0,0 +1,54 @@
+import pytest
+from parallel_scan import ParallelScanner
+from search_engine import SearchEngine
+from server_with_asyncio import ServerWithAsyncio
+from tests.support import SAMPLE_LINES
+
+LINES = [SAMPLE_LINES[i % len(SAMPLE_LINES)] + b' %d' % i for i in range(2000)]
+
+
+@pytest.fixture
+def scanner(monkeypatch):
+    # small ranges so a small file is split between the worker processes
+    monkeypatch.setattr(ParallelScanner, 'RANGE_SIZE', 4096)
+    scanner = ParallelScanner(2)
+    yield scanner
+    scanner.shutdown()
+
+
+def test_ranges_are_line_aligned_and_cover_the_file(write_log, monkeypatch):
+    monkeypatch.setattr(ParallelScanner, 'RANGE_SIZE', 4096)
+    log_file = write_log(LINES)
+    data = open(log_file, 'rb').read()
+    ranges = ParallelScanner.split_ranges(log_file)
+    assert ranges[0][0] == 0 and ranges[-1][1] == len(data)
+    for (_, end), (start, _) in zip(ranges, ranges[1:]):
+        assert end == start and data[end - 1:end] == b'\n'
+
+
+def test_matches_are_merged_in_file_order(write_log, scanner):
+    log_file = write_log(LINES)
+    engine = SearchEngine(['Receiving block', 'WARN'])
+    lines = b''.join(block for _, block in scanner.iter_file_blocks(engine, log_file, 1024))
+    expected = b''.join(SearchEngine(['Receiving block', 'WARN']).iter_file_matches(log_file))
+    assert lines == expected
+    assert engine.bytes_scanned == len(open(log_file, 'rb').read())
+
+
+def test_abandoned_scan_cancels_its_ranges(write_log, scanner):
+    log_file = write_log(LINES)
+    engine = SearchEngine(['INFO'])
+    blocks = scanner.iter_file_blocks(engine, log_file, 1024)
+    next(blocks)
+    blocks.close()
+    # only the ranges whose matches were taken count as scanned
+    assert 0 < engine.bytes_scanned < len(open(log_file, 'rb').read())
+
+
+def test_server_keeps_its_own_copy_of_the_options():
+    options = {'max_queries': 2}
+    server = ServerWithAsyncio('127.0.0.1', 0, 'machine.log', options)
+    server.options['worker'] = 1
+    assert options == {'max_queries': 2}
+    assert ServerWithAsyncio('127.0.0.1', 0, 'machine.log').options == {}
+    server.executor.shutdown()
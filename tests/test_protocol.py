@@ -0,0 +1,49 @@
+import asyncio
+import pytest
+from protocol import FrameDecoder, Protocol, ProtocolError
+
+
+def test_frame_round_trip():
+    frame = Protocol.encode_frame(Protocol.FRAME_REQUEST, 7, b"search ['INFO']")
+    frame_type, request_id, length = Protocol.decode_header(frame[:Protocol.HEADER.size])
+    assert (frame_type, request_id, length) == (Protocol.FRAME_REQUEST, 7, len(b"search ['INFO']"))
+
+
+def test_batch_and_summary_payloads():
+    frame = Protocol.encode_batch(3, 2, b'a\nb\n')
+    assert Protocol.decode_batch(frame[Protocol.HEADER.size:]) == (2, b'a\nb\n')
+    frame = Protocol.encode_summary(3, {'files': [{'file': 'x.log', 'count': 2}]})
+    assert Protocol.decode_summary(frame[Protocol.HEADER.size:]) == {'files': [{'file': 'x.log', 'count': 2}]}
+
+
+def test_decoder_reassembles_frames_from_arbitrary_pieces():
+    frames = [Protocol.encode_frame(Protocol.FRAME_REQUEST, i, b'x' * i) for i in range(1, 6)]
+    data = b''.join(frames)
+    decoder = FrameDecoder()
+    decoded = []
+    for i in range(0, len(data), 3):
+        decoded.extend(decoder.feed(data[i:i + 3]))
+    assert decoded == [(Protocol.FRAME_REQUEST, i, b'x' * i) for i in range(1, 6)]
+    assert not decoder.buffer
+
+
+def test_unsupported_version_is_rejected():
+    header = Protocol.HEADER.pack(Protocol.VERSION + 1, Protocol.FRAME_REQUEST, 1, 0)
+    with pytest.raises(ProtocolError):
+        Protocol.decode_header(header)
+
+
+def test_oversized_frame_is_rejected():
+    header = Protocol.HEADER.pack(Protocol.VERSION, Protocol.FRAME_BATCH, 1, Protocol.MAX_FRAME_SIZE + 1)
+    with pytest.raises(ProtocolError):
+        FrameDecoder().feed(header)
+
+
+def test_read_frame_from_stream():
+    async def read():
+        reader = asyncio.StreamReader()
+        reader.feed_data(Protocol.encode_frame(Protocol.FRAME_ERROR, 2, b'invalid query'))
+        reader.feed_eof()
+        return await Protocol.read_frame(reader), await Protocol.read_frame(reader)
+
+    assert asyncio.run(read()) == ((Protocol.FRAME_ERROR, 2, b'invalid query'), None)
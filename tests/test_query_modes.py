@@ -0,0 +1,72 @@
+from log_searcher import LogSearcher
+from parallel_scan import ParallelScanner
+from tests.support import SAMPLE_LINES, run_query
+
+
+def test_count_sends_no_lines(write_log):
+    searcher = LogSearcher.create(write_log(SAMPLE_LINES), {})
+    lines, summary = run_query(searcher, "search ['PacketResponder'] count")
+    assert lines == []
+    assert summary['files'] == [{'file': 'machine.log', 'count': 3}]
+
+
+def test_count_does_not_cache_the_matched_lines(write_log):
+    searcher = LogSearcher.create(write_log(SAMPLE_LINES), {'cache_size': 1024 * 1024})
+    run_query(searcher, "search ['PacketResponder'] count")
+    assert searcher.cache.nbytes == 0
+
+
+def test_count_uses_a_cached_result(write_log):
+    searcher = LogSearcher.create(write_log(SAMPLE_LINES), {'cache_size': 1024 * 1024})
+    run_query(searcher, "search ['PacketResponder']")
+    _, summary = run_query(searcher, "search ['PacketResponder'] count")
+    assert summary['files'][0]['count'] == 3
+    assert summary['bytes_scanned'] == 0
+
+
+def test_count_with_a_field_query(write_log):
+    searcher = LogSearcher.create(write_log(SAMPLE_LINES), {})
+    _, summary = run_query(searcher, "search ['blk_'] count where level=WARN")
+    assert summary['files'][0]['count'] == 1
+
+
+def test_count_with_scan_workers(write_log, monkeypatch):
+    monkeypatch.setattr(ParallelScanner, 'RANGE_SIZE', 4096)
+    searcher = LogSearcher.create(write_log(SAMPLE_LINES * 200), {'scan_workers': 2})
+    try:
+        _, summary = run_query(searcher, "search ['Receiving block'] count")
+    finally:
+        searcher.scanner.shutdown()
+    assert summary['files'][0]['count'] == 400
+
+
+def test_exists_stops_at_the_first_match(write_log):
+    searcher = LogSearcher.create(write_log(SAMPLE_LINES), {})
+    lines, summary = run_query(searcher, "search ['Receiving block'] exists")
+    assert lines == []
+    assert summary['exists'] is True
+    _, summary = run_query(searcher, "search ['no such line'] exists")
+    assert summary['exists'] is False
+
+
+def test_limit_is_flagged_truncated_only_past_the_limit(write_log):
+    searcher = LogSearcher.create(write_log(SAMPLE_LINES), {})
+    lines, summary = run_query(searcher, "search ['PacketResponder'] limit 2")
+    assert lines == [SAMPLE_LINES[0], SAMPLE_LINES[1]]
+    assert summary['files'][0] == {'file': 'machine.log', 'count': 2, 'truncated': True}
+    lines, summary = run_query(searcher, "search ['PacketResponder'] limit 3")
+    assert len(lines) == 3
+    assert 'truncated' not in summary['files'][0]
+
+
+def test_head_and_tail(write_log):
+    searcher = LogSearcher.create(write_log(SAMPLE_LINES), {})
+    lines, summary = run_query(searcher, "search ['blk_'] head 2")
+    assert lines == SAMPLE_LINES[:2]
+    assert summary['files'][0]['truncated'] is True
+    lines, summary = run_query(searcher, "search ['blk_'] tail 2")
+    assert lines == SAMPLE_LINES[5:7]
+    assert summary['files'][0]['truncated'] is True
+    lines, summary = run_query(searcher, "search ['Receiving block'] tail 2")
+    assert lines == SAMPLE_LINES[5:7]
+    assert 'truncated' not in summary['files'][0]
@@ -0,0 +1,88 @@
+import asyncio
+from query_scheduler import QueryScheduler
+
+
+async def start_queries(scheduler, clients, started):
+    async def query(client, number):
+        await scheduler.acquire(client)
+        started.append((client, number))
+
+    tasks = [asyncio.create_task(query(client, number)) for number, client in enumerate(clients)]
+    # let every query run up to its turn
+    await asyncio.sleep(0)
+    return tasks
+
+
+def test_a_client_alone_uses_all_the_slots():
+    async def run():
+        scheduler = QueryScheduler(4)
+        started = []
+        await start_queries(scheduler, ['a'] * 5 + ['b'], started)
+        assert started == [('a', 0), ('a', 1), ('a', 2), ('a', 3)]
+        # b waits, so a holds at most half of the slots from now on
+        scheduler.release('a')
+        assert scheduler.active_per_client == {'a': 3, 'b': 1}
+        # nobody else waits any more, a may exceed its half again
+        scheduler.release('a')
+        assert scheduler.active_per_client == {'a': 3, 'b': 1} and scheduler.waiting == {}
+
+    asyncio.run(run())
+
+
+def test_free_slots_go_to_the_waiting_clients_in_turn():
+    async def run():
+        scheduler = QueryScheduler(2)
+        started = []
+        await start_queries(scheduler, ['a', 'b', 'a', 'a', 'b', 'c'], started)
+        assert started == [('a', 0), ('b', 1)]
+        scheduler.release('a')
+        await asyncio.sleep(0)
+        scheduler.release('b')
+        await asyncio.sleep(0)
+        scheduler.release('a')
+        await asyncio.sleep(0)
+        return started
+
+    # a's waiting query is not served twice in a row while b and c wait
+    assert asyncio.run(run()) == [('a', 0), ('b', 1), ('a', 2), ('b', 4), ('c', 5)]
+
+
+def test_cancelled_waiting_query_gives_up_its_turn():
+    async def run():
+        scheduler = QueryScheduler(2)
+        started = []
+        tasks = await start_queries(scheduler, ['a', 'b', 'a'], started)
+        tasks[2].cancel()
+        await asyncio.sleep(0)
+        scheduler.release('a')
+        await asyncio.sleep(0)
+        return started, scheduler.active, dict(scheduler.waiting)
+
+    started, active, waiting = asyncio.run(run())
+    assert started == [('a', 0), ('b', 1)]
+    assert active == 1 and waiting == {}
+
+
+def test_query_stops_waiting_when_it_is_cancelled():
+    async def run():
+        scheduler = QueryScheduler(1)
+        started = []
+        await start_queries(scheduler, ['a'], started)
+        stop = asyncio.get_running_loop().create_future()
+        waiting = asyncio.create_task(scheduler.acquire('a', stop))
+        await asyncio.sleep(0)
+        stop.set_result(None)
+        admitted = await waiting
+        return admitted, scheduler.active, dict(scheduler.waiting)
+
+    assert asyncio.run(run()) == (False, 1, {})
+
+
+def test_submitted_queries_are_started_by_the_release_of_a_slot():
+    scheduler = QueryScheduler(1)
+    started = []
+    assert scheduler.submit('a', lambda: started.append(1))
+    assert not scheduler.submit('b', lambda: started.append(2))
+    assert started == [1]
+    scheduler.release('a')
+    assert started == [1, 2] and scheduler.active_per_client == {'b': 1}
@@ -0,0 +1,73 @@
+import asyncio
+from client.client import Client, fetch_server_details_from_config_file
+from protocol import Protocol
+from tests.support import SAMPLE_LINES, decode_response, serve_logs
+
+
+'''
+serve a server which reads the request frames and never answers, returns the listener and the frame types received
+'''
+async def serve_silently():
+    received = []
+
+    async def handle(reader, writer):
+        while True:
+            frame = await Protocol.read_frame(reader)
+            if frame is None:
+                break
+            received.append(frame[0])
+
+    listener = await asyncio.start_server(handle, '127.0.0.1', 0)
+    return listener, received
+
+
+def test_replicas_follow_their_server_in_the_config_file(tmp_path):
+    config = tmp_path / 'servers.conf'
+    config.write_text('host1, 4000 | host2, 4001 | host3, 4002\nhost4, 4003\n')
+    servers, replicas = fetch_server_details_from_config_file(str(config))
+    assert servers == [('host1', 4000), ('host4', 4003)]
+    assert replicas == {('host1', 4000): [('host2', 4001), ('host3', 4002)]}
+
+
+def test_hedge_delay_is_a_percentile_of_the_response_times():
+    client = Client()
+    client.latencies.extend([0.01] * (Client.MIN_LATENCY_SAMPLES - 1))
+    assert client.hedge_delay() == Client.DEFAULT_HEDGE_DELAY
+    client.latencies.extend([0.01] * 80 + [0.2] * 19)
+    assert client.hedge_delay() == 0.2
+
+
+def test_failed_server_is_replaced_by_its_replica(write_log):
+    async def run():
+        async with serve_logs(write_log(SAMPLE_LINES)) as (_, port):
+            client = Client(replicas={('127.0.0.1', 1): [('127.0.0.1', port)]})
+            replica, responses, frame = await client.open_response('127.0.0.1', 1, "search ['WARN']")
+            frames = [frame] + [frame async for frame in responses]
+            await client.close()
+            return replica, port, frames
+
+    replica, port, frames = asyncio.run(run())
+    assert replica == ('127.0.0.1', port)
+    lines, _ = decode_response(Protocol.encode_frame(frame_type, 1, payload) for frame_type, payload in frames)
+    assert lines == [SAMPLE_LINES[4]]
+
+
+def test_slow_server_is_hedged_and_its_query_cancelled(write_log, monkeypatch):
+    monkeypatch.setattr(Client, 'DEFAULT_HEDGE_DELAY', 0.05)
+
+    async def run():
+        listener, received = await serve_silently()
+        slow_port = listener.sockets[0].getsockname()[1]
+        async with serve_logs(write_log(SAMPLE_LINES)) as (_, port):
+            client = Client(replicas={('127.0.0.1', slow_port): [('127.0.0.1', port)]})
+            num_lines, logs = await client.fetch_logs_from_server('127.0.0.1', slow_port, "search ['WARN']")
+            while Protocol.FRAME_CANCEL not in received:
+                await asyncio.sleep(0.01)
+            await client.close()
+        listener.close()
+        return num_lines, logs, port, received
+
+    num_lines, logs, port, received = asyncio.run(run())
+    assert num_lines == 1
+    assert logs.endswith(f'answered by replica 127.0.0.1:{port}\n')
+    assert received.count(Protocol.FRAME_REQUEST) == 1
@@ -0,0 +1,63 @@
+import os
+from log_searcher import LogSearcher
+from result_cache import CachedResult, ResultCache
+from tests.support import SAMPLE_LINES, run_query
+
+
+def cached_searcher(log_file):
+    return LogSearcher.create(log_file, {'cache_size': 1024 * 1024})
+
+
+def test_unchanged_file_is_served_from_the_cache(write_log):
+    searcher = cached_searcher(write_log(SAMPLE_LINES))
+    first = run_query(searcher, "search ['Receiving block']")
+    second = run_query(searcher, "search ['Receiving block']")
+    assert first[0] == second[0] == SAMPLE_LINES[5:7]
+    assert first[1]['bytes_scanned'] > 0
+    assert second[1]['bytes_scanned'] == 0
+
+
+def test_only_appended_data_is_searched(write_log):
+    log_file = write_log(SAMPLE_LINES)
+    searcher = cached_searcher(log_file)
+    run_query(searcher, "search ['Receiving block']")
+    with open(log_file, 'ab') as f:
+        f.write(SAMPLE_LINES[5] + b'\n')
+    lines, summary = run_query(searcher, "search ['Receiving block']")
+    assert lines == SAMPLE_LINES[5:7] + [SAMPLE_LINES[5]]
+    assert summary['bytes_scanned'] == len(SAMPLE_LINES[5]) + 1
+
+
+def test_rewritten_file_is_searched_again(write_log):
+    log_file = write_log(SAMPLE_LINES)
+    searcher = cached_searcher(log_file)
+    run_query(searcher, "search ['WARN']")
+    os.remove(log_file)
+    write_log(list(reversed(SAMPLE_LINES)) + [SAMPLE_LINES[4]])
+    lines, summary = run_query(searcher, "search ['WARN']")
+    assert lines == [SAMPLE_LINES[4]] * 2
+    assert summary['bytes_scanned'] == os.path.getsize(log_file)
+
+
+def test_search_string_order_does_not_matter():
+    assert ResultCache.make_key(['a', 'b', 'a'], 'x.log') == ResultCache.make_key(['b', 'a'], 'x.log')
+
+
+def test_least_recently_used_results_are_evicted():
+    cache = ResultCache(400)
+
+    def entry(nbytes):
+        return CachedResult(1, 0, 0, 0, b'', [(1, b'x' * nbytes)])
+
+    cache.put('a', entry(100))
+    cache.put('b', entry(100))
+    cache.get('a')
+    cache.put('c', entry(100))
+    cache.put('d', entry(100))
+    cache.put('e', entry(100))
+    assert cache.get('b') is None
+    assert all(cache.get(key) is not None for key in 'acde')
+    assert cache.nbytes == 400
+    # a result larger than a quarter of the budget is not cached at all
+    cache.put('f', entry(101))
+    assert cache.get('f') is None
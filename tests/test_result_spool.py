@@ -0,0 +1,60 @@
+import asyncio
+import sys
+from client import client as client_module
+from client.client import Client, ResultSpool, process_cmd_line_args
+from tests.support import SAMPLE_LINES, serve_logs
+
+
+def test_lines_are_read_back_in_chunks_of_complete_lines(monkeypatch):
+    monkeypatch.setattr(ResultSpool, 'READ_SIZE', 100)
+    spool = ResultSpool(1024)
+    data = b''.join(line + b'\n' for line in SAMPLE_LINES)
+    spool.write(data)
+    chunks = []
+    while spool.pending():
+        chunks.append(spool.read())
+    assert b''.join(chunks) == data
+    # every chunk ends at a line, lines longer than a chunk are read whole
+    assert all(chunk.endswith(b'\n') and chunk.count(b'\n') == 1 for chunk in chunks)
+    spool.close()
+
+
+def test_spool_moves_to_disk_beyond_its_memory_and_is_emptied_once_read():
+    spool = ResultSpool(256)
+    spool.write(SAMPLE_LINES[0] + b'\n')
+    assert not spool.file._rolled
+    spool.write(b''.join(line + b'\n' for line in SAMPLE_LINES))
+    assert spool.file._rolled
+    spool.read()
+    spool.read()
+    assert spool.pending() == 0 and spool.write_position == 0
+    spool.write(SAMPLE_LINES[1] + b'\n')
+    assert spool.read() == SAMPLE_LINES[1] + b'\n'
+    spool.close()
+
+
+def test_responses_are_spooled_to_disk_without_result_memory(write_log, monkeypatch, capfd):
+    sizes = []
+
+    class RecordingSpool(ResultSpool):
+        def __init__(self, max_size):
+            sizes.append(max_size)
+            super().__init__(max_size)
+
+    monkeypatch.setattr(client_module, 'ResultSpool', RecordingSpool)
+
+    async def run():
+        async with serve_logs(write_log(SAMPLE_LINES)) as (_, port):
+            client = Client(max_result_memory=0)
+            results = await client.print_merged_responses([('127.0.0.1', port)] * 2, "search ['WARN']")
+            await client.close()
+            return results
+
+    assert [num_lines for num_lines, _ in asyncio.run(run())] == [1, 1]
+    assert sizes == [1, 1]
+    assert capfd.readouterr().out.count('Got exception') == 2
+
+
+def test_result_memory_option(monkeypatch):
+    monkeypatch.setattr(sys, 'argv', ['client.py', '--maxResultMemory=3'])
+    assert process_cmd_line_args()[2] == 3 * 1024 * 1024
@@ -0,0 +1,63 @@
+import time
+from search_engine import SearchEngine
+from tests.support import SAMPLE_LINES
+
+
+def test_matches_any_search_string(write_log):
+    path = write_log(SAMPLE_LINES)
+    engine = SearchEngine(['WARN', 'allocateBlock'])
+    count, lines = engine.search_file(path)
+    assert count == 2
+    assert lines == [SAMPLE_LINES[4] + b'\n', SAMPLE_LINES[7] + b'\n']
+    assert engine.bytes_scanned == len(b''.join(line + b'\n' for line in SAMPLE_LINES))
+
+
+def test_class_docstring_describes_the_engine():
+    assert SearchEngine.__doc__.strip().startswith('Compile the OR-ed search strings')
+
+
+def test_anchors_match_line_boundaries(write_log):
+    path = write_log(SAMPLE_LINES)
+    assert SearchEngine(['terminating$']).search_file(path)[0] == 3
+    assert SearchEngine(['^081109 2040']).search_file(path)[0] == 2
+
+
+def test_match_spanning_a_newline_is_not_a_match(write_log):
+    path = write_log([b'abc', b'def'])
+    # [^x]* crosses the newline between the lines, grep only matches within a line
+    assert SearchEngine(['c[^x]*d']).search_file(path)[0] == 0
+
+
+def test_scan_byte_range(write_log):
+    path = write_log(SAMPLE_LINES)
+    start = len(SAMPLE_LINES[0]) + 1
+    end = start + len(SAMPLE_LINES[1]) + 1
+    assert list(SearchEngine(['PacketResponder']).iter_file_matches(path, start, end)) == [SAMPLE_LINES[1] + b'\n']
+
+
+def test_empty_file(write_log):
+    assert SearchEngine(['a']).search_file(write_log([]))[0] == 0
+
+
+def test_required_literal():
+    assert SearchEngine.required_literal('Receiving block blk_\\d+') == b'Receiving block blk_'
+    assert SearchEngine.required_literal('a|b') == b''
+    assert SearchEngine.required_literal('(?i)warn') == b''
+
+
+def test_stops_at_deadline(write_log):
+    path = write_log(SAMPLE_LINES)
+    engine = SearchEngine(['INFO'])
+    engine.deadline = time.time() - 1
+    assert engine.search_file(path)[0] == 0
+    assert engine.stopped
+
+
+def test_tail_file_matches(write_log):
+    path = write_log(SAMPLE_LINES)
+    assert SearchEngine(['INFO']).tail_file_matches(path, 2) == [SAMPLE_LINES[6] + b'\n', SAMPLE_LINES[7] + b'\n']
+
+
+def test_group_blocks():
+    blocks = list(SearchEngine.group_blocks(iter([b'aaaa\n', b'bb\n', b'c\n']), 6))
+    assert blocks == [(2, b'aaaa\nbb\n'), (1, b'c\n')]
@@ -0,0 +1,121 @@
+import selectors
+import socket
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from log_searcher import LogSearcher
+from protocol import FrameDecoder, Protocol
+from query_scheduler import QueryScheduler
+from server_with_selects import ClientConnection, ServerWithSelect
+from tests.support import SAMPLE_LINES
+
+
+class SelectServer(object):
+
+    '''
+    a selector server with one connected client, the functions the executor hands to the selector loop are run by
+    the test
+    '''
+    def __init__(self, log_file: str, max_queries: int) -> None:
+        self.server = ServerWithSelect()
+        self.server.searcher = LogSearcher.create(log_file, {})
+        self.server.scheduler = QueryScheduler(max_queries)
+        self.server.executor = ThreadPoolExecutor(max_workers=max_queries)
+        self.server.selector = selectors.DefaultSelector()
+        self.client_socket, server_socket = socket.socketpair()
+        self.client_socket.settimeout(5)
+        server_socket.setblocking(False)
+        self.server.selector.register(server_socket, selectors.EVENT_READ)
+        self.connection = ClientConnection(server_socket, 'client')
+        self.server.clients[server_socket] = self.connection
+        self.decoder = FrameDecoder()
+        # response frames received by the client by request id
+        self.responses = {}
+
+    def send(self, frame_type: int, request_id: int, payload: bytes = b'') -> None:
+        self.client_socket.sendall(Protocol.encode_frame(frame_type, request_id, payload))
+        self.server.receive(self.connection)
+
+    '''
+    run the functions handed to the selector loop until the response of a query ended and the query gave up its slot
+    '''
+    def run_until_end(self, request_id: int) -> list:
+        while not self.ended(request_id) or request_id in self.connection.admitted:
+            self.server.completions.get(timeout=5)()
+            self.receive_frames()
+        return self.responses[request_id]
+
+    def receive_frames(self) -> None:
+        self.client_socket.setblocking(False)
+        try:
+            while True:
+                for frame_type, request_id, payload in self.decoder.feed(self.client_socket.recv(65536)):
+                    self.responses.setdefault(request_id, []).append((frame_type, payload))
+        except BlockingIOError:
+            pass
+        finally:
+            self.client_socket.settimeout(5)
+
+    def ended(self, request_id: int) -> bool:
+        return any(frame_type == Protocol.FRAME_SUMMARY for frame_type, _ in self.responses.get(request_id, []))
+
+    def close(self) -> None:
+        self.server.executor.shutdown()
+        self.client_socket.close()
+
+
+@pytest.fixture
+def select_server(write_log):
+    servers = []
+
+    def create(max_queries):
+        servers.append(SelectServer(write_log(SAMPLE_LINES), max_queries))
+        return servers[-1]
+
+    yield create
+    for server in servers:
+        server.close()
+
+
+def test_a_client_waits_for_its_share_of_the_query_slots(select_server):
+    server = select_server(2)
+    server.send(Protocol.FRAME_REQUEST, 1, b"search ['WARN']")
+    server.send(Protocol.FRAME_REQUEST, 2, b"search ['dfs']")
+    # a client alone on the server uses all the slots
+    assert server.connection.admitted == {1, 2}
+    started = []
+    server.server.scheduler.submit('other', lambda: started.append('other'))
+    server.send(Protocol.FRAME_REQUEST, 3, b"search ['Receiving']")
+    assert list(server.connection.waiting) == [3]
+    # while the other client waits the client holds at most half of the slots
+    server.run_until_end(1)
+    assert started == ['other'] and server.connection.admitted == {2}
+    server.run_until_end(2)
+    assert server.connection.admitted == {3} and server.connection.waiting == {}
+    frames = server.run_until_end(3)
+    assert Protocol.decode_batch(frames[0][1]) == (2, b''.join(line + b'\n' for line in SAMPLE_LINES[5:7]))
+    server.server.scheduler.release('other')
+    assert server.server.scheduler.active == 0
+
+
+def test_cancelled_query_leaves_the_queue(select_server):
+    server = select_server(1)
+    # another client holds the only query slot
+    server.server.scheduler.submit('other', lambda: None)
+    server.send(Protocol.FRAME_REQUEST, 1, b"search ['dfs']")
+    assert list(server.connection.waiting) == [1]
+    server.send(Protocol.FRAME_CANCEL, 1)
+    frames = server.run_until_end(1)
+    assert [frame_type for frame_type, _ in frames] == [Protocol.FRAME_SUMMARY]
+    assert Protocol.decode_summary(frames[0][1])['partial'] == 'cancelled'
+    assert server.server.scheduler.waiting == {} and server.server.scheduler.active == 1
+
+
+def test_closed_connection_gives_up_its_slots(select_server):
+    server = select_server(1)
+    server.send(Protocol.FRAME_REQUEST, 1, b"search ['dfs']")
+    server.send(Protocol.FRAME_REQUEST, 2, b"search ['dfs']")
+    server.server.close(server.connection)
+    assert server.server.scheduler.waiting == {}
+    # the search in flight gives up its slot once it returns to the selector loop
+    server.server.completions.get(timeout=5)()
+    assert server.server.scheduler.active == 0
@@ -0,0 +1,182 @@
+import threading
+import pytest
+import shared_scan
+from common import Common
+from parallel_scan import ParallelScanner
+from search_engine import SearchEngine
+from shared_scan import ScanCoalescer, ScanMember, SharedScan
+from tests.support import SAMPLE_LINES
+
+LOG_LINES = SAMPLE_LINES * 50
+
+
+def expected_lines(log_file, search_strings):
+    return list(SearchEngine(search_strings).iter_file_matches(log_file))
+
+
+def lines_of(blocks):
+    return [line + b'\n' for _, lines in blocks for line in lines.splitlines()]
+
+
+@pytest.fixture
+def scans(monkeypatch):
+    sizes = []
+    run = SharedScan.run
+
+    def record(shared_scan):
+        sizes.append(len(shared_scan.members))
+        run(shared_scan)
+
+    monkeypatch.setattr(SharedScan, 'run', record)
+    return sizes
+
+
+def test_concurrent_queries_share_a_scan(write_log, scans):
+    log_file = write_log(LOG_LINES)
+    coalescer = ScanCoalescer(0.2)
+    queries = [['WARN'], ['Receiving block'], ['PacketResponder [02]']]
+    results = {}
+
+    def search(search_strings):
+        results[search_strings[0]] = lines_of(coalescer.iter_file_blocks(SearchEngine(search_strings), log_file))
+
+    threads = [threading.Thread(target=search, args=(search_strings,)) for search_strings in queries]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert scans == [3]
+    for search_strings in queries:
+        assert results[search_strings[0]] == expected_lines(log_file, search_strings)
+
+
+
+def test_queries_with_groups_are_searched_on_their_own(write_log, scans):
+    log_file = write_log(LOG_LINES)
+    coalescer = ScanCoalescer(0.2)
+    # the backreferences would refer to the group of the other query in a combined regex
+    queries = [[r'blk_-?\d*(\d)\1'], [r'(Receiving) block'], ['WARN']]
+    results = {}
+
+    def search(search_strings):
+        results[search_strings[0]] = lines_of(coalescer.iter_file_blocks(SearchEngine(search_strings), log_file))
+
+    threads = [threading.Thread(target=search, args=(search_strings,)) for search_strings in queries]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert sorted(scans) == [1, 1, 1]
+    for search_strings in queries:
+        assert results[search_strings[0]] == expected_lines(log_file, search_strings)
+
+
+def test_cancelled_query_stops_waiting_for_the_shared_scan(write_log, monkeypatch):
+    started = threading.Event()
+    release = threading.Event()
+    run = SharedScan.run
+
+    def wait(shared_scan):
+        started.set()
+        release.wait(5)
+        run(shared_scan)
+
+    monkeypatch.setattr(SharedScan, 'run', wait)
+    engine = SearchEngine(['dfs'])
+    results = []
+    thread = threading.Thread(target=lambda: results.append(lines_of(
+        ScanCoalescer(0).iter_file_blocks(engine, write_log(LOG_LINES)))))
+    thread.start()
+    try:
+        assert started.wait(5)
+        engine.cancelled = True
+        # the query ends while the shared scan still holds off
+        thread.join(1)
+        assert results == [[]] and engine.stopped
+    finally:
+        release.set()
+
+def test_slow_query_is_detached_without_holding_back_the_others(write_log, scans, monkeypatch):
+    # every matched line is a block of its own, the fast query has fewer lines than a query may hold
+    monkeypatch.setattr(Common, 'RESPONSE_CHUNK_SIZE', 1)
+    monkeypatch.setattr(ScanMember, 'MAX_QUEUED_BLOCKS', 100)
+    detached = []
+    detach = ScanMember.detach
+
+    def record(member):
+        detached.append((member.engine.search_strings, member.position))
+        detach(member)
+
+    monkeypatch.setattr(ScanMember, 'detach', record)
+    log_file = write_log(LOG_LINES)
+    coalescer = ScanCoalescer(0.2)
+    fast_done = threading.Event()
+    results = {}
+
+    def fast():
+        results['fast'] = lines_of(coalescer.iter_file_blocks(SearchEngine(['WARN']), log_file))
+        fast_done.set()
+
+    def slow():
+        blocks = coalescer.iter_file_blocks(SearchEngine(['dfs']), log_file)
+        first = next(blocks)
+        # the slow query takes nothing more until the fast one has all of its lines
+        fast_done.wait(5)
+        results['slow'] = lines_of([first]) + lines_of(blocks)
+
+    threads = [threading.Thread(target=slow), threading.Thread(target=fast)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert scans == [2]
+    assert results['fast'] == expected_lines(log_file, ['WARN'])
+    assert results['slow'] == expected_lines(log_file, ['dfs'])
+    assert [search_strings for search_strings, _ in detached] == [['dfs']]
+    # the slow query searched on its own from a line boundary after its first lines
+    position = detached[0][1]
+    with open(log_file, 'rb') as f:
+        assert 0 < position < len(f.read())
+
+
+def test_queries_detached_from_a_parallel_scan_resume_at_a_range(write_log, monkeypatch):
+    monkeypatch.setattr(ParallelScanner, 'RANGE_SIZE', 4096)
+    monkeypatch.setattr(ScanMember, 'MAX_QUEUED_BLOCKS', 1)
+    log_file = write_log(LOG_LINES)
+    ranges = ParallelScanner.split_ranges(log_file)
+    scanner = ParallelScanner(2)
+    try:
+        coalescer = ScanCoalescer(0.2, scanner)
+        engines = [SearchEngine(['dfs']), SearchEngine(['blk_'])]
+        members = [coalescer.iter_file_blocks(engine, log_file) for engine in engines]
+        results = {}
+        # the second query takes nothing more until the first one has all of its lines
+        threads = [threading.Thread(target=lambda: results.update(first=lines_of(members[0]))),
+                   threading.Thread(target=lambda: results.update(second=next(members[1])))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        assert results['first'] == expected_lines(log_file, ['dfs'])
+        assert lines_of([results['second']]) + lines_of(members[1]) == expected_lines(log_file, ['blk_'])
+    finally:
+        scanner.shutdown()
+    assert all(engine.bytes_scanned == ranges[-1][1] for engine in engines)
+
+
+def test_abandoned_query_leaves_the_shared_scan(write_log):
+    log_file = write_log(LOG_LINES)
+    coalescer = ScanCoalescer(0.01)
+    blocks = coalescer.iter_file_blocks(SearchEngine(['dfs']), log_file)
+    assert next(blocks)
+    blocks.close()
+    assert lines_of(coalescer.iter_file_blocks(SearchEngine(['WARN']), log_file)) == \
+        expected_lines(log_file, ['WARN'])
+
+
+def test_coalescing_is_off_by_default(write_log):
+    _, _, _, options = Common.parse_server_cmdline_args([])
+    assert options['coalesce_window'] == 0
+    _, _, _, options = Common.parse_server_cmdline_args(['--coalescewindow=10'])
+    assert options['coalesce_window'] == 0.01
+    assert shared_scan.ScanCoalescer(options['coalesce_window']).executor._max_workers == Common.DEFAULT_MAX_QUERIES
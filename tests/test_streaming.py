@@ -0,0 +1,46 @@
+from common import Common
+from log_searcher import LogSearcher
+from protocol import Protocol
+from tests.support import SAMPLE_LINES, decode_response, run_query
+
+
+def test_response_is_streamed_in_bounded_batches(write_log):
+    lines = [SAMPLE_LINES[i % len(SAMPLE_LINES)] for i in range(8000)]
+    searcher = LogSearcher(write_log(lines))
+    _, frames = searcher.prepare_search_response("search ['INFO']", 1)
+
+    frames = list(frames)
+    batches = frames[:-1]
+    assert len(batches) > 1
+    for frame in batches:
+        assert frame[1] == Protocol.FRAME_BATCH
+        # a batch ends once it reached the chunk size, with at most one block of matched lines beyond it
+        assert len(frame) < 3 * Common.RESPONSE_CHUNK_SIZE
+
+    matched, summary = decode_response(frames)
+    assert len(matched) == 7000
+    assert summary['files'] == [{'file': 'machine.log', 'count': 7000}]
+
+
+def test_summary_only_without_matches(write_log):
+    searcher = LogSearcher(write_log(SAMPLE_LINES))
+    _, frames = searcher.prepare_search_response("search ['no such line']", 1)
+    frames = list(frames)
+    assert len(frames) == 1 and frames[0][1] == Protocol.FRAME_SUMMARY
+    assert decode_response(frames)[1]['files'][0]['count'] == 0
+
+
+def test_multiple_files_prefix_lines_with_their_path(write_log):
+    first = write_log(SAMPLE_LINES[:4], 'a.log')
+    write_log(SAMPLE_LINES[4:], 'b.log')
+    searcher = LogSearcher(first.replace('a.log', '*.log'))
+    matched, summary = run_query(searcher, "search ['WARN']")
+    assert matched == [first.replace('a.log', 'b.log').encode() + b':' + SAMPLE_LINES[4]]
+    assert [f['count'] for f in summary['files']] == [0, 1]
+
+
+def test_invalid_query_is_answered_with_an_error(write_log):
+    searcher = LogSearcher(write_log(SAMPLE_LINES))
+    return_code, frames = searcher.prepare_search_response('grep INFO', 1)
+    assert return_code == 1
+    assert decode_response(frames)[1]['error'].startswith('invalid query')
@@ -0,0 +1,65 @@
+import os
+import time
+import pytest
+from log_searcher import LogSearcher
+from search_query import SearchQuery
+from time_index import TimeIndex
+from tests.support import SAMPLE_LINES, run_query
+
+# the sample lines with a timestamp one second after the other
+TIMED_LINES = [b'081109 20%02d%02d' % divmod(i, 60) + SAMPLE_LINES[i % len(SAMPLE_LINES)][13:] for i in range(2000)]
+
+
+@pytest.fixture
+def small_samples(monkeypatch):
+    monkeypatch.setattr(TimeIndex, 'SAMPLE_INTERVAL', 4096)
+
+
+def test_only_lines_of_the_window_are_matched(write_log):
+    searcher = LogSearcher.create(write_log(SAMPLE_LINES), {})
+    lines, _ = run_query(searcher, "search ['dfs'] from 081109 203807 to 081109 204132")
+    assert lines == SAMPLE_LINES[1:6]
+
+
+def test_only_the_byte_range_of_the_window_is_searched(write_log, small_samples):
+    log_file = write_log(TIMED_LINES)
+    searcher = LogSearcher.create(log_file, {})
+    lines, summary = run_query(searcher, "search ['Receiving block'] from 081109 201000 to 081109 201059")
+    assert lines == [line for line in TIMED_LINES[600:660] if b'Receiving block' in line]
+    assert summary['bytes_scanned'] < os.path.getsize(log_file) // 4
+
+
+def test_lines_without_a_timestamp_are_kept():
+    lines = b'081109 203615 first\n    at continuation\n081109 204453 last\n'
+    assert list(TimeIndex.filter_blocks((block for block in [(3, lines)]), b'081109 203000', b'081109 204000')) == \
+        [(2, b'081109 203615 first\n    at continuation\n')]
+
+
+def test_index_follows_the_growing_file(write_log, small_samples):
+    log_file = write_log(TIMED_LINES[:1000])
+    time_index = TimeIndex(log_file)
+    time_index.update()
+    samples = len(time_index.timestamps)
+    with open(log_file, 'ab') as f:
+        f.write(b''.join(line + b'\n' for line in TIMED_LINES[1000:]))
+    start, end = time_index.byte_range(b'081109 202500', None)
+    assert len(time_index.timestamps) > samples
+    assert start > os.path.getsize(log_file) // 2 and end is None
+    assert time_index.timestamps == sorted(time_index.timestamps)
+
+
+def test_index_starts_over_for_a_rotated_file(write_log, small_samples):
+    log_file = write_log(TIMED_LINES)
+    time_index = TimeIndex(log_file)
+    time_index.update()
+    os.remove(log_file)
+    write_log(TIMED_LINES[:10])
+    assert time_index.byte_range(b'081109 200005', b'081109 200006') == (0, None)
+    assert len(time_index.timestamps) == 1
+
+
+def test_last_sets_the_start_of_the_window():
+    search_query = SearchQuery.parse("search ['blk_'] last 2h")
+    time_from = time.mktime(time.strptime(search_query.time_from, '%y%m%d %H%M%S'))
+    assert search_query.time_to is None
+    assert abs(time.time() - 7200 - time_from) < 2
@@ -0,0 +1,161 @@
+import os
+import pickle
+import token_index
+from search_engine import SearchEngine
+from token_index import LogIndexer, TokenIndex
+from tests.support import SAMPLE_LINES
+
+# the WARN line is rare enough for the index to select it
+LINES = [SAMPLE_LINES[i % 4] for i in range(400)] + [SAMPLE_LINES[4]]
+
+
+def build_index(log_file, tmp_path):
+    index = TokenIndex(log_file, str(tmp_path / 'machine.idx'))
+    assert index.update()
+    return index
+
+
+def test_candidate_lines_contain_the_literal(write_log, tmp_path):
+    log_file = write_log(LINES)
+    index = build_index(log_file, tmp_path)
+    spans, indexed_size = index.candidate_spans([b'Got exception'])
+    assert indexed_size == os.path.getsize(log_file)
+    assert len(spans) == 1
+
+    engine = SearchEngine(['Got exception'])
+    assert list(engine.iter_indexed_matches(log_file, spans, indexed_size)) == [SAMPLE_LINES[4] + b'\n']
+    # only the candidate line was read
+    assert engine.bytes_scanned == len(SAMPLE_LINES[4]) + 1
+
+
+def test_frequent_or_short_literals_are_not_narrowed_down(write_log, tmp_path):
+    index = build_index(write_log(LINES), tmp_path)
+    assert index.candidate_spans([b'PacketResponder']) is None
+    assert index.candidate_spans([b'ab']) is None
+
+
+def test_appended_lines_are_indexed_incrementally(write_log, tmp_path):
+    log_file = write_log(LINES)
+    index = build_index(log_file, tmp_path)
+    with open(log_file, 'ab') as f:
+        f.write(SAMPLE_LINES[7] + b'\n')
+    assert index.update()
+    assert len(index.candidate_spans([b'allocateBlock'])[0]) == 1
+    assert not index.update()
+
+
+def test_persisted_index_is_loaded(write_log, tmp_path):
+    log_file = write_log(LINES)
+    index = build_index(log_file, tmp_path)
+    index.save()
+    loaded = TokenIndex(log_file, index.index_path)
+    assert loaded.load()
+    assert loaded.candidate_spans([b'Got exception']) == index.candidate_spans([b'Got exception'])
+    assert loaded.matches_log_file()
+
+
+def test_index_is_rewritten_only_after_enough_new_data(write_log, tmp_path):
+    log_file = write_log(LINES)
+    index = build_index(log_file, tmp_path)
+    assert index.needs_save(LogIndexer.MIN_SAVE_SIZE)
+    index.save()
+    assert not index.needs_save(1)
+
+    with open(log_file, 'ab') as f:
+        f.write(SAMPLE_LINES[7] + b'\n')
+    index.update()
+    assert not index.needs_save(LogIndexer.MIN_SAVE_SIZE)
+    assert index.needs_save(1)
+
+
+def test_indexer_persists_small_appends_on_exit(write_log, tmp_path):
+    log_file = write_log(LINES)
+    indexer = LogIndexer(log_file, str(tmp_path / 'index'))
+    os.makedirs(indexer.index_dir)
+    indexer.refresh()
+    index_path = indexer.index_path(log_file)
+    persisted_size = os.path.getsize(index_path)
+
+    with open(log_file, 'ab') as f:
+        f.write(SAMPLE_LINES[7] + b'\n')
+    indexer.refresh()
+    assert indexer.get_index(log_file).candidate_spans([b'allocateBlock'])
+    assert os.path.getsize(index_path) == persisted_size
+
+    indexer.save_all()
+    loaded = TokenIndex(log_file, index_path)
+    assert loaded.load() and loaded.indexed_size == os.path.getsize(log_file)
+
+
+
+def test_small_appends_are_persisted_after_the_save_interval(write_log, tmp_path, monkeypatch):
+    log_file = write_log(LINES)
+    indexer = LogIndexer(log_file, str(tmp_path / 'index'))
+    os.makedirs(indexer.index_dir)
+    indexer.refresh()
+    with open(log_file, 'ab') as f:
+        f.write(SAMPLE_LINES[7] + b'\n')
+    monkeypatch.setattr(LogIndexer, 'SAVE_INTERVAL', 0)
+    indexer.refresh()
+    loaded = TokenIndex(log_file, indexer.index_path(log_file))
+    assert loaded.load() and loaded.indexed_size == os.path.getsize(log_file)
+
+
+def test_index_file_holds_only_data(write_log, tmp_path):
+    log_file = write_log(LINES)
+    index = build_index(log_file, tmp_path)
+    index.save()
+    with open(index.index_path, 'rb') as f:
+        data = f.read()
+    assert data.startswith(TokenIndex.MAGIC)
+
+    # files which are not token indexes, e.g. pickles, or which were cut short are not loaded
+    for content in [pickle.dumps({'version': TokenIndex.FORMAT_VERSION}), data[:len(data) // 2], data[:-8]]:
+        with open(index.index_path, 'wb') as f:
+            f.write(content)
+        assert not TokenIndex(log_file, index.index_path).load()
+
+def test_rotated_log_file_is_reindexed_and_persisted(write_log, tmp_path):
+    log_file = write_log(LINES)
+    index = build_index(log_file, tmp_path)
+    index.save()
+    os.remove(log_file)
+    write_log(LINES[:200])
+    assert not index.matches_log_file()
+    assert index.update()
+    assert index.needs_save(LogIndexer.MIN_SAVE_SIZE)
+
+
+def test_read_only_indexer_loads_the_index_of_another_process(write_log, tmp_path):
+    log_file = write_log(LINES)
+    reader = LogIndexer(log_file, str(tmp_path / 'index'), read_only=True)
+    os.makedirs(reader.index_dir)
+    reader.reload()
+    assert reader.get_index(log_file) is None
+
+    writer = LogIndexer(log_file, reader.index_dir)
+    writer.refresh()
+    reader.reload()
+    assert reader.get_index(log_file).candidate_spans([b'Got exception']) == \
+        writer.get_index(log_file).candidate_spans([b'Got exception'])
+
+    # the reader drops the index of a rewritten log file until the writer indexed it again
+    os.remove(log_file)
+    write_log(LINES[:200])
+    reader.reload()
+    assert reader.get_index(log_file) is None
+    writer.refresh()
+    reader.reload()
+    assert reader.get_index(log_file).indexed_size == os.path.getsize(log_file)
+
+
+def test_read_only_indexer_never_persists_an_index(write_log, tmp_path, monkeypatch):
+    registered = []
+    monkeypatch.setattr(token_index.atexit, 'register', registered.append)
+    monkeypatch.setattr(LogIndexer, 'run', lambda indexer: None)
+    log_file = write_log(LINES)
+    LogIndexer(log_file, str(tmp_path / 'index'), read_only=True).start()
+    assert registered == [] and os.listdir(tmp_path / 'index') == []
+    writer = LogIndexer(log_file, str(tmp_path / 'index'))
+    writer.start()
+    assert registered == [writer.save_all]
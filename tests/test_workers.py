@@ -0,0 +1,45 @@
+import socket
+import pytest
+from log_searcher import LogSearcher
+from log_segment import SegmentBuilder
+from tests.support import SAMPLE_LINES
+from token_index import LogIndexer
+from workers import WorkerSupervisor
+
+
+def test_workers_share_the_scan_workers_of_the_server():
+    options = {'workers': 4, 'scan_workers': 8, 'index_dir': 'index'}
+    assert WorkerSupervisor.worker_options(options, 3) == \
+        {'workers': 4, 'scan_workers': 2, 'index_dir': 'index', 'worker': 3}
+    # the settings of the server are left as they are for the other workers
+    assert options == {'workers': 4, 'scan_workers': 8, 'index_dir': 'index'}
+    # the workers keep scanning in parallel however few scan workers are left to share
+    assert WorkerSupervisor.worker_options({'workers': 4, 'scan_workers': 3}, 0)['scan_workers'] == 2
+    assert WorkerSupervisor.worker_options({'workers': 4, 'scan_workers': 1}, 0)['scan_workers'] == 1
+    assert WorkerSupervisor.worker_options({'workers': 2}, 1)['scan_workers'] == 0
+
+
+def test_listen_socket_has_the_address_family_of_the_hostname():
+    listen_socket = WorkerSupervisor.create_listen_socket('127.0.0.1', 0)
+    with listen_socket:
+        assert listen_socket.family == socket.AF_INET
+    if socket.has_ipv6:
+        try:
+            listen_socket = WorkerSupervisor.create_listen_socket('::1', 0)
+        except OSError:
+            pytest.skip('IPv6 is not available')
+        with listen_socket:
+            assert listen_socket.family == socket.AF_INET6
+
+
+def test_only_worker_zero_builds_the_indexes_and_segments(write_log, tmp_path, monkeypatch):
+    # no background indexing, only the roles of the workers are checked
+    monkeypatch.setattr(LogIndexer, 'run', lambda indexer: None)
+    monkeypatch.setattr(SegmentBuilder, 'run', lambda builder: None)
+    log_file = write_log(SAMPLE_LINES)
+    options = {'workers': 2, 'index_dir': str(tmp_path / 'index'), 'segment_dir': str(tmp_path / 'segments')}
+    for worker_id in range(2):
+        searcher = LogSearcher.create(log_file, WorkerSupervisor.worker_options(options, worker_id))
+        assert searcher.worker == worker_id
+        assert searcher.indexer.read_only == searcher.segments.read_only == (worker_id != 0)
+    assert LogSearcher.create(log_file, {'index_dir': str(tmp_path / 'index')}).indexer.read_only is False